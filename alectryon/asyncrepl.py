@@ -0,0 +1,206 @@
+# Copyright © 2026 Clément Pit-Claudel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Drive provers through asyncio subprocess streams, from synchronous code.
+
+``AsyncREPL`` replaces the blocking pipes of a ``REPLDriver`` with asyncio
+streams, managed by a single event loop running in a background thread (see
+``EventLoopThread``).  This is a thread bridge, not an asynchronous driver: the
+driver logic is unchanged and synchronous, and each read or write blocks the
+calling thread until the event loop completes it.  What the bridge adds is a
+deadline on each read and write (``READ_TIMEOUT``), and a single place where
+all prover processes are managed.  ``annotate_async`` runs ``annotate`` in a
+worker thread, so that async code, such as a build server, can annotate
+documents without blocking its own event loop.
+"""
+
+from typing import Any, Optional
+
+import asyncio
+import os
+import threading
+from subprocess import PIPE
+
+from .core import debug, ProverTimeout
+from .lean3 import Lean3
+from .serapi import SerAPI
+
+class EventLoopThread:
+    """An asyncio event loop running in a daemon thread."""
+    _instance: Optional["EventLoopThread"] = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="alectryon-asyncio", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls) -> "EventLoopThread":
+        """Return the shared loop, starting it if needed (including after ``fork``)."""
+        with cls._lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def run(self, coro, timeout: Optional[float] = None) -> Any:
+        """Run `coro` on this loop; raise ``ProverTimeout`` after `timeout` seconds."""
+        async def _run():
+            try:
+                return await asyncio.wait_for(coro, timeout)
+            except asyncio.TimeoutError:
+                MSG = "No response from prover after {} seconds."
+                raise ProverTimeout(MSG.format(timeout)) from None
+        return asyncio.run_coroutine_threadsafe(_run(), self.loop).result()
+
+class _Stream:
+    """A stream of an ``AsyncProcess``, closable from any thread."""
+    def __init__(self, process: "AsyncProcess", stream):
+        self.process, self.stream = process, stream
+
+    def read(self, timeout: Optional[float] = 1) -> bytes:
+        """Read until EOF or for at most `timeout` seconds, and return what was read.
+
+        This is only used to report the rest of a prover's output after an
+        error, so it does not fail if the prover is still running.
+        """
+        chunks = []
+        async def _read():
+            while True:
+                chunk = await self.stream.read(2 ** 16)
+                if not chunk:
+                    return
+                chunks.append(chunk)
+        try:
+            self.process.runner.run(_read(), timeout)
+        except ProverTimeout:
+            pass
+        return b"".join(chunks)
+
+    def close(self):
+        if self.stream is not None and hasattr(self.stream, "close"):
+            self.process.runner.loop.call_soon_threadsafe(self.stream.close)
+
+class AsyncProcess:
+    """A prover process managed by an ``EventLoopThread``.
+
+    This exposes the parts of ``subprocess.Popen``'s interface that
+    ``REPLDriver`` and ``DriverPool`` use, plus ``readline`` and ``write``.
+    """
+    def __init__(self, runner: EventLoopThread, proc: asyncio.subprocess.Process):
+        self.runner, self.proc = runner, proc
+        self.stdin, self.stdout = _Stream(self, proc.stdin), _Stream(self, proc.stdout)
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def poll(self):
+        return self.proc.returncode
+
+    def readline(self, timeout: Optional[float] = None) -> bytes:
+        return self.runner.run(self.proc.stdout.readline(), timeout)
+
+    def write(self, bs: bytes, timeout: Optional[float] = None):
+        async def _write():
+            self.proc.stdin.write(bs)
+            await self.proc.stdin.drain()
+        self.runner.run(_write(), timeout)
+
+    def kill(self):
+        async def _kill():
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+        self.runner.run(_kill())
+
+    def wait(self, timeout: Optional[float] = None):
+        return self.runner.run(self.proc.wait(), timeout)
+
+class AsyncREPL:
+    """A mixin that runs a ``REPLDriver``'s prover through asyncio streams."""
+    # Maximum time to wait for each line of output (or for each write to
+    # complete), in seconds (``None``: no limit).  This is not a deadline for
+    # whole queries: use ``SENTENCE_TIMEOUT`` and ``DOCUMENT_TIMEOUT`` for that.
+    READ_TIMEOUT: Optional[float] = None
+
+    # Maximum length of a line of output (asyncio's default is 64kB, but goals
+    # printed by sertop can be much larger)
+    STREAM_LIMIT = 2 ** 30
+
+    repl: Optional[AsyncProcess]
+
+    def _start(self, stdin=PIPE, stderr=PIPE, stdout=PIPE, more_args=()):
+        cmd = self._repl_command(more_args) # type: ignore
+        self._debug_start(cmd) # type: ignore
+        runner = EventLoopThread.get()
+        proc = runner.run(asyncio.create_subprocess_exec(
+            *cmd, stdin=stdin, stderr=stderr, stdout=stdout, limit=self.STREAM_LIMIT))
+        return AsyncProcess(runner, proc)
+
+    def _readline(self) -> bytes:
+        assert self.repl
+        return self.repl.readline(self.READ_TIMEOUT)
+
+    def _writebytes(self, bs: bytes):
+        assert self.repl
+        self.repl.write(bs, self.READ_TIMEOUT)
+
+    def _read(self):
+        response = self._readline()
+        debug(response, '<< ')
+        self._record("read", response) # type: ignore
+        return response
+
+    def _write(self, s, end):
+        debug(s, '>> ')
+        self._record("write", s + end) # type: ignore
+        self._writebytes(s + end)
+
+    async def annotate_async(self, chunks):
+        """Run ``annotate`` in a worker thread, without blocking the running event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.annotate, chunks) # type: ignore
+
+class AsyncTextREPL(AsyncREPL):
+    """Like ``AsyncREPL``, for drivers that exchange text with their prover."""
+    REPL_ENCODING = "utf-8"
+
+    def _read(self):
+        response = self._readline().decode(self.REPL_ENCODING)
+        debug(response, '<< ')
+        self._record("read", response) # type: ignore
+        return response
+
+    def _write(self, s, end):
+        debug(s, '>> ')
+        self._record("write", s + end) # type: ignore
+        self._writebytes((s + end).encode(self.REPL_ENCODING))
+
+class AsyncSerAPI(AsyncREPL, SerAPI):
+    ID = "sertop_async"
+
+class AsyncLean3(AsyncTextREPL, Lean3):
+    ID = "lean3_async"
@@ -22,11 +22,15 @@ from typing import Tuple, List, Union
 
 import argparse
 import inspect
+import json
 import os
 import os.path
 import re
 import shutil
 import sys
+import time
+import tracemalloc
+from types import GeneratorType
 
 from . import __version__, core
 
@@ -75,17 +79,16 @@ def rst_to_code(rst, fpath, point, marker, backend):
     lang = LANGUAGES[backend.replace("+rst", "")]
     return _catch_parsing_errors(fpath, rst2code_marked, lang, rst, point, marker)
 
-def annotate_chunks(chunks, fpath, cache_directory, cache_compression,
+def annotate_chunks(chunks, fpath, cache_directory, cache_compression, cache_backend,
                     input_language, driver_name, driver_args, exit_code):
     from .core import StderrObserver
     from .json import CacheSet
     driver_cls = core.resolve_driver(input_language, driver_name)
     driver = driver_cls(driver_args, fpath=fpath)
-    with CacheSet(cache_directory, fpath, cache_compression) as caches:
-        annotated = caches[input_language].update(chunks, driver)
+    with CacheSet(cache_directory, fpath, cache_compression, cache_backend) as caches:
+        yield from caches[input_language].update_iter(chunks, driver)
         assert isinstance(driver.observer, StderrObserver)
         exit_code.val = int(driver.observer.exit_code >= 3)
-        return annotated
 
 def map_code_chunks(chunks, f):
     from .literate import Code
@@ -99,9 +102,9 @@ def map_code_chunks(chunks, f):
             j += 1
     return chunks
 
-def annotate_chunks_mixed(chunks, fpath, cache_directory, cache_compression,
+def annotate_chunks_mixed(chunks, fpath, cache_directory, cache_compression, cache_backend,
                           input_language, driver_name, driver_args, exit_code):
-    return map_code_chunks(chunks, lambda code_chunks: annotate_chunks(code_chunks, fpath, cache_directory, cache_compression,
+    return map_code_chunks(chunks, lambda code_chunks: annotate_chunks(code_chunks, fpath, cache_directory, cache_compression, cache_backend,
                                                                 input_language, driver_name, driver_args, exit_code))
 
 def register_docutils(v, ctx):
@@ -111,6 +114,7 @@ def register_docutils(v, ctx):
     docutils.AlectryonTransform.LANGUAGE_DRIVERS = ctx["language_drivers"]
     docutils.CACHE_DIRECTORY = ctx["cache_directory"]
     docutils.CACHE_COMPRESSION = ctx["cache_compression"]
+    docutils.CACHE_BACKEND = ctx["cache_backend"]
     docutils.HTML_MINIFICATION = ctx["html_minification"]
     docutils.LONG_LINE_THRESHOLD = ctx["long_line_threshold"]
     docutils.setup(ctx["input_language"] or "coq")
@@ -386,7 +390,7 @@ def dump_html_mixed(snippets, fname, webpage_style,
 
 def encode_json(obj):
     from .json import PlainSerializer
-    return PlainSerializer.encode(obj)
+    return [PlainSerializer.encode(fragments) for fragments in obj]
 
 def decode_json(obj):
     from .json import PlainSerializer
@@ -491,6 +495,8 @@ def _add_code_pipelines(pipelines, lang, *exts):
          write_file(".io.json", strip=()))
     }
     pipelines[lang + '+rst'] = {
+        'null':
+        (read_plain, register_docutils, gen_docutils),
         'webpage':
         (read_plain, register_docutils, gen_docutils, copy_assets,
          write_file(".html", strip=(*exts, ".rst"))),
@@ -502,6 +508,8 @@ def _add_code_pipelines(pipelines, lang, *exts):
          write_file(".lint.json", strip=(*exts, ".rst"))),
     }
     pipelines[lang + '+markup'] = {
+        'null':
+        (read_plain, parse_literate, annotate_chunks_mixed),
         'webpage':
         (read_plain, parse_literate, annotate_chunks_mixed, apply_transforms_mixed,
          gen_html_snippets_mixed, dump_html_mixed, copy_assets,
@@ -510,6 +518,8 @@ def _add_code_pipelines(pipelines, lang, *exts):
 
 def _add_coqdoc_pipeline(pipelines):
     pipelines['coqdoc'] = {
+        'null':
+        (read_plain, parse_plain, annotate_chunks),
         'webpage':
         (read_plain, parse_plain, annotate_chunks, # transforms applied later
          gen_html_snippets_with_coqdoc, dump_html_standalone, copy_assets,
@@ -519,6 +529,8 @@ def _add_coqdoc_pipeline(pipelines):
 def _add_docutils_pipelines(pipelines, lang, *exts):
     exts = (*CODE_EXTENSIONS, *exts)
     pipelines[lang] = {
+        'null':
+        (read_plain, register_docutils, gen_docutils),
         'webpage':
         (read_plain, register_docutils, gen_docutils, copy_assets,
          write_file(".html", strip=exts)),
@@ -668,6 +680,28 @@ COPY_FUNCTIONS = {
     "none": None
 }
 
+def find_prewarm_inputs(paths):
+    """Expand directories in `paths` into the source files that they contain."""
+    exts = tuple(ext for ext, frontend in FRONTENDS_BY_EXTENSION
+                 if not frontend.endswith("json"))
+    for fpath in paths:
+        if not os.path.isdir(fpath):
+            yield fpath
+            continue
+        for root, dirs, files in os.walk(fpath):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for fname in sorted(files):
+                if fname.endswith(exts):
+                    yield os.path.join(root, fname)
+
+def resolve_prewarm_pipeline(fpath, args):
+    # The ``null`` backend annotates inputs without rendering them
+    frontend = args.frontend or infer_frontend(fpath)
+    if "null" not in PIPELINES[frontend]:
+        MSG = "argument --prewarm: Frontend {!r} does not support prewarming"
+        raise argparse.ArgumentTypeError(MSG.format(frontend))
+    return frontend, "null", PIPELINES[frontend]["null"]
+
 def post_process_arguments(parser, args):
     if len(args.input) > 1 and args.output:
         parser.error("argument --output: Not valid with multiple inputs")
@@ -685,6 +719,27 @@ def post_process_arguments(parser, args):
         "coq": args.coq_driver
     }
 
+    for flag in ("shared_cache", "cache_gc", "cache_stats"):
+        if getattr(args, flag) and args.cache_directory is None:
+            MSG = "argument --{}: requires --cache-directory"
+            parser.error(MSG.format(flag.replace("_", "-")))
+
+    if args.cache_backend == "sqlite":
+        if args.shared_cache or args.cache_gc:
+            MSG = "argument {}: not allowed with --cache-backend=sqlite"
+            parser.error(MSG.format("--shared-cache" if args.shared_cache else "--cache-gc"))
+        if args.cache_compression == "binary":
+            parser.error("argument --cache-compression: 'binary' is not "
+                         "allowed with --cache-backend=sqlite")
+    elif args.cache_max_size is not None:
+        parser.error("argument --cache-max-size: requires --cache-backend=sqlite")
+
+    if args.record_transcripts and args.replay_transcripts:
+        MSG = "argument --record-transcripts: not allowed with --replay-transcripts"
+        parser.error(MSG)
+    if args.replay_transcripts:
+        args.language_drivers = {lang: "replay" for lang in core.ALL_LANGUAGES}
+
     coq_args = []
     for (dirpath,) in args.coq_args_I:
         coq_args.extend(("-I", dirpath))
@@ -705,9 +760,12 @@ def post_process_arguments(parser, args):
     args.driver_args_by_name = {
         "sertop": args.sertop_args,
         "sertop_noexec": args.sertop_args,
+        "sertop_async": args.sertop_args,
         "coqc_time": args.coqc_args,
         "lean3_repl": (),
+        "lean3_async": (),
         "leanInk": leanInk_args,
+        "replay": (),
     }
     assert set(core.ALL_DRIVERS) == args.driver_args_by_name.keys()
 
@@ -725,8 +783,19 @@ def post_process_arguments(parser, args):
             MSG = "argument --mark-point: Expecting a number, not {!r}"
             parser.error(MSG.format(args.point))
 
-    args.pipelines = [(fpath, *resolve_pipeline(fpath, args))
-                      for fpath in args.input]
+    if args.prewarm is not None:
+        if args.cache_directory is None:
+            parser.error("argument --prewarm: requires --cache-directory")
+        if "-" in args.input:
+            parser.error("argument --prewarm: input cannot be '-'")
+        if args.profile:
+            # Annotation happens in worker processes, which are not profiled
+            parser.error("argument --prewarm: not allowed with --profile")
+        args.pipelines = [(fpath, *resolve_prewarm_pipeline(fpath, args))
+                          for fpath in find_prewarm_inputs(args.input)]
+    else:
+        args.pipelines = [(fpath, *resolve_pipeline(fpath, args))
+                          for fpath in args.input]
 
     return args
 
@@ -814,13 +883,54 @@ and produce reStructuredText, HTML, LaTeX, or JSON output.""",
     cache_out.add_argument("--cache-directory", default=None, metavar="DIRECTORY",
                            help=CACHE_DIRECTORY_HELP)
 
-    CACHE_COMPRESSION_HELP = ("Compress caches.")
-    CACHE_COMPRESSION_CHOICES = ("none", "gzip", "xz")
+    CACHE_COMPRESSION_HELP = ("Compress caches, or store them in a binary "
+                              "format that is faster to load.")
+    CACHE_COMPRESSION_CHOICES = ("none", "gzip", "xz", "binary")
     cache_out.add_argument("--cache-compression", nargs='?',
                            default=None, const="xz",
                            choices=CACHE_COMPRESSION_CHOICES,
                            help=CACHE_COMPRESSION_HELP)
 
+    SHARED_CACHE_HELP = ("Also store prover output in a content-addressed "
+                         "store shared by all documents in the cache "
+                         "directory, so that documents that start with the "
+                         "same code reuse each other's results.")
+    cache_out.add_argument("--shared-cache", action="store_true",
+                           default=False, help=SHARED_CACHE_HELP)
+
+    CACHE_GC_HELP = ("After processing, delete entries of the shared store "
+                     "that no cached document uses anymore.")
+    cache_out.add_argument("--cache-gc", action="store_true",
+                           default=False, help=CACHE_GC_HELP)
+
+    CACHE_STATS_HELP = ("After processing, print cache hits, misses (by "
+                        "reason), bytes read and written, time spent decoding "
+                        "and encoding caches, and prover time saved.")
+    cache_out.add_argument("--cache-stats", action="store_true",
+                           default=False, help=CACHE_STATS_HELP)
+
+    PREWARM_HELP = ("Only annotate inputs and store the results in the cache "
+                    "(without transforming or rendering them), using up to "
+                    "JOBS processes (default: one per CPU).  Directories are "
+                    "searched recursively for input files.  Report progress "
+                    "and per-file timings.")
+    cache_out.add_argument("--prewarm", metavar="JOBS", type=int,
+                           nargs="?", const=0, default=None,
+                           help=PREWARM_HELP)
+
+    CACHE_BACKEND_HELP = ("Store caches in one file per document ('files', the "
+                          "default), or in a single SQLite database in the cache "
+                          "directory ('sqlite').")
+    CACHE_BACKEND_CHOICES = ("files", "sqlite")
+    cache_out.add_argument("--cache-backend", default="files",
+                           choices=CACHE_BACKEND_CHOICES,
+                           help=CACHE_BACKEND_HELP)
+
+    CACHE_MAX_SIZE_HELP = ("Evict least recently used entries from the SQLite "
+                           "cache when it grows larger than MEGABYTES.")
+    cache_out.add_argument("--cache-max-size", type=float, default=None,
+                           metavar="MEGABYTES", help=CACHE_MAX_SIZE_HELP)
+
     html_out = parser.add_argument_group("HTML output configuration")
 
     WEBPAGE_STYLE_HELP = "Choose a style for standalone webpages."
@@ -838,6 +948,12 @@ and produce reStructuredText, HTML, LaTeX, or JSON output.""",
                           default=False,
                           help=HTML_MINIFICATION_HELP)
 
+    TIMING_HEATMAP_HELP = ("Color sentences by how long the prover spent on "
+                           "them (requires timings; see --record-timings).")
+    html_out.add_argument("--timing-heatmap", action='store_true',
+                          default=False,
+                          help=TIMING_HEATMAP_HELP)
+
     HTML_DIALECT_HELP = "Choose which HTML dialect to use."
     HTML_DIALECT_CHOICES = ("html4", "html5")
     html_out.add_argument("--html-dialect", default="html4",
@@ -869,6 +985,46 @@ and produce reStructuredText, HTML, LaTeX, or JSON output.""",
                       metavar="COQC_ARG",
                       help=COQC_ARGS_HELP)
 
+    SERTOP_TRANSPORT_HELP = ("Choose how sertop prints its responses: as "
+                             "s-expressions (the default, and usually faster), "
+                             "as JSON (experimental), or 'auto' to use JSON "
+                             "when the installed sertop supports it and "
+                             "s-expressions otherwise.")
+    subp.add_argument("--sertop-transport", choices=("sexp", "json", "auto"),
+                      default=None, help=SERTOP_TRANSPORT_HELP)
+
+    REUSE_PROVERS_HELP = ("Keep prover processes running across input files, "
+                          "resetting them between documents instead of "
+                          "restarting them.")
+    subp.add_argument("--reuse-provers", action="store_true",
+                      default=False, help=REUSE_PROVERS_HELP)
+
+    RECORD_TIMINGS_HELP = ("Record how long the prover spends adding, "
+                           "running, and printing the goals of each sentence "
+                           "(SerAPI and Lean 3 drivers only).")
+    subp.add_argument("--record-timings", action="store_true",
+                      default=False, help=RECORD_TIMINGS_HELP)
+
+    SENTENCE_TIMEOUT_HELP = ("Give up on sentences that run for more than "
+                             "SECONDS, restart the prover, and continue with "
+                             "the next chunk (SerAPI drivers only).")
+    subp.add_argument("--sentence-timeout", metavar="SECONDS", type=float,
+                      default=None, help=SENTENCE_TIMEOUT_HELP)
+
+    DOCUMENT_TIMEOUT_HELP = ("Stop running sentences once a document has been "
+                             "processed for SECONDS; later sentences are shown "
+                             "without goals or messages (SerAPI drivers only).")
+    subp.add_argument("--document-timeout", metavar="SECONDS", type=float,
+                      default=None, help=DOCUMENT_TIMEOUT_HELP)
+
+    PARALLEL_SEGMENTS_HELP = ("Split documents at `Reset Initial.` and "
+                              "`(* alectryon-segment *)` and annotate the "
+                              "resulting segments in parallel, using up to "
+                              "JOBS processes (default: one per CPU).")
+    subp.add_argument("--parallel-segments", metavar="JOBS", type=int,
+                      nargs="?", const=0, default=None,
+                      help=PARALLEL_SEGMENTS_HELP)
+
     I_HELP = "Pass -I DIR to the SerAPI subprocess."
     subp.add_argument("-I", "--ml-include-path", dest="coq_args_I",
                       metavar="DIR", nargs=1, action="append",
@@ -902,10 +1058,27 @@ and produce reStructuredText, HTML, LaTeX, or JSON output.""",
     debug.add_argument("--expect-unexpected", action="store_true",
                        default=False, help=EXPECT_UNEXPECTED_HELP)
 
+    RECORD_TRANSCRIPTS_HELP = ("Record communications with prover processes "
+                               "into transcripts in DIR.")
+    debug.add_argument("--record-transcripts", metavar="DIR", default=None,
+                       help=RECORD_TRANSCRIPTS_HELP)
+
+    REPLAY_TRANSCRIPTS_HELP = ("Instead of running provers, replay transcripts "
+                               "recorded with --record-transcripts in DIR.")
+    debug.add_argument("--replay-transcripts", metavar="DIR", default=None,
+                       help=REPLAY_TRANSCRIPTS_HELP)
+
     DEBUG_HELP = "Print communications with prover process."
     debug.add_argument("--debug", action="store_true",
                        default=False, help=DEBUG_HELP)
 
+    PROFILE_HELP = ("Measure time and memory used by each pipeline step and "
+                    "each prover call; print a summary and write a JSON "
+                    "report to REPORT (default: alectryon.profile.json).  "
+                    "Memory tracing slows Alectryon down significantly.")
+    debug.add_argument("--profile", metavar="REPORT", nargs="?", default=None,
+                       const="alectryon.profile.json", help=PROFILE_HELP)
+
     TRACEBACK_HELP = "Print error traces."
     debug.add_argument("--traceback", action="store_true",
                        default=False, help=TRACEBACK_HELP)
@@ -925,7 +1098,12 @@ class ExitCode:
 
 def call_pipeline_step(step, state, ctx):
     params = list(inspect.signature(step).parameters.keys())[1:]
-    return step(state, **{p: ctx[p] for p in params})
+    if core.PROFILER is None:
+        return step(state, **{p: ctx[p] for p in params})
+    with core.profiled("step", step.__name__, fpath=ctx["fpath"]):
+        state = step(state, **{p: ctx[p] for p in params})
+        # Force lazy steps, to attribute their costs correctly
+        return list(state) if isinstance(state, (GeneratorType, map)) else state
 
 def build_context(fpath, args, frontend, backend):
     input_is_stdin = fpath == "-"
@@ -968,7 +1146,8 @@ def except_hook(etype, value, tb):
     for line in TracebackException(etype, value, tb, capture_locals=True).format():
         print(line, file=sys.stderr)
 
-def process_pipelines(args):
+def configure(args):
+    """Apply global settings from command-line arguments `args`."""
     if args.debug:
         core.DEBUG = True
 
@@ -980,11 +1159,131 @@ def process_pipelines(args):
         from . import serapi
         serapi.SerAPI.EXPECT_UNEXPECTED = True
 
-    for fpath, frontend, backend, pipeline in args.pipelines:
-        state, ctx = None, build_context(fpath, args, frontend, backend)
-        for step in pipeline:
-            state = call_pipeline_step(step, state, ctx)
-        yield ctx["exit_code"].val
+    if args.sertop_transport is not None:
+        from . import serapi
+        serapi.SerAPI.TRANSPORT = args.sertop_transport
+
+    if args.record_timings:
+        core.Driver.RECORD_TIMINGS = True
+
+    if args.shared_cache:
+        from .json import FileCacheSet
+        FileCacheSet.SHARED_STORE = True
+
+    if args.cache_max_size is not None:
+        from .json import SQLiteCacheSet
+        SQLiteCacheSet.MAX_SIZE = int(args.cache_max_size * 1024 * 1024)
+
+    if args.timing_heatmap:
+        from .html import HtmlGenerator
+        HtmlGenerator.TIMING_HEATMAP = True
+
+    core.REPLDriver.SENTENCE_TIMEOUT = args.sentence_timeout
+    core.REPLDriver.DOCUMENT_TIMEOUT = args.document_timeout
+
+    transcripts = args.record_transcripts or args.replay_transcripts
+    if transcripts:
+        core.CLIDriver.TRANSCRIPT_DIRECTORY = transcripts
+
+    if args.parallel_segments is not None:
+        from .parallel import SegmentedAnnotator
+        core.Driver.SEGMENTER = SegmentedAnnotator(
+            args.parallel_segments, initializer=configure, initargs=(worker_args(args),))
+
+def worker_args(args):
+    """Copy `args` for ``configure`` in worker processes (minus the pipelines)."""
+    return argparse.Namespace(**{**vars(args), "pipelines": None})
+
+def run_pipeline(fpath, args, frontend, backend, pipeline):
+    state, ctx = None, build_context(fpath, args, frontend, backend)
+    for step in pipeline:
+        state = call_pipeline_step(step, state, ctx)
+    if isinstance(state, GeneratorType):
+        for _ in state: # Run lazy pipelines to completion
+            pass
+    return ctx["exit_code"].val
+
+def _prewarm_one(fpath, args, frontend, backend, pipeline):
+    from . import json as alectryon_json
+    alectryon_json.STATS = alectryon_json.CacheStats() # Reported per file
+    start = time.perf_counter()
+    exit_code = run_pipeline(fpath, args, frontend, backend, pipeline)
+    return exit_code, time.perf_counter() - start, alectryon_json.STATS
+
+def _prewarm_worker(args):
+    configure(args)
+    if args.reuse_provers:
+        from multiprocessing.util import Finalize
+        core.REPLDriver.POOL = pool = core.DriverPool()
+        Finalize(None, pool.close, exitpriority=0) # Kill idle provers on exit
+
+def prewarm(args):
+    """Run prewarming pipelines in a pool of ``args.prewarm`` worker processes.
+
+    Report progress and per-file timings on stderr, and yield exit codes.  With
+    ``--reuse-provers``, each worker keeps its own pool of provers.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from .json import STATS
+    wargs = worker_args(args) # Each pipeline is sent with its own task
+    start, total = time.perf_counter(), len(args.pipelines)
+    with ProcessPoolExecutor(max_workers=args.prewarm or None,
+                             initializer=_prewarm_worker, initargs=(wargs,)) as ex:
+        futures = {ex.submit(_prewarm_one, fpath, wargs, *rest): fpath
+                   for fpath, *rest in args.pipelines}
+        for done, future in enumerate(as_completed(futures), start=1):
+            fpath = futures[future]
+            try:
+                exit_code, elapsed, stats = future.result()
+            except Exception as e: # pylint: disable=broad-except
+                print("[{}/{}] {}: failed ({}: {})".format(
+                    done, total, fpath, type(e).__name__, e), file=sys.stderr)
+                yield 1
+                continue
+            STATS.merge(stats)
+            print("[{}/{}] {}: {:.2f}s".format(done, total, fpath, elapsed), file=sys.stderr)
+            yield exit_code
+    print("Prewarmed caches for {} files in {:.2f}s.".format(
+        total, time.perf_counter() - start), file=sys.stderr)
+
+def process_pipelines(args):
+    configure(args)
+
+    if args.profile:
+        core.PROFILER = core.Profiler()
+        tracemalloc.start()
+
+    try:
+        if args.prewarm is not None:
+            yield from prewarm(args)
+        else:
+            with core.DriverPool() if args.reuse_provers else core.nullctx() as pool:
+                core.REPLDriver.POOL = pool
+                try:
+                    for fpath, frontend, backend, pipeline in args.pipelines:
+                        yield run_pipeline(fpath, args, frontend, backend, pipeline)
+                finally:
+                    core.REPLDriver.POOL = None
+    finally:
+        if args.profile:
+            write_profile(core.PROFILER, args.profile)
+    if args.cache_gc:
+        collect_cache_garbage(args.cache_directory)
+    if args.cache_stats:
+        from .json import STATS
+        print(STATS.format_summary(), file=sys.stderr)
+
+def collect_cache_garbage(cache_directory):
+    from .json import SharedStore
+    deleted = SharedStore(cache_directory).collect_garbage()
+    print("Deleted {} unused entries from the shared cache.".format(deleted), file=sys.stderr)
+
+def write_profile(profiler, report_path):
+    tracemalloc.stop()
+    print(profiler.format_summary(), file=sys.stderr)
+    with open(report_path, mode="w", encoding="utf-8") as report:
+        json.dump({"records": profiler.records, "summary": profiler.summary()},
+                  report, indent=2)
 
 def main():
     try:
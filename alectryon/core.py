@@ -19,8 +19,8 @@
 # SOFTWARE.
 
 from functools import reduce
-from typing import Any, DefaultDict, Dict, Iterable, \
-    NamedTuple, NoReturn, Optional, Tuple, Union
+from typing import Any, DefaultDict, Dict, Iterable, List, \
+    NamedTuple, NoReturn, Optional, Pattern, Tuple, Union
 
 from collections import deque, namedtuple, defaultdict
 from contextlib import contextmanager
@@ -36,13 +36,20 @@ import re
 import subprocess
 import sys
 import textwrap
+import threading
+import time
+import tracemalloc
 
 DEBUG = False
 TRACEBACK = False
+PROFILER: Optional["Profiler"] = None
 
 class UnexpectedError(ValueError):
     pass
 
+class ProverTimeout(TimeoutError):
+    pass
+
 def indent(text, prefix):
     if prefix.isspace():
         return textwrap.indent(text, prefix)
@@ -63,7 +70,17 @@ Hypothesis = namedtuple("Hypothesis", "names body type")
 Goal = namedtuple("Goal", "name conclusion hypotheses")
 Message = namedtuple("Message", "contents")
 TypeInfo = namedtuple("TypeInfo", "name type")
-Sentence = namedtuple("Sentence", "contents messages goals")
+Timing = namedtuple("Timing", "add exec goals print")
+
+class Sentence(namedtuple("Sentence", "contents messages goals timing", defaults=(None,))):
+    __slots__ = ()
+
+    def __repr__(self):
+        # Omit ``timing`` unless it was recorded (see ``Driver.RECORD_TIMINGS``)
+        if self.timing is None:
+            return "Sentence(contents={!r}, messages={!r}, goals={!r})".format(*self[:3])
+        return super().__repr__()
+
 Text = namedtuple("Text", "contents")
 FragmentToken = namedtuple("FragmentToken", "raw typeinfo docstring link semanticType", defaults=("", None, None, None, None))
 Fragment = Union[Text, Sentence]
@@ -129,6 +146,73 @@ def cwd(wd: Union[str, os.PathLike]):
     finally:
         os.chdir(old_cwd)
 
+class Profiler:
+    """Measure time and memory spent in (possibly nested) sections of code.
+
+    Peak memory is only recorded if ``tracemalloc`` is tracing; it is measured
+    relative to the memory in use when the section starts.
+    """
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+        self._peaks: List[int] = [] # Peaks of enclosing sections
+
+    def _reset_peak(self) -> int:
+        _, peak = tracemalloc.get_traced_memory()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        if hasattr(tracemalloc, "reset_peak"): # LATER (3.9+)
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    @contextmanager
+    def section(self, kind: str, name: str, **details):
+        tracing = tracemalloc.is_tracing()
+        mem0 = self._reset_peak() if tracing else 0
+        self._peaks.append(0)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+            peak = self._peaks.pop()
+            if tracing:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            self.records.append({"kind": kind, "name": name, **details,
+                                 "wall": wall, "cpu": cpu,
+                                 "peak_memory": max(peak - mem0, 0) if tracing else None})
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Aggregate records by kind and name, most expensive first."""
+        totals: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for r in self.records:
+            t = totals.setdefault((r["kind"], r["name"]), {
+                "kind": r["kind"], "name": r["name"], "calls": 0,
+                "wall": 0.0, "cpu": 0.0, "peak_memory": None})
+            t["calls"] += 1
+            t["wall"] += r["wall"]
+            t["cpu"] += r["cpu"]
+            if r["peak_memory"] is not None:
+                t["peak_memory"] = max(t["peak_memory"] or 0, r["peak_memory"])
+        return sorted(totals.values(), key=lambda t: -t["wall"])
+
+    def format_summary(self) -> str:
+        lines = ["{:<8} {:<32} {:>5} {:>9} {:>9} {:>10}".format(
+            "kind", "name", "calls", "wall (s)", "cpu (s)", "peak (MiB)")]
+        for t in self.summary():
+            peak = t["peak_memory"]
+            lines.append("{:<8} {:<32} {:>5} {:>9.3f} {:>9.3f} {:>10}".format(
+                t["kind"], t["name"][:32], t["calls"], t["wall"], t["cpu"],
+                "-" if peak is None else "{:.1f}".format(peak / 2**20)))
+        return "\n".join(lines)
+
+def profiled(kind: str, name: str, **details):
+    """Record time and memory spent in a block of code, if profiling."""
+    if PROFILER is None:
+        return nullctx()
+    return PROFILER.section(kind, name, **details)
+
 class Backend:
     def __init__(self, highlighter):
         self.highlighter = highlighter
@@ -213,6 +297,23 @@ class PosStr(str):
         super().__init__()
         self.pos, self.col_offset = pos, col_offset
 
+    def split_at(self, offset):
+        r"""Split this string at character `offset`, adjusting positions.
+
+        >>> head, tail = PosStr("ab\ncd", Position("f", 3, 2), 5).split_at(4)
+        >>> head, head.pos, tail, tail.pos
+        ('ab\nc', Position(fpath='f', line=3, col=2), 'd', Position(fpath='f', line=4, col=7))
+        """
+        head, tail = self[:offset], self[offset:]
+        nl = head.rfind("\n")
+        if nl == -1: # First line
+            line, col = self.pos.line, self.pos.col + offset
+        else:
+            line = self.pos.line + head.count("\n")
+            col = 1 + self.col_offset + len(head) - (nl + 1)
+        return (PosStr(head, self.pos, self.col_offset),
+                PosStr(tail, Position(self.pos.fpath, line, col), self.col_offset))
+
 class View(bytes):
     def __getitem__(self, key):
         return memoryview(self).__getitem__(key)
@@ -388,9 +489,11 @@ class Document:
         [[Text(contents='A')]]
         >>> list(Document.strip_separators([[Text("\n")]], "\n"))
         [[]]
+        >>> list(Document.strip_separators([[Text("A")]], ""))
+        [[Text(contents='A')]]
         """
         for fragments in grouped:
-            if fragments:
+            if fragments and separator:
                 assert fragments[-1].contents.endswith(separator)
                 (contents, _) = fragments[-1].contents.split_at_pos(-len(separator))
                 fragments[-1] = fragments[-1]._replace(contents=contents)
@@ -571,6 +674,17 @@ class FragmentContent:
         return prefix, center, suffix
 
 class Driver():
+    SEGMENT_RE: Optional[Pattern] = None
+    """Where independent segments of a document begin (see ``parallel.py``)."""
+
+    # If set, documents are split into independent segments, which are
+    # annotated in parallel.
+    SEGMENTER: Optional["SegmentedAnnotator"] = None
+
+    # Whether to record how long the prover spends on each sentence (see
+    # ``Timing``, in seconds); drivers that do not measure this ignore it.
+    RECORD_TIMINGS = False
+
     def __init__(self):
         self.observer : Observer = StderrObserver()
 
@@ -588,6 +702,26 @@ class Driver():
         """
         raise NotImplementedError()
 
+    def annotate_iter(self, chunks):
+        """Like ``annotate``, but yield the annotations of each chunk in turn.
+
+        Drivers that process chunks one by one yield each chunk's annotations
+        as soon as they are ready, so that callers can start rendering them
+        while the prover is still running.  By default, this waits for
+        ``annotate`` to return.
+        """
+        yield from self.annotate(chunks)
+
+    def annotate_suffix(self, chunks, start):
+        """Annotate ``chunks[start:]``, after processing ``chunks[:start]``.
+
+        The prefix ``chunks[:start]`` is run for its side effects only, so
+        drivers can skip most of the work for it.  This is used to update caches
+        incrementally; drivers that do not support it raise
+        ``NotImplementedError``.
+        """
+        raise NotImplementedError()
+
 class CLIDriver(Driver): # pylint: disable=abstract-method
     BIN: str = "unset-binary"
     NAME: str = "cli-driver"
@@ -597,11 +731,16 @@ class CLIDriver(Driver): # pylint: disable=abstract-method
 
     CLI_ENCODING = "utf-8"
 
+    # If set, exchanges with the prover are recorded into a transcript in this
+    # directory, to be played back by the ``replay`` driver (see ``replay.py``).
+    TRANSCRIPT_DIRECTORY: Optional[str] = None
+
     def __init__(self, args=(), fpath="-", binpath=None):
         super().__init__()
         self.fpath = Path(fpath)
         self.user_args = args
         self.binpath: str = binpath or self.BIN
+        self.transcript: Optional["TranscriptWriter"] = None
 
     @classmethod
     def version_info(cls, binpath=None):
@@ -610,6 +749,8 @@ class CLIDriver(Driver): # pylint: disable=abstract-method
 
     @property
     def metadata(self):
+        if self.RECORD_TIMINGS:
+            return {"args": self.user_args, "timings": True}
         return {"args": self.user_args}
 
     @classmethod
@@ -625,6 +766,18 @@ class CLIDriver(Driver): # pylint: disable=abstract-method
             cls.driver_not_found(binpath)
         return path
 
+    def _record(self, kind, data):
+        if self.TRANSCRIPT_DIRECTORY is not None:
+            if self.transcript is None:
+                from .replay import TranscriptWriter
+                self.transcript = TranscriptWriter(self, self.TRANSCRIPT_DIRECTORY)
+            self.transcript.record(kind, data)
+
+    def close_transcript(self):
+        """Flush and close this driver's transcript, if it is recording one."""
+        if self.transcript is not None:
+            self.transcript.close()
+
     @staticmethod
     def _debug_start(cmd):
         debug(" ".join(quote(s) for s in cmd), '# ')
@@ -642,55 +795,251 @@ class CLIDriver(Driver): # pylint: disable=abstract-method
             MSG = "Driver {} ({}) exited with code {}:\n{}"
             raise ValueError(MSG.format(self.NAME, self.binpath, p.returncode,
                                         indent(self._proc_out(p), "   ")))
+        self._record("cli", p.stdout)
+        self.close_transcript()
         return p.stdout
 
+    def _read_output(self, fpath: Path) -> str:
+        """Read `fpath`, a file produced by the prover."""
+        contents = fpath.read_text(encoding="utf-8")
+        self._record("file", contents)
+        self.close_transcript()
+        return contents
+
+class Watchdog:
+    """Call `callback` if a deadline passes before ``disarm`` is called.
+
+    A single thread serves all successive deadlines, so arming and disarming
+    are cheap enough to do once per sentence.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadline: Optional[float] = None
+        self.fired = False
+        self.closed = False
+        self.cv = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        with self.cv:
+            while not self.closed:
+                if self.deadline is None:
+                    self.cv.wait()
+                    continue
+                left = self.deadline - time.monotonic()
+                if left > 0:
+                    self.cv.wait(left)
+                    continue
+                self.deadline, self.fired = None, True
+                self.callback()
+
+    def arm(self, timeout: float):
+        with self.cv:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="alectryon-watchdog", daemon=True)
+                self.thread.start()
+            self.deadline, self.fired = time.monotonic() + timeout, False
+            self.cv.notify()
+
+    def disarm(self) -> bool:
+        """Cancel the current deadline; return ``True`` if it had passed."""
+        with self.cv:
+            self.deadline = None
+            return self.fired
+
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify()
+
 class REPLDriver(CLIDriver): # pylint: disable=abstract-method
     REPL_ARGS: Tuple[str, ...] = ()
 
+    # If set, prover processes are taken from and returned to this pool instead
+    # of being started and killed for each document.
+    POOL: Optional["DriverPool"] = None
+
+    # Time budgets in seconds (``None``: no limit), enforced by killing the
+    # prover (see ``time_limit``).
+    SENTENCE_TIMEOUT: Optional[float] = None
+    DOCUMENT_TIMEOUT: Optional[float] = None
+
     def __init__(self, args=(), fpath="-", binpath=None):
         super().__init__(args, fpath, binpath)
         self.repl = None
         self.instance_args: Tuple[str, ...] = ()
+        self.deadline: Optional[float] = None
+        self.watchdog: Optional[Watchdog] = None
 
     def __enter__(self):
-        self.reset()
+        if self.DOCUMENT_TIMEOUT is not None:
+            self.deadline = time.monotonic() + self.DOCUMENT_TIMEOUT
+        if self.POOL is None or not self.POOL.acquire(self):
+            self.reset()
+        else:
+            self._reset_document_state()
         return self
 
-    def __exit__(self, *_exn):
-        self.kill()
+    def __exit__(self, *exn):
+        if self.watchdog:
+            self.watchdog.close()
+            self.watchdog = None
+        self.close_transcript()
+        if exn[0] is not None or self.POOL is None or not self.POOL.release(self):
+            self.kill()
         return False
 
+    def time_left(self, per_sentence=True) -> Optional[float]:
+        """Compute the time budget of the next sentence (``None``: no limit).
+
+        With `per_sentence` unset, only the document's budget is considered.
+        """
+        budgets = []
+        if per_sentence and self.SENTENCE_TIMEOUT is not None:
+            budgets.append(self.SENTENCE_TIMEOUT)
+        if self.deadline is not None:
+            budgets.append(self.deadline - time.monotonic())
+        return min(budgets, default=None)
+
+    def _on_timeout(self):
+        if self.repl:
+            self.repl.kill()
+
+    @contextmanager
+    def time_limit(self, timeout: Optional[float]):
+        """Kill the prover if the enclosed block runs for more than `timeout` seconds.
+
+        Errors caused by the prover being killed (such as reading an empty
+        response) are reported as ``ProverTimeout``; the driver must then be
+        ``reset`` before it can be used again.
+        """
+        MSG = "Prover did not respond within {:.3g} seconds."
+        if timeout is None:
+            yield
+            return
+        if timeout <= 0:
+            raise ProverTimeout(MSG.format(0))
+        if self.watchdog is None:
+            self.watchdog = Watchdog(self._on_timeout)
+        self.watchdog.arm(timeout)
+        try:
+            yield
+        except Exception:
+            if not self.watchdog.disarm():
+                raise
+            raise ProverTimeout(MSG.format(timeout)) from None
+        if self.watchdog.disarm():
+            raise ProverTimeout(MSG.format(timeout))
+
     def _read(self):
         response = self.repl.stdout.readline()
         debug(response, '<< ')
+        self._record("read", response)
         return response
 
     def _write(self, s, end):
         debug(s, '>> ')
+        self._record("write", s + end)
         self.repl.stdin.write(s + end)  # type: ignore
         self.repl.stdin.flush()
 
+    @staticmethod
+    def _kill(repl):
+        repl.kill()
+        try:
+            repl.stdin.close()
+            repl.stdout.close()
+        finally:
+            repl.wait()
+
     def kill(self):
         """Terminate this prover instance."""
         if self.repl:
-            self.repl.kill()
-            try:
-                self.repl.stdin.close()
-                self.repl.stdout.close()
-            finally:
-                self.repl.wait()
+            self._kill(self.repl)
+        self.close_transcript()
+
+    def rewind(self):
+        """Return the running prover to the state it was in right after starting.
+
+        Drivers that implement this can be reused across documents (see
+        ``DriverPool``).
+        """
+        raise NotImplementedError()
+
+    def _repl_command(self, more_args=()):
+        return [self.resolve_driver(self.binpath),
+                *self.REPL_ARGS, *self.user_args, *self.instance_args, *more_args]
 
     def _start(self, stdin=PIPE, stderr=PIPE, stdout=PIPE, more_args=()):
-        cmd = [self.resolve_driver(self.binpath),
-               *self.REPL_ARGS, *self.user_args, *self.instance_args, *more_args]
+        cmd = self._repl_command(more_args)
         self._debug_start(cmd)
         # pylint: disable=consider-using-with
         return subprocess.Popen(cmd, stdin=stdin, stderr=stderr, stdout=stdout)
 
+    def _reset_document_state(self):
+        """Forget what this driver knows about the current document.
+
+        This is called when starting a prover and when reusing one from a pool.
+        """
+
     def reset(self):
         """Start or restart this prover instance."""
+        self._reset_document_state()
         self.repl = self._start(stderr=None)
 
+class DriverPool:
+    """A collection of idle prover processes, reused across documents.
+
+    When a ``REPLDriver`` is done with a document, it can ``rewind`` its prover
+    and return it to the pool instead of killing it; the next driver with the
+    same class, binary, and arguments then picks it up instead of starting a
+    new process.
+    """
+    def __init__(self):
+        self.idle: DefaultDict[Any, List[Any]] = defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exn):
+        self.close()
+        return False
+
+    @staticmethod
+    def _key(driver: REPLDriver):
+        return (type(driver), driver.binpath,
+                tuple(driver.user_args), tuple(driver.instance_args))
+
+    def acquire(self, driver: REPLDriver) -> bool:
+        """Give `driver` an idle process, if one is available."""
+        idle = self.idle[self._key(driver)]
+        while idle:
+            repl = idle.pop()
+            if repl.poll() is None:
+                driver.repl = repl
+                return True
+        return False
+
+    def release(self, driver: REPLDriver) -> bool:
+        """Take `driver`'s process back, if it can be rewound."""
+        if driver.repl is None or driver.repl.poll() is not None:
+            return False
+        try:
+            driver.rewind()
+        except (NotImplementedError, ValueError):
+            return False
+        self.idle[self._key(driver)].append(driver.repl)
+        driver.repl = None
+        return True
+
+    def close(self):
+        """Terminate all idle processes."""
+        for repls in self.idle.values():
+            for repl in repls:
+                REPLDriver._kill(repl)
+        self.idle.clear()
+
 class TextREPLDriver(REPLDriver): # pylint: disable=abstract-method
     REPL_ENCODING = "utf-8"
 
@@ -706,13 +1055,18 @@ DRIVERS_BY_LANGUAGE = {
     "coq": {
         "sertop": (".serapi", "SerAPI"),
         "sertop_noexec": (".serapi", "SerAPI_noexec"),
+        "sertop_async": (".asyncrepl", "AsyncSerAPI"),
         "coqc_time": (".coqc_time", "CoqcTime"),
+        "replay": (".replay", "CoqReplay"),
     },
     "lean3": {
-        "lean3_repl": (".lean3", "Lean3")
+        "lean3_repl": (".lean3", "Lean3"),
+        "lean3_async": (".asyncrepl", "AsyncLean3"),
+        "replay": (".replay", "Lean3Replay"),
     },
     "lean4": {
-        "leanInk": (".lean4", "Lean4")
+        "leanInk": (".lean4", "Lean4"),
+        "replay": (".replay", "Lean4Replay"),
     },
 }
 
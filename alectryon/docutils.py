@@ -130,6 +130,10 @@ CACHE_COMPRESSION = None
 """Which compression to use for cache files.
 See the documentation of --cache-compression."""
 
+CACHE_BACKEND = "files"
+"""Where to store caches ("files" or "sqlite").
+See the documentation of --cache-backend."""
+
 HTML_MINIFICATION = False
 """Whether to minify generated HTML files."""
 
@@ -402,7 +406,8 @@ class AlectryonTransform(OneTimeTransform):
         from .json import CacheSet
         state = alectryon_state(self.document)
         all_pending = self.document.traverse(alectryon_pending)
-        with CacheSet(CACHE_DIRECTORY, self.document['source'], CACHE_COMPRESSION) as caches:
+        with CacheSet(CACHE_DIRECTORY, self.document['source'], CACHE_COMPRESSION,
+                      CACHE_BACKEND) as caches:
             for lang, pending_nodes in by_lang(all_pending).items():
                 driver_info, annotated = self.annotate(pending_nodes, lang, caches[lang])
                 state.drivers_info.append(driver_info)
@@ -1433,6 +1438,29 @@ class LintingWriter(docutils.writers.UnfilteredWriter):
     def translate(self):
         self.output = self.document["js_observer"].stream.getvalue()
 
+# Annotation only
+# ===============
+
+class AnnotatingTransformer(EarlyTransformer):
+    """A transformer that stops once drivers have run (see ``AlectryonTransform``)."""
+    PRIORITY_THRESHOLD = "801-000"
+
+    def add_pending(self, pending, priority=None):
+        # Skip transforms added by earlier transforms, too
+        priority = pending.transform.default_priority if priority is None else priority
+        if self.get_priority_string(priority) < self.PRIORITY_THRESHOLD:
+            super().add_pending(pending, priority)
+
+class AnnotatingReader(StandaloneReader):
+    def new_document(self):
+        doc = super().new_document()
+        doc.transformer = AnnotatingTransformer(doc)
+        return doc
+
+class NullWriter(docutils.writers.UnfilteredWriter):
+    def translate(self):
+        self.output = ""
+
 # API
 # ===
 
@@ -1459,6 +1487,9 @@ BACKENDS = {
     'lint': {
         None: (DummyTranslator, LintingWriter),
     },
+    'null': {
+        None: (DummyTranslator, NullWriter),
+    },
     'pseudoxml': {
         None: (DummyTranslator, ("docutils.writers.pseudoxml", "Writer")),
     }
@@ -1468,6 +1499,8 @@ def _maybe_import(tp):
     return getattr(import_module(tp[0]), tp[1]) if isinstance(tp, tuple) else tp
 
 def get_reader(_frontend, backend):
+    if backend == 'null':
+        return AnnotatingReader
     return LintingReader if backend == 'lint' else StandaloneReader
 
 def get_parser(frontend):
@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from bisect import bisect_right
 from functools import wraps
 from os import path
 import pickle
@@ -93,6 +94,13 @@ def deduplicate(selector):
     return _deduplicate
 
 class HtmlGenerator(Backend):
+    # Whether to color sentences by how long the prover spent on them (when
+    # timings were recorded, see ``core.Timing``).  Sentences get a class
+    # ``alectryon-heat-N``, where N counts the thresholds (in seconds) in
+    # ``HEATMAP_THRESHOLDS`` that their total time reaches.
+    TIMING_HEATMAP = False
+    HEATMAP_THRESHOLDS = (0.001, 0.01, 0.1, 1, 10)
+
     def __init__(self, highlighter, gensym_stem="", minify=False):
         super().__init__(highlighter)
         self.gensym = None if minify else Gensym(gensym_stem + "-" if gensym_stem else "")
@@ -225,10 +233,19 @@ class HtmlGenerator(Backend):
         for wsp in wsps:
             tags.span(wsp, cls="alectryon-wsp")
 
+    @classmethod
+    def heat_class(cls, timing):
+        total = sum(t for t in timing if t is not None)
+        return "alectryon-heat-{}".format(bisect_right(cls.HEATMAP_THRESHOLDS, total))
+
     def gen_sentence(self, s):
         if s.input is not None:
             self.gen_whitespace(s.prefixes)
-        with tags.span(cls="alectryon-sentence"):
+        cls = "alectryon-sentence"
+        timing = s.props.get("timing")
+        if self.TIMING_HEATMAP and timing is not None:
+            cls += " " + self.heat_class(timing)
+        with tags.span(cls=cls):
             toggle = s.outputs and self.gen_checkbox(s.annots.unfold, "alectryon-toggle")
             if s.input is not None:
                 self.gen_input(s, toggle)
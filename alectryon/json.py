@@ -18,11 +18,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, List, Optional, Sequence, Tuple
 
+import hashlib
 import json
+import mmap
+import os
 import pickle
 import re
+import sqlite3
+import struct
+import time
+from collections import Counter
+from contextlib import contextmanager
 from copy import deepcopy
 from functools import wraps
 from importlib import import_module
@@ -30,6 +38,11 @@ from os import path, makedirs, unlink, fspath
 
 from . import core
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None # type: ignore
+
 COMMENTS_RE = re.compile(r"^\s*//.*$", re.MULTILINE)
 def uncomment(s):
     return COMMENTS_RE.sub("", s)
@@ -38,12 +51,114 @@ def loads(s, **kwargs):
     """Load a JSON document from string `s`, ignoring // comments."""
     return json.loads(uncomment(s), **kwargs)
 
+class _JSONStreamReader:
+    BLOCK_SIZE = 1 << 16
+    WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, stream):
+        self.stream, self.buf, self.pos, self.eof = stream, "", 0, False
+        self.decoder = json.JSONDecoder()
+
+    def _error(self, msg):
+        return json.JSONDecodeError(msg, self.buf, self.pos)
+
+    def _fill(self, size):
+        data = self.stream.read(size)
+        self.buf, self.pos, self.eof = self.buf[self.pos:] + data, 0, not data
+
+    def peek(self):
+        while True:
+            self.pos = self.WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill(self.BLOCK_SIZE)
+
+    def _decode(self):
+        self.peek()
+        size = self.BLOCK_SIZE
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may be cut short ("1." or "1e+")
+                truncated = isinstance(value, (int, float)) and len(self.buf) - end <= 2
+                if self.eof or not truncated:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2
+
+    def read(self, depth):
+        opening = self.peek()
+        if depth <= 0 or opening not in ("{", "["):
+            return self._decode()
+        self.pos += 1
+        closing, container = ("}", {}) if opening == "{" else ("]", [])
+        if self.peek() == closing:
+            self.pos += 1
+            return container
+        while True:
+            if opening == "{":
+                key = self._decode() if self.peek() == '"' else None
+                if not isinstance(key, str):
+                    raise self._error("Expecting property name enclosed in double quotes")
+                if self.peek() != ":":
+                    raise self._error("Expecting ':' delimiter")
+                self.pos += 1
+                container[key] = self.read(depth - 1) # type: ignore
+            else:
+                container.append(self.read(depth - 1)) # type: ignore
+            delimiter = self.peek()
+            if delimiter == closing:
+                self.pos += 1
+                return container
+            if delimiter != ",":
+                raise self._error("Expecting ',' delimiter")
+            self.pos += 1
+
+def load_stream(stream, depth=3):
+    """Load a JSON document from text stream `stream`, one value at a time.
+
+    Containers nested less than `depth` levels deep are parsed piecewise, and
+    deeper values are decoded one by one as they are read, so the document is
+    never held in memory as a single string.  Comments are not allowed.
+    """
+    reader = _JSONStreamReader(stream)
+    js = reader.read(depth)
+    if reader.peek():
+        raise reader._error("Extra data")
+    return js
+
+def dump_stream(obj, stream, depth=3):
+    """Write `obj` to text stream `stream` as compact JSON, one value at a time.
+
+    Containers nested less than `depth` levels deep are written piecewise, with
+    one element per line; deeper values are encoded in one go.
+    """
+    if depth > 0 and isinstance(obj, dict):
+        items, opening, closing = obj.items(), "{", "}"
+    elif depth > 0 and isinstance(obj, Sequence) and not isinstance(obj, str):
+        items, opening, closing = ((None, v) for v in obj), "[", "]"
+    else:
+        stream.write(json.dumps(obj, separators=(",", ":")))
+        return
+    stream.write(opening)
+    for idx, (key, value) in enumerate(items):
+        stream.write(",\n" if idx else "\n")
+        if key is not None:
+            stream.write(json.dumps(key) + ":")
+        dump_stream(value, stream, depth - 1)
+    stream.write(closing)
+
 TYPE_OF_ALIASES = {
     "text": core.Text,
     "hypothesis": core.Hypothesis,
     "goal": core.Goal,
     "message": core.Message,
     "sentence": core.Sentence,
+    "timing": core.Timing,
     "goals": core.Goals,
     "messages": core.Messages,
     "token": core.FragmentToken,
@@ -58,6 +173,22 @@ ALIASES_OF_TYPE = {
 
 TYPES = tuple(TYPE_OF_ALIASES.values())
 
+# Fields that are left out of the encoding when unset, so that documents that
+# do not use them are encoded as before.
+OPTIONAL_FIELDS = frozenset(("timing",))
+
+def _field_values(obj):
+    """List the values of `obj`'s fields, minus unset trailing ``OPTIONAL_FIELDS``.
+
+    >>> from .core import Sentence as S
+    >>> _field_values(S("s", [], [])), _field_values(S("s", [], [], 1))
+    (['s', [], []], ['s', [], [], 1])
+    """
+    values = list(obj)
+    while values and values[-1] is None and obj._fields[len(values) - 1] in OPTIONAL_FIELDS:
+        values.pop()
+    return values
+
 class PlainSerializer:
     """Convert arrays and dictionaries of namedtuples to and from JSON.
 
@@ -82,10 +213,10 @@ class PlainSerializer:
         type_name = ALIASES_OF_TYPE.get(type(obj).__name__)
         if type_name:
             d: Dict[str, Any] = {"_type": type_name} # Put _type first
-            for k, v in zip(obj._fields, obj):
+            for k, v in zip(obj._fields, _field_values(obj)):
                 d[k] = PlainSerializer.encode(v)
             return d
-        assert obj is None or isinstance(obj, (int, str))
+        assert obj is None or isinstance(obj, (int, float, str))
         return obj
 
     @staticmethod
@@ -130,10 +261,10 @@ class DeduplicatingSerializer:
                 key = pickle.dumps(obj)
                 if key in obj_table:
                     return {"*": obj_table[key]}
-                d = {"&": type_name, "_": [encode(v) for v in obj]}
+                d = {"&": type_name, "_": [encode(v) for v in _field_values(obj)]}
                 obj_table[key] = len(obj_table)
                 return d
-            assert obj is None or isinstance(obj, (int, str))
+            assert obj is None or isinstance(obj, (int, float, str))
             return obj
         return encode(obj)
 
@@ -186,8 +317,8 @@ class FullyDeduplicatingSerializer:
                 return {k: encode(v) for k, v in sorted(obj.items())}
             type_name = ALIASES_OF_TYPE.get(type(obj).__name__)
             if type_name:
-                return {"&": type_name, "_": [encode(v) for v in obj]}
-            assert obj is None or isinstance(obj, (int, str))
+                return {"&": type_name, "_": [encode(v) for v in _field_values(obj)]}
+            assert obj is None or isinstance(obj, (int, float, str))
             return obj
         return encode(obj)
 
@@ -226,6 +357,59 @@ def deprecated(fn, old_name):
 json_of_annotated = deprecated(PlainSerializer.encode, "json_of_annotated")
 annotated_of_json = deprecated(PlainSerializer.decode, "annotated_of_json")
 
+class CacheStats:
+    """Counters describing cache activity, aggregated over a run.
+
+    Misses are classified by reason: ``missing`` (no cache entry), ``version``
+    (entry written by an incompatible version of Alectryon), ``metadata``
+    (different prover arguments), or ``chunks`` (different code).  Misses
+    that still reuse part of a cache are additionally counted in ``reuses``.
+    ``time_saved`` is estimated from the annotation times recorded in caches.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses: Counter = Counter()
+        self.reuses: Counter = Counter()
+        self.upgrades = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.decode_time = 0.0
+        self.encode_time = 0.0
+        self.time_saved = 0.0
+
+    @contextmanager
+    def timed(self, field):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, field, getattr(self, field) + time.perf_counter() - start)
+
+    def merge(self, other: "CacheStats"):
+        for field, value in vars(other).items():
+            setattr(self, field, getattr(self, field) + value)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {k: dict(v) if isinstance(v, Counter) else v for k, v in vars(self).items()}
+
+    @staticmethod
+    def _format_counter(counter):
+        return " ({})".format(", ".join("{}: {}".format(k, v) for k, v in sorted(counter.items()))) \
+            if counter else ""
+
+    def format_summary(self) -> str:
+        return "\n".join((
+            "Cache: {} hits, {} misses{}, {} partial reuses{}, {} upgrades".format(
+                self.hits, sum(self.misses.values()), self._format_counter(self.misses),
+                sum(self.reuses.values()), self._format_counter(self.reuses), self.upgrades),
+            "Cache: read {:.1f} KiB (decoding: {:.3f}s), wrote {:.1f} KiB (encoding: {:.3f}s), "
+            "saved about {:.3f}s of prover time".format(
+                self.bytes_read / 1024, self.decode_time,
+                self.bytes_written / 1024, self.encode_time, self.time_saved)))
+
+STATS = CacheStats()
+"""Cache activity in this process (see ``CacheStats``)."""
+
 def validate_metadata(metadata, reference, cache_file):
     if metadata != reference:
         MSG = "Outdated metadata in {} ({} != {})"
@@ -240,11 +424,240 @@ def validate_data(data, reference, cache_file):
         return False
     return True
 
+def digest_chunks(chunks: Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for chunk in chunks:
+        bs = chunk.encode("utf-8")
+        h.update(b"%d:%b" % (len(bs), bs))
+    return h.hexdigest()
+
+def digest_metadata(metadata) -> str:
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True).encode("utf-8")).hexdigest()
+
+@contextmanager
+def file_lock(fpath):
+    """Hold an exclusive advisory lock on `fpath` (where supported).
+
+    `fpath` is created to be locked and deleted before the lock is released,
+    so lock files do not outlive the processes that hold them.
+    """
+    if fcntl is None:
+        yield
+        return
+    while True:
+        fd = os.open(fpath, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous holder may have deleted `fpath` while we waited
+            if path.samestat(os.fstat(fd), os.stat(fpath)):
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield
+    finally:
+        unlink(fpath)
+        os.close(fd)
+
+class Sections(Sequence):
+    """A list of JSON values stored in sections of a buffer, decoded on demand."""
+    def __init__(self, buf, spans):
+        self.buf, self.spans = buf, spans
+
+    def __len__(self):
+        return len(self.spans)
+
+    def raw(self, idx) -> bytes:
+        offset, size = self.spans[idx]
+        return self.buf[offset:offset + size]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return json.loads(self.raw(idx))
+
+class BinaryCacheFormat:
+    r"""A cache file format that can be memory-mapped and decoded lazily.
+
+    A file starts with a header (``MAGIC``, then the offset and length of the
+    index), followed by sections.  Each section holds the compact JSON encoding
+    of one chunk, or of the annotations of one chunk.  The index (also JSON)
+    holds each language's driver, metadata, and digests, and, for ``chunks``
+    and ``annotated``, the offsets and lengths of the corresponding sections;
+    they are read as ``Sections`` objects, so only the parts of a cache that
+    are actually used are decoded.
+    """
+    MAGIC = b"ALECTRYON-CACHE\n"
+    HEADER = struct.Struct("<16sQQ")
+    SECTIONS = ("chunks", "annotated")
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    @classmethod
+    def _write_sections(cls, out, values):
+        spans = []
+        for idx, value in enumerate(values):
+            bs = values.raw(idx) if isinstance(values, Sections) else cls._encode(value)
+            spans.append([out.tell(), len(bs)])
+            out.write(bs)
+        return spans
+
+    @classmethod
+    def write(cls, out, js):
+        """Write `js`, the contents of a cache file, to binary stream `out`."""
+        out.write(cls.HEADER.pack(cls.MAGIC, 0, 0))
+        index: Dict[str, Any] = {}
+        for key, data in js.items():
+            if isinstance(data, dict) and all(k in data for k in cls.SECTIONS):
+                data = {k: (cls._write_sections(out, v) if k in cls.SECTIONS else v)
+                        for k, v in data.items()}
+            index[key] = data
+        encoded, offset = cls._encode(index), out.tell()
+        out.write(encoded)
+        out.seek(0)
+        out.write(cls.HEADER.pack(cls.MAGIC, offset, len(encoded)))
+
+    @classmethod
+    def read(cls, fpath):
+        """Map `fpath` into memory and read its index.
+
+        Return the cache's contents (with ``Sections`` objects in place of
+        sections) and the ``mmap`` object, which the caller must close.
+        """
+        with open(fpath, mode="rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, size = cls.HEADER.unpack_from(buf)
+        if magic != cls.MAGIC:
+            buf.close()
+            raise ValueError("Unrecognized cache file: {}".format(fpath))
+        js = json.loads(buf[offset:offset + size])
+        for data in js.values():
+            if isinstance(data, dict) and all(k in data for k in cls.SECTIONS):
+                for k in cls.SECTIONS:
+                    data[k] = Sections(buf, data[k])
+        return js, buf
+
+class SharedStore:
+    """A content-addressed store of annotations, shared by all documents in a
+    cache directory.
+
+    The annotations of a chunk depend on the chunks that precede it, so each
+    chunk is stored under a hash of its language, driver metadata, and all
+    chunks up to and including it (see ``keys``).  Documents that start with
+    the same chunks (a shared preamble, a copied example, a translated page)
+    thus share entries.  Each document records the keys that it uses in
+    ``refs/``, and ``collect_garbage`` deletes entries that no document uses.
+    """
+    DIRNAME = ".shared"
+
+    def __init__(self, cache_root: str):
+        self.cache_root = cache_root
+        self.root = path.join(cache_root, self.DIRNAME)
+
+    @staticmethod
+    def keys(lang, metadata, chunks: Iterable[str]) -> List[str]:
+        """Compute the key of each chunk in `chunks`."""
+        header = [FileCacheSet.CACHE_VERSION, lang, metadata]
+        h = hashlib.sha256(json.dumps(header, sort_keys=True).encode("utf-8"))
+        keys = []
+        for chunk in chunks:
+            bs = chunk.encode("utf-8")
+            h.update(b"%d:%b" % (len(bs), bs))
+            keys.append(h.copy().hexdigest())
+        return keys
+
+    def _entry_path(self, key):
+        return path.join(self.root, "objects", key[:2], key[2:] + ".json")
+
+    def _refs_path(self, cache_rel_file):
+        name = hashlib.sha256(cache_rel_file.encode("utf-8")).hexdigest()
+        return path.join(self.root, "refs", name + ".json")
+
+    @staticmethod
+    def _load(fpath):
+        try:
+            with open(fpath, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _dump(js, fpath):
+        makedirs(path.dirname(fpath), exist_ok=True)
+        tmp = "{}.{}.tmp".format(fpath, os.getpid())
+        with open(tmp, mode="w", encoding="utf-8") as f:
+            json.dump(js, f)
+        os.replace(tmp, fpath)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._load(self._entry_path(key))
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        fpath = self._entry_path(key)
+        if not path.exists(fpath):
+            self._dump(entry, fpath)
+
+    def has_refs(self, cache_rel_file: str) -> bool:
+        return path.exists(self._refs_path(cache_rel_file))
+
+    def set_refs(self, cache_rel_file: str, keys: Dict[str, List[str]]):
+        """Record that the document cached in `cache_rel_file` uses `keys`."""
+        refs = {"document": cache_rel_file, "keys": keys}
+        fpath = self._refs_path(cache_rel_file)
+        if self._load(fpath) != refs:
+            self._dump(refs, fpath)
+
+    def _live_keys(self):
+        live = set()
+        refs_dir = path.join(self.root, "refs")
+        for name in sorted(os.listdir(refs_dir)) if path.isdir(refs_dir) else ():
+            fpath = path.join(refs_dir, name)
+            refs = self._load(fpath)
+            cache_file = path.join(self.cache_root, refs["document"])
+            if not any(path.exists(cache_file + ext)
+                       for _, ext in FileCacheSet.KNOWN_COMPRESSIONS.values()):
+                unlink(fpath) # The document's cache was deleted
+                continue
+            for keys in refs["keys"].values():
+                live.update(keys)
+        return live
+
+    def collect_garbage(self) -> int:
+        """Delete entries that no document refers to; return how many were deleted."""
+        live, deleted = self._live_keys(), 0
+        objects_dir = path.join(self.root, "objects")
+        for prefix in sorted(os.listdir(objects_dir)) if path.isdir(objects_dir) else ():
+            subdir = path.join(objects_dir, prefix)
+            for name in sorted(os.listdir(subdir)):
+                if prefix + name[:-len(".json")] not in live:
+                    unlink(path.join(subdir, name))
+                    deleted += 1
+            if not os.listdir(subdir):
+                os.rmdir(subdir)
+        return deleted
+
 class Cache:
-    def __init__(self, data, cache_file):
+    # Whether to reuse the annotations of unchanged chunks when contents change
+    INCREMENTAL = True
+
+    def __init__(self, data, cache_file, store: Optional[SharedStore] = None, lang=None):
         self.data = data
         self.cache_file = cache_file
         self.serializer = PlainSerializer
+        self.store, self.lang = store, lang
+        # Whether ``data`` has changed since it was read
+        self.dirty = False
+        # Why ``data`` is ``None`` (for ``CacheStats``)
+        self.missing_reason = "missing"
+        if data is not None and "digests" not in data: # Older caches
+            # Saved only if the cache changes, so that hits don't rewrite it
+            data["digests"] = self._digests(data.get("chunks") or [], data["metadata"])
 
     @staticmethod
     def normalize(obj: Any) -> Any:
@@ -254,37 +667,217 @@ class Cache:
             return {k: Cache.normalize(v) for (k, v) in obj.items()}
         return obj
 
-    def _validate(self, chunks, metadata):
+    @staticmethod
+    def _digests(chunks, metadata):
+        return {"metadata": digest_metadata(metadata), "chunks": digest_chunks(chunks)}
+
+    def _staleness(self, chunks, metadata) -> Optional[str]:
+        """Return ``None`` if this cache is valid for `chunks`, or why it is not."""
         # Note that we validate "metadata" but not "driver".  This is to prevent
         # Coq upgrades from invalidating caches.  It's easy to force invalidation
         # by hand (delete the caches), whereas automatic invalidation on Coq
         # upgrades would make it a pain to keep a collection of examples (say, a
         # blog) with dependencies on different libraries and Coq versions.
-        return (self.data is not None
-           and validate_metadata(self.data["metadata"], metadata, self.cache_file)
-           and validate_data(self.data.get("chunks"), chunks, self.cache_file))
+        # Digests are compared first; full values are only compared (and
+        # reported) when digests differ.
+        if self.data is None:
+            return self.missing_reason
+        digests = self.data["digests"]
+        if not (digests["metadata"] == digest_metadata(metadata)
+                or validate_metadata(self.data["metadata"], metadata, self.cache_file)):
+            return "metadata"
+        if not (digests["chunks"] == digest_chunks(chunks)
+                or validate_data(list(self.data.get("chunks") or ()),
+                                 chunks, self.cache_file)):
+            return "chunks"
+        return None
+
+    def _validate(self, chunks, metadata):
+        return self._staleness(chunks, metadata) is None
+
+    def _decode(self, annotated):
+        with STATS.timed("decode_time"):
+            return self.serializer.decode(list(annotated))
+
+    def lookup(self, chunks, metadata) -> Tuple[Optional[List[Any]], Optional[str]]:
+        """Like ``get``, but also return why the cache is stale (see ``_staleness``)."""
+        staleness = self._staleness(self.normalize(chunks), self.normalize(metadata))
+        if staleness is not None:
+            return None, staleness
+        return self._decode(self.data["annotated"]), None
 
     def get(self, chunks, metadata):
-        if not self._validate(self.normalize(chunks), self.normalize(metadata)):
-            return None
-        return self.serializer.decode(self.data.get("annotated"))
+        return self.lookup(chunks, metadata)[0]
 
     @property
     def driver_info(self):
         return core.DriverInfo(*self.data.get("driver", ("Coq+SerAPI", "??")))
 
-    def put(self, chunks, metadata, annotated, driver):
+    def put(self, chunks, metadata, annotated, driver, elapsed=None):
+        with STATS.timed("encode_time"):
+            encoded = self.serializer.encode(annotated)
+        self._put(chunks, metadata, encoded, driver, elapsed)
+
+    def _put(self, chunks, metadata, encoded, driver, elapsed=None):
+        """Record `encoded` annotations for `chunks`.
+
+        `elapsed` is the time that the driver took to annotate `chunks`, if known.
+        """
+        chunks, metadata = list(chunks), self.normalize(metadata)
         self.data = {"driver": self.normalize(driver),
-                     "metadata": self.normalize(metadata),
-                     "chunks": list(chunks),
-                     "annotated": self.serializer.encode(annotated)}
+                     "metadata": metadata,
+                     "digests": self._digests(chunks, metadata),
+                     "chunks": chunks,
+                     "annotated": encoded,
+                     **({"elapsed": round(elapsed, 6)} if elapsed is not None else {})}
+        self.dirty = True
 
-    def update(self, chunks, driver):
-        annotated = self.get(chunks, driver.metadata)
+    @staticmethod
+    def _split_chunk(chunk, offset):
+        if isinstance(chunk, core.PosStr):
+            return chunk.split_at(offset)
+        return chunk[:offset], chunk[offset:]
+
+    def _reusable_prefix(self, chunks):
+        """Find the part of the cached annotations that `chunks` leave unchanged.
+
+        Return ``(n, fragments, offset)``: the first ``n`` chunks are unchanged,
+        and so are the first ``offset`` characters of chunk ``n``, whose
+        annotations are ``fragments``.  Sentences in the edited chunk are only
+        kept if followed by an unchanged ``Text`` fragment: without it, an edit
+        could extend the sentence.
+        """
+        old_chunks = self.data["chunks"]
+        old_annotated = self.data["annotated"]
+        n = 0
+        while n < min(len(chunks), len(old_chunks)) and chunks[n] == old_chunks[n]:
+            n += 1
+        kept, offset = 0, 0
+        if n < min(len(chunks), len(old_chunks)):
+            common = len(path.commonprefix([chunks[n], old_chunks[n]]))
+            end = 0
+            for idx, fr in enumerate(self.serializer.decode(old_annotated[n])):
+                end += len(str(fr.contents))
+                if end > common:
+                    break
+                if isinstance(fr, core.Text):
+                    kept, offset = idx + 1, end
+        fragments = self.serializer.decode(old_annotated[n][:kept]) if kept else []
+        return n, fragments, offset
+
+    def _update_incrementally(self, chunks, driver):
+        """Annotate `chunks`, reusing cached annotations for an unchanged prefix."""
+        if not (self.INCREMENTAL and self.data is not None
+                and self.data["metadata"] == self.normalize(driver.metadata)):
+            return None
+        n, fragments, offset = self._reusable_prefix(self.normalize(chunks))
+        if n == 0 and offset == 0:
+            return None
+        prefix = self.serializer.decode(self.data["annotated"][:n])
+        if n == len(chunks):
+            return prefix
+        chunks = list(chunks)
+        if offset:
+            chunks[n:n+1] = self._split_chunk(chunks[n], offset)
+        annotated = self._annotate_suffix(chunks, n + (1 if offset else 0), driver)
         if annotated is None:
-            annotated = driver.annotate(chunks)
-            self.put(chunks, driver.metadata, annotated, driver.version_info())
-        return annotated
+            return None
+        if offset:
+            annotated[0] = fragments + annotated[0]
+        return prefix + annotated
+
+    @staticmethod
+    def _annotate_suffix(chunks, start, driver):
+        try:
+            with core.profiled("driver", type(driver).__name__ + ".annotate_suffix",
+                               chunks=len(chunks) - start):
+                return driver.annotate_suffix(chunks, start)
+        except NotImplementedError:
+            return None
+
+    def _shared_prefix(self, chunks, metadata):
+        """Look up the longest prefix of `chunks` with entries in the shared store.
+
+        Return a list of entries, one per chunk of the prefix.
+        """
+        entries: List[Dict[str, Any]] = []
+        if self.store is not None:
+            for key in self.store.keys(self.lang, metadata, chunks):
+                entry = self.store.get(key)
+                if entry is None:
+                    break
+                entries.append(entry)
+        return entries
+
+    def _update_from_store(self, chunks, driver, entries):
+        """Annotate `chunks`, reusing shared annotations (`entries`) for a prefix."""
+        if not entries:
+            return None
+        prefix = [self.serializer.decode(e["annotated"]) for e in entries]
+        if len(entries) == len(chunks):
+            self._put(chunks, driver.metadata, [e["annotated"] for e in entries],
+                      entries[0]["driver"])
+            return prefix
+        annotated = self._annotate_suffix(list(chunks), len(entries), driver)
+        if annotated is None:
+            return None
+        self.put(chunks, driver.metadata, prefix + annotated, driver.version_info())
+        return prefix + annotated
+
+    def update(self, chunks, driver):
+        return list(self.update_iter(chunks, driver))
+
+    def update_iter(self, chunks, driver):
+        """Like ``update``, but yield annotations chunk by chunk.
+
+        Chunks that are not cached are annotated with ``driver.annotate_iter``,
+        and the cache is updated once the last chunk has been yielded.
+        """
+        annotated, staleness = self.lookup(chunks, driver.metadata)
+        if annotated is not None:
+            STATS.hits += 1
+            STATS.time_saved += self.data.get("elapsed", 0)
+            yield from annotated
+            return
+        STATS.misses[staleness] += 1
+        shared = self._shared_prefix(self.normalize(chunks), self.normalize(driver.metadata))
+        if shared and len(shared) == len(chunks):
+            STATS.reuses["shared"] += 1
+            yield from self._update_from_store(chunks, driver, shared)
+            return
+        # Partial updates keep the previous (approximate) annotation time
+        elapsed = self.data.get("elapsed") if self.data else None
+        annotated = self._update_incrementally(chunks, driver)
+        if annotated is not None:
+            STATS.reuses["incremental"] += 1
+            self.put(chunks, driver.metadata, annotated, driver.version_info(), elapsed)
+            yield from annotated
+            return
+        annotated = self._update_from_store(chunks, driver, shared)
+        if annotated is not None:
+            STATS.reuses["shared"] += 1
+            yield from annotated
+            return
+        encoded, elapsed = [], 0.0
+        with core.profiled("driver", type(driver).__name__ + ".annotate",
+                           chunks=len(chunks)):
+            fragments_iter = iter(driver.annotate_iter(chunks))
+            while True:
+                start = time.perf_counter()
+                fragments = next(fragments_iter, None)
+                elapsed += time.perf_counter() - start
+                if fragments is None:
+                    break
+                # Encode before yielding, since callers may modify `fragments`
+                with STATS.timed("encode_time"):
+                    encoded.append(self.serializer.encode(fragments))
+                yield fragments
+        self._put(chunks, driver.metadata, encoded, driver.version_info(), elapsed)
+
+def _relative_document_path(cache_root, doc_path):
+    doc_path = path.realpath(fspath(doc_path))
+    doc_root = path.commonpath((cache_root, doc_path))
+    return path.relpath(doc_path, doc_root)
 
 class BaseCacheSet:
     def __enter__(self):
@@ -310,13 +903,22 @@ class TrivialCacheSet(BaseCacheSet):
 class FileCacheSet(BaseCacheSet):
     CACHE_VERSION = "2"
 
+    # Whether to also store annotations in a ``SharedStore``, and look them up
+    # there when a document's own cache is missing or outdated.
+    SHARED_STORE = False
+
     LANG_PREFIX = "&"
     METADATA = {"cache_version": CACHE_VERSION}
 
+    # Indentation of JSON cache files; by default they are written compactly,
+    # with one chunk per line.
+    INDENT: Optional[int] = None
+
     KNOWN_COMPRESSIONS = {
         "none": ("builtins", ""),
         "gzip": ("gzip", ".gz"),
         "xz": ("lzma", ".xz"),
+        "binary": (None, ".bin"), # See ``BinaryCacheFormat``
     }
 
     def __init__(self, cache_root: str, doc_path: str, cache_compression):
@@ -325,23 +927,33 @@ class FileCacheSet(BaseCacheSet):
         if self.wanted_compression not in self.KNOWN_COMPRESSIONS:
             raise ValueError("Unsupported cache compression: {}".format(cache_compression))
 
-        doc_path = path.realpath(fspath(doc_path))
-        doc_root = path.commonpath((self.cache_root, doc_path))
-        self.cache_rel_file = path.relpath(doc_path, doc_root) + ".cache"
+        self.cache_rel_file = _relative_document_path(self.cache_root, doc_path) + ".cache"
         self.cache_file = path.join(cache_root, self.cache_rel_file)
         self.cache_dir = path.dirname(self.cache_file)
         makedirs(self.cache_dir, exist_ok=True)
+        self.store = SharedStore(self.cache_root) if self.SHARED_STORE else None
 
+        self.buffers: List[mmap.mmap] = [] # Back binary caches
+        self.stamp = self._stamp()
         self.ondisk_compression, self.js = self._read()
-        self.caches = self._read_caches() if self._validate() else {}
+        self.caches = self._read_caches(self.js) if self._validate(self.js) else {}
+        self.outdated = self.js is not None and not self.caches
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_exn):
-        self._write()
+        try:
+            self._write()
+        finally:
+            self._close()
         return False
 
+    def _close(self):
+        for buf in self.buffers:
+            buf.close()
+        self.buffers.clear()
+
     @classmethod
     def _upgrade(cls, contents):
         """Upgrade old cache contents to the latest cache version.
@@ -353,6 +965,7 @@ class FileCacheSet(BaseCacheSet):
         metadata = contents.get("metadata", {})
         version = metadata.get("cache_version")
         if version == "1":
+            STATS.upgrades += 1
             metadata.pop("cache_version", None)
             return {"metadata": cls.METADATA,
                     **{cls.LANG_PREFIX + "coq":
@@ -361,32 +974,58 @@ class FileCacheSet(BaseCacheSet):
                         **contents}}}
         return contents
 
-    def _read_caches(self):
-        assert self.js is not None
-        return {key[len(self.LANG_PREFIX):]: Cache(data, self.cache_rel_file)
-                for key, data in sorted(self.js.items())
-                if key.startswith(self.LANG_PREFIX)}
+    def _read_caches(self, js):
+        langs = (key[len(self.LANG_PREFIX):] for key in sorted(js)
+                 if key.startswith(self.LANG_PREFIX))
+        return {lang: Cache(js[self.LANG_PREFIX + lang], self.cache_rel_file,
+                            self.store, lang)
+                for lang in langs}
 
-    def _open(self, compression, mode):
+    def _open(self, compression, mode, fpath=None):
         mod, ext = self.KNOWN_COMPRESSIONS[compression]
-        return import_module(mod).open(self.cache_file + ext, mode=mode) # type: ignore
+        fpath = fpath or self.cache_file + ext
+        return import_module(mod).open(fpath, mode=mode) # type: ignore
+
+    def _read_binary(self):
+        js, buf = BinaryCacheFormat.read(self.cache_file + self.KNOWN_COMPRESSIONS["binary"][1])
+        self.buffers.append(buf)
+        return js
 
     def _read(self):
-        for compression in self.KNOWN_COMPRESSIONS:
+        for compression, (_mod, ext) in self.KNOWN_COMPRESSIONS.items():
             try:
-                with self._open(compression, mode="rt") as cache:
-                    return compression, self._upgrade(loads(cache.read()))
+                size = path.getsize(self.cache_file + ext)
+                with STATS.timed("decode_time"):
+                    if compression == "binary":
+                        js = self._read_binary()
+                    else:
+                        with self._open(compression, mode="rt") as cache:
+                            js = load_stream(cache)
+                STATS.bytes_read += size
+                return compression, self._upgrade(js)
             except FileNotFoundError:
                 pass
         return None, None
 
-    def _validate(self):
-        return self.js and validate_metadata(self.js["metadata"], self.METADATA,
-                                           self.cache_rel_file)
+    def _stamp(self):
+        """Identify the current cache file, to detect changes made by other processes."""
+        for _mod, ext in self.KNOWN_COMPRESSIONS.values():
+            try:
+                st = os.stat(self.cache_file + ext)
+                return (ext, st.st_ino, st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def _validate(self, js):
+        return js and validate_metadata(js["metadata"], self.METADATA,
+                                        self.cache_rel_file)
 
     def __getitem__(self, lang):
         if lang not in self.caches:
-            self.caches[lang] = Cache(None, self.cache_rel_file)
+            self.caches[lang] = Cache(None, self.cache_rel_file, self.store, lang)
+            if self.outdated:
+                self.caches[lang].missing_reason = "version"
         return self.caches[lang]
 
     def _check_recompression(self):
@@ -400,25 +1039,240 @@ class FileCacheSet(BaseCacheSet):
         return needed
 
     def _delete_old_caches(self):
-        for _mod, ext in self.KNOWN_COMPRESSIONS.values():
+        for compression, (_mod, ext) in self.KNOWN_COMPRESSIONS.items():
+            if compression == self.wanted_compression:
+                continue
             try:
                 unlink(self.cache_file + ext)
             except FileNotFoundError:
                 pass
 
+    def _merge(self):
+        """Pick up languages written by other processes since this file was read.
+
+        Languages that this process changed are kept; others are replaced by
+        their latest version on disk.
+        """
+        _, js = self._read()
+        if not self._validate(js):
+            return
+        for lang, cache in self._read_caches(js).items():
+            if lang not in self.caches or not self.caches[lang].dirty:
+                self.caches[lang] = cache
+
+    def _rebind(self, js):
+        for lang, c in self.caches.items():
+            c.data = js[self.LANG_PREFIX + lang]
+
     def _force_write(self, js):
+        # Caches are written to a temporary file and atomically moved into
+        # place, so concurrent readers always see a complete file.  Binary
+        # sections are copied from the old file when possible, so the old file
+        # is only unmapped once the new one is ready.
+        fpath = self.cache_file + self.KNOWN_COMPRESSIONS[self.wanted_compression][1]
+        tmp = "{}.{}.tmp".format(fpath, os.getpid())
+        try:
+            with STATS.timed("encode_time"):
+                if self.wanted_compression == "binary":
+                    with open(tmp, mode="wb") as cache:
+                        BinaryCacheFormat.write(cache, js)
+                else:
+                    if self.buffers: # Decode all sections before unmapping them
+                        js = json.loads(json.dumps(js, default=list))
+                        self._rebind(js)
+                    with self._open(self.wanted_compression, "wt", tmp) as cache:
+                        if self.INDENT is None:
+                            dump_stream(js, cache)
+                        else:
+                            json.dump(js, cache, indent=self.INDENT)
+            STATS.bytes_written += path.getsize(tmp)
+            self._close()
+            os.replace(tmp, fpath)
+        finally:
+            if path.exists(tmp):
+                unlink(tmp)
         self._delete_old_caches()
-        with self._open(self.wanted_compression, mode="wt") as cache:
-            json.dump(js, cache, indent=2)
+        if self.wanted_compression == "binary":
+            js = self._read_binary()
+            self._rebind(js)
         self.js, self.ondisk_compression = js, self.wanted_compression
+        self.stamp = self._stamp()
+
+    def _share(self):
+        """Copy this document's annotations to the shared store, and record its keys."""
+        assert self.store
+        refs = {}
+        for lang, c in sorted(self.caches.items()):
+            if c.data is None:
+                continue
+            keys = self.store.keys(lang, c.data["metadata"], c.data["chunks"])
+            for key, encoded in zip(keys, c.data["annotated"]):
+                self.store.put(key, {"driver": c.data["driver"], "annotated": encoded})
+            refs[lang] = keys
+        self.store.set_refs(self.cache_rel_file, refs)
+
+    def _write(self):
+        # Caches track their own changes, so unchanged caches are neither
+        # compared nor rewritten
+        dirty = self.js is None or any(c.dirty for c in self.caches.values())
+        if dirty or self._check_recompression():
+            with file_lock(self.cache_file + ".lock"):
+                if self._stamp() != self.stamp:
+                    self._merge()
+                js = { "metadata": self.METADATA,
+                       **{ self.LANG_PREFIX + lang: c.data
+                           for (lang, c) in sorted(self.caches.items()) } }
+                self._force_write(js)
+        if self.store and (dirty or not self.store.has_refs(self.cache_rel_file)):
+            self._share()
+        for c in self.caches.values():
+            c.dirty = False
+
+class _SQLiteCache(Cache):
+    def __init__(self, data, cache_file, cache_set, lang):
+        super().__init__(data, cache_file, lang=lang)
+        self.cache_set = cache_set
+
+    def lookup(self, chunks, metadata):
+        annotated, staleness = super().lookup(chunks, metadata)
+        if annotated is None: # Look for another document with the same contents
+            digests = self._digests(self.normalize(chunks), self.normalize(metadata))
+            data = self.cache_set.find(self.lang, digests)
+            if data is not None:
+                self.data, self.dirty = data, True
+                annotated = super().lookup(chunks, metadata)[0]
+        return annotated, staleness
+
+class SQLiteCacheSet(BaseCacheSet):
+    """A cache set stored in a single SQLite database in the cache directory.
+
+    Each row holds the cache of one language in one document, keyed by
+    document path and language, and indexed by digests of its contents (so
+    that moved or copied documents reuse existing entries) and by last use.
+    """
+    DB_NAME = "alectryon.sqlite3"
+
+    # Maximum total size of cache entries, in bytes.  Least recently used
+    # entries are evicted when the database grows past this size.
+    MAX_SIZE: Optional[int] = None
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS caches (
+        document TEXT NOT NULL,
+        lang TEXT NOT NULL,
+        version TEXT NOT NULL,
+        chunks_digest TEXT NOT NULL,
+        metadata_digest TEXT NOT NULL,
+        compression TEXT NOT NULL,
+        data BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (document, lang)
+    );
+    CREATE INDEX IF NOT EXISTS caches_by_digests
+        ON caches (lang, chunks_digest, metadata_digest);
+    CREATE INDEX IF NOT EXISTS caches_by_last_use ON caches (last_used);
+    """
+
+    def __init__(self, cache_root: str, doc_path: str, cache_compression):
+        self.compression = cache_compression or "none"
+        if self.compression not in ("none", "gzip", "xz"):
+            MSG = "Unsupported cache compression for SQLite caches: {}"
+            raise ValueError(MSG.format(cache_compression))
+        self.cache_root = path.realpath(fspath(cache_root))
+        self.document = _relative_document_path(self.cache_root, doc_path)
+        makedirs(self.cache_root, exist_ok=True)
+        self.db = sqlite3.connect(path.join(self.cache_root, self.DB_NAME), timeout=60)
+        self.db.executescript(self.SCHEMA)
+        self.caches: Dict[str, _SQLiteCache] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exn):
+        try:
+            self._write()
+        finally:
+            self.db.close()
+        return False
+
+    @staticmethod
+    def _compressor(compression):
+        mod, _ext = FileCacheSet.KNOWN_COMPRESSIONS[compression]
+        return None if mod == "builtins" else import_module(mod)
+
+    def _decode(self, compression, blob):
+        STATS.bytes_read += len(blob)
+        with STATS.timed("decode_time"):
+            mod = self._compressor(compression)
+            return json.loads((mod.decompress(blob) if mod else blob).decode("utf-8"))
+
+    def _encode(self, data):
+        with STATS.timed("encode_time"):
+            blob = json.dumps(data, separators=(",", ":")).encode("utf-8")
+            mod = self._compressor(self.compression)
+            blob = mod.compress(blob) if mod else blob
+        STATS.bytes_written += len(blob)
+        return blob
+
+    def find(self, lang, digests) -> Optional[Dict[str, Any]]:
+        """Find a cache entry for `lang` with `digests`, in any document."""
+        row = self.db.execute(
+            "SELECT compression, data FROM caches WHERE lang = ? AND version = ?"
+            " AND chunks_digest = ? AND metadata_digest = ? LIMIT 1",
+            (lang, FileCacheSet.CACHE_VERSION, digests["chunks"], digests["metadata"])
+        ).fetchone()
+        return self._decode(*row) if row else None
+
+    def __getitem__(self, lang):
+        if lang not in self.caches:
+            row = self.db.execute(
+                "SELECT compression, data FROM caches"
+                " WHERE document = ? AND lang = ? AND version = ?",
+                (self.document, lang, FileCacheSet.CACHE_VERSION)).fetchone()
+            data = self._decode(*row) if row else None
+            self.caches[lang] = _SQLiteCache(data, self.document, self, lang)
+        return self.caches[lang]
+
+    def _evict(self):
+        total, = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM caches").fetchone()
+        if self.MAX_SIZE is None or total <= self.MAX_SIZE:
+            return
+        rows = self.db.execute(
+            "SELECT document, lang, size FROM caches WHERE document != ?"
+            " ORDER BY last_used", (self.document,)).fetchall()
+        for document, lang, size in rows:
+            if total <= self.MAX_SIZE:
+                break
+            self.db.execute("DELETE FROM caches WHERE document = ? AND lang = ?",
+                            (document, lang))
+            total -= size
 
     def _write(self):
-        js = { "metadata": self.METADATA,
-               **{ self.LANG_PREFIX + lang: c.data
-                   for (lang, c) in sorted(self.caches.items()) } }
-        if js != self.js or self._check_recompression():
-            self._force_write(js)
-
-def CacheSet(cache_root, doc_path, cache_compression) -> BaseCacheSet:
-    cls = FileCacheSet if cache_root is not None else TrivialCacheSet
+        now = time.time()
+        with self.db: # One transaction
+            for lang, c in sorted(self.caches.items()):
+                if c.data is None:
+                    continue
+                if c.dirty:
+                    blob = self._encode(c.data)
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO caches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.document, lang, FileCacheSet.CACHE_VERSION,
+                         c.data["digests"]["chunks"], c.data["digests"]["metadata"],
+                         self.compression, blob, len(blob), now))
+                    c.dirty = False
+                else:
+                    self.db.execute(
+                        "UPDATE caches SET last_used = ? WHERE document = ? AND lang = ?",
+                        (now, self.document, lang))
+            self._evict()
+
+CACHE_BACKENDS = {
+    "files": FileCacheSet,
+    "sqlite": SQLiteCacheSet,
+}
+
+def CacheSet(cache_root, doc_path, cache_compression, cache_backend="files") -> BaseCacheSet:
+    cls = CACHE_BACKENDS[cache_backend] if cache_root is not None else TrivialCacheSet
     return cls(cache_root, doc_path, cache_compression)
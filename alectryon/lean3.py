@@ -21,12 +21,13 @@
 import json
 import re
 import tempfile
+import time
 from collections import deque
 from pathlib import Path
 from typing import Any, Iterable, List, Optional, Tuple, TypedDict
 
 from .core import TextREPLDriver, Positioned, Document, Hypothesis, Goal, Message, Sentence, \
-    Text, cwd
+    Text, Timing, cwd
 from .transforms import transform_contents_to_tokens
 
 class _AstNode(TypedDict):
@@ -161,7 +162,12 @@ class Lean3(TextREPLDriver):
 
     DEBUG = False
 
-    def _collect_sentences_and_states(self) -> Iterable[Tuple[Pos, Any]]:
+    def _collect_sentences_and_states(self) -> Iterable[Tuple[Pos, Any, Optional[float]]]:
+        """Find sentences and query the proof state after each of them.
+
+        Each value is a triple: a span, a state, and the time taken to query
+        the state (``None`` if it was not queried).
+        """
         last_end: Pos = (0, 0)
         last_idx: Optional[int] = None
         last_parent: Optional[int] = None
@@ -181,15 +187,17 @@ class Lean3(TextREPLDriver):
                 print("Skip")
                 continue
             if last_span:
-                last_state = None
+                last_state, elapsed = None, None
                 if parent in (last_idx, last_parent):
+                    t_start = time.perf_counter()
                     last_state = self._get_state_at(start)
-                yield (last_span, last_state)
+                    elapsed = time.perf_counter() - t_start
+                yield (last_span, last_state, elapsed)
             last_span = (self.document.pos2offset(*start),
                          self.document.pos2offset(*end)) if start != end else None
             last_end, last_idx, last_parent = end, idx, parent
         if last_span:
-            yield (last_span, None)
+            yield (last_span, None, None)
 
     # FIXME: this does not handle hypotheses with a body
     # FIXME: this does not deal with `conv` goals
@@ -215,8 +223,13 @@ class Lean3(TextREPLDriver):
                        list(self._parse_hyps(m.group("hyps"))))
 
     def _find_sentences(self):
-        for (beg, end), st in self._collect_sentences_and_states():
-            sentence = Sentence(self.document[beg:end], [], list(self._parse_goals(st)))
+        # Lean processes the whole document at once (``sync``), so only the
+        # time spent retrieving goals can be attributed to each sentence.
+        for (beg, end), st, elapsed in self._collect_sentences_and_states():
+            timing = None
+            if self.RECORD_TIMINGS:
+                timing = Timing(None, None, elapsed and round(elapsed, 6), None)
+            sentence = Sentence(self.document[beg:end], [], list(self._parse_goals(st)), timing)
             yield Positioned(beg, end, sentence)
 
     def _resplit_fragments(self, fragments):
@@ -292,7 +305,7 @@ class Lean3(TextREPLDriver):
                 with open(fdescriptor, "w", encoding="utf-8") as tmp:
                     tmp.write(self.document.contents)
                 self.run_cli(more_args=[str(tmpname)])
-                self.ast = json.loads(tmpname.with_suffix(".ast.json").read_text("utf8"))["ast"]
+                self.ast = json.loads(self._read_output(tmpname.with_suffix(".ast.json")))["ast"]
             finally:
                 tmpname.unlink(missing_ok=True)
                 tmpname.with_suffix(".ast.json").unlink(missing_ok=True)
@@ -67,7 +67,7 @@ class Lean4(CLIDriver):
                          more_args=[input_file_path])
 
             output_file = input_file.with_suffix(self.LEAN_FILE_EXT + self.LEAN_INK_FILE_EXT)
-            content = output_file.read_text(encoding="utf-8")
+            content = self._read_output(output_file)
             json_result = json.loads(content)
             tuple_result = PlainSerializer.decode(json_result)
             return tuple_result
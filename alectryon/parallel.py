@@ -0,0 +1,151 @@
+# Copyright © 2026 Clément Pit-Claudel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Annotate independent segments of a document in parallel.
+
+Some documents are made of parts that do not depend on each other: code after
+``Reset Initial.`` in Coq, for example, starts from a clean slate.  Such parts
+can be annotated by separate prover instances, running concurrently in a pool of
+worker processes; results are then merged back in document order.
+"""
+
+from typing import Any, Callable, List, Optional, Tuple, Type
+
+from concurrent.futures import ProcessPoolExecutor
+import copy
+
+from .core import Document, Driver, Notification, Observer, PosStr
+from .literate import LANGUAGES, Comment, Parser, ParsingError
+
+class CollectingObserver(Observer):
+    """An observer that stores notifications, to replay them later."""
+    def __init__(self):
+        self.notifications: List[Notification] = []
+
+    def _notify(self, n: Notification):
+        self.notifications.append(n)
+
+def _split_chunk(chunk, offset):
+    if isinstance(chunk, PosStr):
+        return chunk.split_at(offset)
+    return chunk[:offset], chunk[offset:]
+
+def _boundaries(chunk, segment_re, parser: Optional[Type[Parser]]):
+    """Find matches of `segment_re` in `chunk` that do not start inside a comment.
+
+    A match may start a comment, such as ``(* alectryon-segment *)``.  Chunks
+    that `parser` cannot parse (with unterminated comments) are not split.
+    """
+    matches = list(segment_re.finditer(chunk))
+    if parser is None or not matches:
+        return matches
+    try:
+        parts = parser(str(chunk)).partition()
+    except ParsingError:
+        return []
+    comments = [(p.v.beg, p.v.end) for p in parts if isinstance(p, Comment)]
+    return [m for m in matches
+            if not any(beg < m.start() < end for beg, end in comments)]
+
+def _annotate_segment(driver: Driver, pieces: List[str]) \
+        -> Tuple[List[Any], List[Notification]]:
+    annotated = driver.annotate(pieces)
+    assert isinstance(driver.observer, CollectingObserver)
+    return annotated, driver.observer.notifications
+
+class SegmentedAnnotator:
+    """Split documents at ``driver.SEGMENT_RE`` and annotate segments in parallel.
+
+    `jobs` is the maximum number of worker processes (by default, the number of
+    CPUs).  Workers call `initializer` with `initargs` when they start: workers
+    started with ``spawn`` or ``forkserver`` (the default on some platforms) do
+    not inherit settings from the parent process.  Each segment is annotated
+    by a fresh copy of the driver, so the boundaries must really be
+    independence points: no segment may refer to definitions from a previous
+    one.  Boundaries inside comments are ignored.
+    """
+    def __init__(self, jobs: Optional[int] = None,
+                 initializer: Optional[Callable[..., Any]] = None,
+                 initargs: Tuple[Any, ...] = ()):
+        self.jobs = jobs or None
+        self.initializer = initializer
+        self.initargs = initargs
+
+    @staticmethod
+    def split(chunks: List[str], segment_re,
+              parser: Optional[Type[Parser]] = None) -> List[List[str]]:
+        r"""Cut `chunks` into segments, each a list of pieces of chunks.
+
+        If `parser` is set, it is used to skip boundaries inside comments.
+
+        >>> import re
+        >>> SegmentedAnnotator.split(["A.\nReset.\nB.", "C.", "Reset. D."],
+        ...                          re.compile("^Reset", re.MULTILINE))
+        [['A.\n'], ['Reset.\nB.', 'C.'], ['Reset. D.']]
+        """
+        segments: List[List[str]] = [[]]
+        for chunk in chunks:
+            consumed = 0
+            for m in _boundaries(chunk, segment_re, parser):
+                if m.start() > consumed:
+                    piece, chunk = _split_chunk(chunk, m.start() - consumed)
+                    segments[-1].append(piece)
+                    consumed = m.start()
+                if segments[-1]:
+                    segments.append([])
+            segments[-1].append(chunk)
+        return segments
+
+    def _worker_driver(self, driver: Driver) -> Driver:
+        worker = copy.copy(driver)
+        worker.observer = CollectingObserver()
+        # Workers annotate their segments sequentially, in their own process
+        worker.SEGMENTER = None # type: ignore
+        worker.POOL = None # type: ignore
+        return worker
+
+    def annotate(self, driver: Driver, chunks: List[str]) -> Optional[List[Any]]:
+        """Annotate `chunks` using copies of `driver`, one per segment.
+
+        Return ``None`` if `chunks` form a single segment, or if transcripts are
+        being recorded.
+        """
+        segment_re = getattr(driver, "SEGMENT_RE", None)
+        # Transcripts record a single prover session
+        if segment_re is None or getattr(driver, "TRANSCRIPT_DIRECTORY", None):
+            return None
+        lang = LANGUAGES.get(getattr(driver, "LANGUAGE", None))
+        segments = self.split(chunks, segment_re, lang.parser if lang else None)
+        if len(segments) <= 1:
+            return None
+        worker = self._worker_driver(driver)
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=self.initializer,
+                                 initargs=self.initargs) as ex:
+            futures = [ex.submit(_annotate_segment, worker, pieces)
+                       for pieces in segments]
+            results = [f.result() for f in futures]
+        fragments = []
+        for annotated, notifications in results:
+            for n in notifications:
+                driver.observer._notify(n)
+            for piece_fragments in annotated:
+                fragments.extend(piece_fragments)
+        return list(Document(chunks, "").recover_chunks(fragments))
@@ -0,0 +1,210 @@
+# Copyright © 2026 Clément Pit-Claudel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Record exchanges with provers and play them back without a prover.
+
+When ``CLIDriver.TRANSCRIPT_DIRECTORY`` is set, drivers record everything that
+they send to and receive from their prover into a transcript (one file per
+document and language, one JSON value per line).  The ``replay`` driver serves
+these transcripts back, which makes it possible to run (and benchmark) the full
+pipeline on machines that do not have the prover installed.
+"""
+
+from typing import Any, Deque, Dict, IO, List, Optional
+
+from collections import deque
+from os import makedirs, path
+from pathlib import Path
+import json
+
+from . import __version__, sexp as sx
+from .core import CLIDriver, Driver, DriverInfo, debug, resolve_driver
+from .json import _relative_document_path
+
+class TranscriptMismatch(ValueError):
+    pass
+
+def transcript_path(directory: str, fpath: Path, language: str) -> Path:
+    """Compute the location of `fpath`'s transcript in `directory`.
+
+    Like caches, transcripts are laid out like the documents that they belong
+    to, so documents with the same name in different directories get
+    different transcripts.
+    """
+    if fpath.name in ("", "-"):
+        return Path(directory) / "-.{}.transcript".format(language)
+    doc_path = _relative_document_path(path.realpath(directory), fpath)
+    return Path(directory) / "{}.{}.transcript".format(doc_path, language)
+
+class TranscriptWriter:
+    """Record a driver's exchanges with its prover as they happen.
+
+    The transcript stays open until ``close`` is called; recording more events
+    after that reopens it.
+    """
+    def __init__(self, driver: CLIDriver, directory: str):
+        self.path = transcript_path(directory, driver.fpath, driver.LANGUAGE) # type: ignore
+        makedirs(self.path.parent, exist_ok=True)
+        header = {"driver": driver.ID, "args": list(driver.user_args)} # type: ignore
+        # pylint: disable=consider-using-with
+        self.file: Optional[IO[str]] = open(self.path, mode="w", encoding="utf-8")
+        self.file.write(json.dumps(header) + "\n")
+
+    def record(self, kind: str, data: Any):
+        # ``sertop`` exchanges bytes; other drivers exchange strings.
+        binary = isinstance(data, (bytes, bytearray))
+        if binary:
+            data = data.decode("utf-8", "surrogateescape")
+        if self.file is None:
+            # pylint: disable=consider-using-with
+            self.file = open(self.path, mode="a", encoding="utf-8")
+        self.file.write(json.dumps([kind, data, binary]) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Transcript:
+    """A recorded transcript, split by kind of exchange."""
+    KINDS = ("read", "write", "cli", "file")
+
+    def __init__(self, path: Path, driver: str, args: List[str]):
+        self.path, self.driver, self.args = path, driver, args
+        self.events: Dict[str, Deque[Any]] = {k: deque() for k in self.KINDS}
+
+    @classmethod
+    def load(cls, path: Path) -> "Transcript":
+        with open(path, encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            transcript = cls(path, header["driver"], header["args"])
+            for line in f:
+                kind, data, binary = json.loads(line)
+                if binary:
+                    data = data.encode("utf-8", "surrogateescape")
+                transcript.events[kind].append(data)
+        return transcript
+
+    def next(self, kind: str) -> Any:
+        events = self.events[kind]
+        if not events:
+            MSG = "Transcript {} has no more {!r} events."
+            raise TranscriptMismatch(MSG.format(self.path, kind))
+        return events.popleft()
+
+class _ReplayProcess:
+    """A stand-in for the prover process of a replayed ``REPLDriver``."""
+    @staticmethod
+    def poll():
+        return None
+
+def _same_sexp(s, expected):
+    if not (s.startswith(b'(') and expected.startswith(b'(')):
+        return False
+    try:
+        return sx.load(s) == sx.load(expected)
+    except sx.ParseError:
+        return False
+
+class Replaying:
+    """A mixin that serves a driver's I/O from a ``Transcript``."""
+    POOL = None
+    SEGMENTER = None
+    TRANSPORT = "sexp" # Not probed: replayed responses can be in any format
+
+    replayed: Transcript
+
+    def _start(self, *_args, **_kwargs):
+        return _ReplayProcess()
+
+    def kill(self):
+        self.repl = None
+
+    def _read(self):
+        response = self.replayed.next("read")
+        debug(response, '<< ')
+        return response
+
+    def _write(self, s, end):
+        debug(s, '>> ')
+        expected = self.replayed.next("write")
+        # Compare parsed s-expressions: atoms may or may not be quoted
+        if s + end != expected and not _same_sexp(bytes(s), expected):
+            MSG = "Transcript {} does not match the current run: expected {!r}, got {!r}."
+            raise TranscriptMismatch(MSG.format(self.replayed.path, expected, s + end))
+
+    def run_cli(self, working_directory=None, capture_output=True, more_args=()):
+        return self.replayed.next("cli")
+
+    def _read_output(self, _fpath):
+        return self.replayed.next("file")
+
+class Replay(Driver):
+    """Play back the transcript recorded for a document.
+
+    The transcript says which driver produced it; that driver then runs as
+    usual, except that its exchanges with the prover are served from the
+    transcript.  The transcript is read from ``CLIDriver.TRANSCRIPT_DIRECTORY``.
+    """
+    NAME = "Replay"
+    ID = "replay"
+    LANGUAGE = "unset"
+
+    def __init__(self, args=(), fpath="-", binpath=None):
+        super().__init__()
+        self.fpath = Path(fpath)
+        self.user_args = args
+        self.binpath = binpath
+
+    @classmethod
+    def version_info(cls, binpath=None):
+        return DriverInfo(cls.NAME, __version__)
+
+    @property
+    def metadata(self):
+        return {"args": self.user_args}
+
+    def _recorded_driver(self) -> Driver:
+        directory: Optional[str] = CLIDriver.TRANSCRIPT_DIRECTORY
+        if directory is None:
+            raise ValueError("The replay driver needs a transcript directory.")
+        transcript = Transcript.load(transcript_path(directory, self.fpath, self.LANGUAGE))
+        driver_cls = resolve_driver(self.LANGUAGE, transcript.driver)
+        replaying = type(driver_cls.__name__ + "Replay", (Replaying, driver_cls), {})
+        driver = replaying(transcript.args, fpath=self.fpath)
+        driver.replayed = transcript
+        driver.observer = self.observer
+        return driver
+
+    def annotate(self, chunks):
+        return self._recorded_driver().annotate(chunks)
+
+    def annotate_suffix(self, chunks, start):
+        return self._recorded_driver().annotate_suffix(chunks, start)
+
+class CoqReplay(Replay):
+    LANGUAGE = "coq"
+
+class Lean3Replay(Replay):
+    LANGUAGE = "lean3"
+
+class Lean4Replay(Replay):
+    LANGUAGE = "lean4"
@@ -18,15 +18,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Any, Iterator, List, Tuple, Union
-
-from collections import namedtuple
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+from collections import deque, namedtuple, OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass
+import hashlib
+import json
+import re
+import subprocess
 import sys
+import time
 
 from . import sexp as sx
-from .core import UnexpectedError, REPLDriver, \
-    Hypothesis, Goal, Message, Sentence, Text, \
-    PrettyPrinted, PosView, indent, debug
+from .core import UnexpectedError, ProverTimeout, REPLDriver, \
+    Hypothesis, Goal, Message, Sentence, Text, Timing, \
+    PrettyPrinted, PosStr, PosView, View, indent, debug
 from .coq import CoqIdents
 
 def sexp_hd(sexp):
@@ -37,17 +44,178 @@ def sexp_hd(sexp):
 def utf8(x):
     return str(x).encode('utf-8')
 
+def may_contain_evars(dumped: bytes) -> bool:
+    """Check whether the dumped term `dumped` may contain existential variables.
+
+    The check is conservative, and works on both parsed terms (whose atoms
+    ``dump`` quotes) and ``sexp.Lazy`` terms (which ``dump`` copies as-is).
+    """
+    return b'Evar' in dumped
+
+# Record fields of sertop's responses whose type is an option.  JSON encodes
+# options as ``null`` or as their value; s-expressions use ``()`` or ``(value)``.
+# Other options cannot be told apart from their values, so terms are only
+# converted faithfully if their encoding does not use options (this is the case
+# of ``Constr.t`` terms, which are sent back to sertop to be printed).
+JSON_OPTION_FIELDS = frozenset(("loc", "stm_ids", "name"))
+# Constructors with inline records, whose fields s-expressions splice in place
+JSON_INLINE_RECORDS = frozenset(("Message",))
+JSON_CONSTRUCTOR_RE = re.compile(r"[A-Z][A-Za-z0-9_]*\Z")
+
+def json_to_sexp(js):
+    """Convert a response printed by ``sertop --printer=json`` to an s-expression.
+
+    The result has the same shape as the corresponding response printed by
+    ``--printer=sertop``, so the rest of the driver can process it unchanged:
+    records become lists of pairs, constant constructors become atoms, and
+    strings are escaped.
+
+    >>> json_to_sexp(["Message", {"level": ["Notice"], "loc": None}])
+    [b'Message', [b'level', b'Notice'], [b'loc', []]]
+
+    >>> json_to_sexp(["Answer", "query0", ["Added", 2, {"bp": 0, "ep": 6}, ["NewTip"]]])
+    [b'Answer', b'query0', [b'Added', b'2', [[b'bp', b'0'], [b'ep', b'6']], b'NewTip']]
+    >>> json_to_sexp({"loc": None, "stm_ids": [1, 2], "str": "Nat.add"})
+    [[b'loc', []], [b'stm_ids', [[b'1', b'2']]], [b'str', b'Nat.add']]
+    """
+    if isinstance(js, str):
+        return sx.escape(js.encode("utf-8"))
+    if isinstance(js, bool):
+        return b'true' if js else b'false'
+    if isinstance(js, (int, float)):
+        return utf8(js)
+    if js is None:
+        return []
+    if isinstance(js, dict):
+        fields = []
+        for k, v in js.items():
+            if k == "hyp": # Hypotheses are (names, body option, type) triples
+                v = [[json_to_sexp(names), json_to_sexp([body] if body is not None else None),
+                      json_to_sexp(htype)] for names, body, htype in v]
+            elif k in JSON_OPTION_FIELDS:
+                v = json_to_sexp([v] if v is not None else None)
+            else:
+                v = json_to_sexp(v)
+            fields.append([k.encode("utf-8"), v])
+        return fields
+    if len(js) == 1 and isinstance(js[0], str) and JSON_CONSTRUCTOR_RE.match(js[0]):
+        return js[0].encode("utf-8")
+    if len(js) == 2 and isinstance(js[0], str) and js[0] in JSON_INLINE_RECORDS:
+        return [js[0].encode("utf-8"), *json_to_sexp(js[1])]
+    return [json_to_sexp(x) for x in js]
+
 ApiAck = namedtuple("ApiAck", "")
 ApiCompleted = namedtuple("ApiCompleted", "")
 ApiAdded = namedtuple("ApiAdded", "sid loc")
+ApiCanceled = namedtuple("ApiCanceled", "sids")
 ApiExn = namedtuple("ApiExn", "sids exn loc")
 ApiMessage = namedtuple("ApiMessage", "sid level msg")
 ApiString = namedtuple("ApiString", "string")
 
+@dataclass
+class PrintStats:
+    requested: int = 0 # Terms that needed printing
+    printed: int = 0 # ``Print`` queries actually sent
+    memoized: int = 0 # Terms found in the ``PrintMemo``
+    batches: int = 0
+    seconds: float = 0.0
+
+    def __str__(self):
+        return ("{} terms printed with {} queries in {} batches ({:.3f}s); "
+                "{} reused from previous sentences").format(
+                    self.requested, self.printed, self.batches,
+                    self.seconds, self.memoized)
+
+@dataclass
+class GoalStats:
+    queried: int = 0 # ``Goals`` queries sent
+    skipped: int = 0 # Queries avoided for sentences that cannot change goals
+    reused: int = 0 # Unchanged goals copied from the previous sentence
+
+    def __str__(self):
+        return ("{} goal queries, {} skipped; "
+                "{} unchanged goal lists reused without printing").format(
+                    self.queried, self.skipped, self.reused)
+
+class PrintMemo:
+    """A bounded LRU table of pretty-printed terms, shared across sentences."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Any, str]" = OrderedDict()
+
+    def get(self, key) -> Optional[str]:
+        pp = self.entries.get(key)
+        if pp is not None:
+            self.entries.move_to_end(key)
+        return pp
+
+    def put(self, key, pp: str):
+        self.entries[key] = pp
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+class PrintBatch:
+    """A collection of ``Print`` queries, sent to sertop all at once.
+
+    Use `add` to register terms and `run` to print them.  Identical queries
+    (same term, printing parameters, and context) are only sent once, and
+    results are looked up in (and saved to) the API's ``PrintMemo``.
+    """
+    def __init__(self, api: "SerAPI"):
+        self.api = api
+        self.queries: Dict[Any, Tuple[bool, Tuple[Any, Any, bytes, int, int]]] = {}
+        self.results: Dict[Any, str] = {}
+        self.requested = 0
+
+    def add(self, sexp, sid, kind, pp_depth, pp_margin, context=()) \
+            -> Callable[[], Optional[str]]:
+        """Register `sexp` for printing; return a function to retrieve the result.
+
+        `context` lists the names bound in the term's environment (Coq renames
+        bound variables to avoid capturing them).
+        """
+        if sexp is None:
+            return lambda: None
+        dumped = bytes(sx.dump(sexp))
+        digest = hashlib.blake2b(dumped, digest_size=16).digest()
+        key = (digest, kind, pp_depth, pp_margin, context)
+        # Existential variables print differently once they are instantiated
+        memoizable = not may_contain_evars(dumped)
+        self.queries.setdefault(key, (memoizable, (sexp, sid, kind, pp_depth, pp_margin)))
+        self.requested += 1
+        return lambda: self.results[key]
+
+    def run(self):
+        start = time.perf_counter()
+        memo, stats = self.api.print_memo, self.api.print_stats
+        pending = []
+        for key, (memoizable, query) in self.queries.items():
+            if key in self.results:
+                continue
+            pp = memo.get(key) if memoizable else None
+            if pp is not None:
+                self.results[key] = pp
+                stats.memoized += 1
+            else:
+                pending.append((key, memoizable, self.api._pprint(*query)))
+        for key, memoizable, collect in pending:
+            pp = self.results[key] = collect().pp
+            if memoizable:
+                memo.put(key, pp)
+        stats.requested += self.requested
+        stats.printed += len(pending)
+        stats.batches += 1
+        stats.seconds += time.perf_counter() - start
+        self.requested = 0
+
 class SerAPI(REPLDriver):
     BIN = "sertop"
     NAME = "Coq+SerAPI"
-    REPL_ARGS = ("--printer=sertop", "--implicit")
+    REPL_ARGS = ("--implicit",)
 
     ID = "sertop"
     LANGUAGE = "coq"
@@ -58,6 +226,62 @@ class SerAPI(REPLDriver):
     MIN_PP_MARGIN = 20
     DEFAULT_PP_ARGS = {'pp_depth': 30, 'pp_margin': 55}
 
+    # Maximum number of bytes of queries sent to sertop before reading answers.
+    # Sertop stops reading its input while it is blocked writing its output, so
+    # sending more than a pipe's capacity without reading could deadlock.
+    PIPELINE_BUFFER_SIZE = 32 * 1024
+
+    # Maximum number of printed terms remembered across sentences
+    PRINT_MEMO_SIZE = 4096
+
+    # Name of the top-level module of documents annotated by pooled processes
+    # (see ``topfile``).
+    POOLED_TOPFILE = "Top.v"
+
+    # Sentences that cannot change how terms are printed: tactics, bullets, and
+    # a few queries.  Other sentences (notations, scopes, definitions, …) may
+    # change printing, so they conservatively flush the ``PrintMemo``.
+    PRINT_NEUTRAL_RE = re.compile(
+        r"\s*(?:[-+*{}]|[a-z_]|(?:Check|Print|About|Search\w*|Locate|Compute|Eval"
+        r"|Show|Goal|Proof)\b)")
+
+    # Responses that are dropped without being parsed: acknowledgments, and
+    # feedback on the progress of the document (see ``_deserialize_feedback``).
+    IGNORED_RESPONSE_RE = re.compile(
+        rb'[(](?:Answer [^ ()]+ Ack[)]|Feedback[(][(]doc_id \d+[)][(]span_id \d+[)]'
+        rb'[(]route \d+[)][(]contents ?[(]?'
+        rb'(?:FileLoaded|ProcessingIn|Processed|AddedAxiom)[ ()])')
+
+    # How sertop prints its responses (``--sertop-transport``): ``"sexp"``,
+    # ``"json"``, or ``"auto"`` to use JSON if the installed sertop supports it
+    # (see ``json_supported``).  Responses in either format are accepted
+    # regardless of this setting.  JSON is not the default: with
+    # ``LAZY_TERMS``, s-expressions parse faster than JSON responses can be
+    # converted (see ``etc/benchmark.py``), and JSON responses are only
+    # understood as far as ``json_to_sexp`` goes.
+    TRANSPORT = "sexp"
+    PRINTERS = {"sexp": "sertop", "json": "json"}
+    _JSON_SUPPORT: Dict[str, bool] = {}
+
+    # Whether to skip parsing the terms in goals.  Sertop sends them back to be
+    # printed, so they are kept as raw bytes (see ``sexp.Lazy``).
+    LAZY_TERMS = True
+
+    # Whether to reuse the previous sentence's goals when they cannot have
+    # changed (see ``GOAL_NEUTRAL_RE``) or when they are identical.
+    REUSE_GOALS = True
+
+    # Queries that cannot change the proof state: no need to ask for goals.
+    GOAL_NEUTRAL_RE = re.compile(
+        r"\s*(?:Check|Print|About|Search\w*|Locate|Compute|Eval|Show)\b")
+
+    # ``Reset Initial`` discards all previous definitions, so code after it can
+    # be annotated by a separate ``sertop`` (see ``SegmentedAnnotator``); the
+    # ``(* alectryon-segment *)`` comment marks other independent sections.
+    SEGMENT_RE = re.compile(
+        r"^[ \t]*(?:Reset[ \t]+Initial[ \t]*[.]|[(][*][ \t]*alectryon-segment[ \t]*[*][)])",
+        re.MULTILINE)
+
     # pylint: disable=dangerous-default-value
     def __init__(self, args=(),
                  fpath="-",
@@ -65,10 +289,25 @@ class SerAPI(REPLDriver):
                  pp_args=DEFAULT_PP_ARGS):
         """Prepare to run ``sertop``."""
         super().__init__(args=args, fpath=fpath, binpath=binpath)
-        self.instance_args = ("--topfile={}".format(self.topfile),)
+        self.transport = self.TRANSPORT
+        if self.transport == "auto":
+            self.transport = "json" if self.json_supported(self.binpath) else "sexp"
+        self.instance_args = ("--printer={}".format(self.PRINTERS[self.transport]),
+                              "--topfile={}".format(self.topfile))
         self.next_qid = 0
         self.pp_args = {**SerAPI.DEFAULT_PP_ARGS, **pp_args}
         self.last_response = None
+        self.pending: Deque[Tuple[bytes, int]] = deque()
+        self.pending_bytes = 0
+        self.responses: Dict[bytes, Deque[Any]] = {}
+        self.print_stats = PrintStats()
+        self.print_memo = PrintMemo(self.PRINT_MEMO_SIZE)
+        self.goal_stats = GoalStats()
+        self.last_goals: Optional[Tuple[Optional[bytes], List[Goal]]] = None
+        self.first_sid = None
+        self.history: List[bytes] = []
+        self.halted = False
+        self.add_times: Dict[Any, float] = {}
 
     @classmethod
     def driver_not_found(cls, binpath):
@@ -78,14 +317,47 @@ class SerAPI(REPLDriver):
 
     @property
     def topfile(self):
+        # ``--topfile`` cannot be changed once sertop is running, so pooled
+        # processes all use the same module name (otherwise they would only
+        # ever be reused for documents with the same file name).
+        if self.POOL is not None:
+            return self.POOLED_TOPFILE
         return CoqIdents.topfile_of_fpath(self.fpath)
 
     @property
     def metadata(self):
-        return {"sertop_args": self.user_args}
+        metadata: Dict[str, Any] = {"sertop_args": self.user_args}
+        if self.RECORD_TIMINGS:
+            metadata["timings"] = True
+        if self.POOL is not None:
+            metadata["topfile"] = self.topfile
+        return metadata
+
+    @classmethod
+    def json_supported(cls, binpath=None) -> bool:
+        """Check whether ``sertop --help`` lists a JSON printer."""
+        try:
+            path = cls.resolve_driver(binpath)
+        except ValueError:
+            return False # Reported when starting sertop
+        if path not in cls._JSON_SUPPORT:
+            try:
+                out = subprocess.run([path, "--help=plain"], stdin=subprocess.DEVNULL,
+                                     capture_output=True, timeout=30, check=False).stdout
+            except (OSError, subprocess.SubprocessError):
+                out = b""
+            printer = re.search(rb"--printer\b.*?(?:\n[ \t]*\n|\Z)", out, re.DOTALL)
+            supported = bool(printer and re.search(rb"\bjson\b", printer.group()))
+            debug("JSON transport {}supported by {}".format(
+                "" if supported else "not ", path), '# ')
+            cls._JSON_SUPPORT[path] = supported
+        return cls._JSON_SUPPORT[path]
 
     def _next_sexp(self):
-        """Wait for the next sertop prompt, and return the output preceding it."""
+        """Wait for the next sertop prompt, and return the output preceding it.
+
+        Return ``None`` for responses that match ``IGNORED_RESPONSE_RE``.
+        """
         response = self._read()
         if not response: # pragma: no cover
             # https://github.com/ejgallego/coq-serapi/issues/212
@@ -93,15 +365,65 @@ class SerAPI(REPLDriver):
             raise UnexpectedError(MSG.format(self.last_response))
         debug(response, '<< ')
         self.last_response = response
+        if response[:1] in (b'[', b'{'): # JSON transport
+            try:
+                return json_to_sexp(json.loads(response))
+            except ValueError: # pragma: no cover
+                return response
+        if self.IGNORED_RESPONSE_RE.match(response):
+            return None
+        lazy = sx.TERM_RE if self.LAZY_TERMS and b'CoqExtGoal' in response else None
         try:
-            return sx.load(response)
+            return sx.load(response, lazy)
         except sx.ParseError: # pragma: no cover
             return response
 
+    def _reset_document_state(self):
+        self.first_sid = None
+        self.history.clear()
+        self.halted = False
+        self.add_times.clear()
+        self.pending.clear()
+        self.pending_bytes = 0
+        self.responses.clear()
+        self.print_memo.clear()
+        self.last_goals = None
+
+    @staticmethod
+    def _is_completed(sexp):
+        return (isinstance(sexp, list) and sexp_hd(sexp) == b'Answer'
+                and len(sexp) > 2 and sexp_hd(sexp[2]) == b'Completed')
+
+    def _dispatch(self):
+        """Read one response and queue it for the oldest pending query.
+
+        Sertop processes queries in order, so all output (including feedback)
+        up to the next ``Completed`` answer belongs to that query.
+        """
+        qid, size = self.pending[0]
+        sexp = self._next_sexp()
+        if sexp is None:
+            return
+        self.responses[qid].append(sexp)
+        if SerAPI._is_completed(sexp):
+            self.pending.popleft()
+            self.pending_bytes -= size
+
     def _send(self, sexp):
-        s = sx.dump([b'query%d' % self.next_qid, sexp])
+        """Send `sexp` to sertop without waiting for an answer.
+
+        Return the query's tag, to be passed to ``_collect_messages``.
+        """
+        qid = b'query%d' % self.next_qid
+        s = sx.dump([qid, sexp])
         self.next_qid += 1
+        while self.pending and self.pending_bytes + len(s) > self.PIPELINE_BUFFER_SIZE:
+            self._dispatch()
         self._write(s, b'\n')
+        self.pending.append((qid, len(s)))
+        self.pending_bytes += len(s)
+        self.responses[qid] = deque()
+        return qid
 
     @staticmethod
     def _deserialize_loc(loc):
@@ -132,6 +454,8 @@ class SerAPI(REPLDriver):
             yield ApiCompleted()
         elif tag == b'Added':
             yield ApiAdded(sexp[1], SerAPI._deserialize_loc(sexp[2]))
+        elif tag == b'Canceled':
+            yield ApiCanceled(sexp[1])
         elif tag == b'ObjList':
             for tag, *obj in sexp[1]:
                 if tag == b'CoqString':
@@ -210,13 +534,17 @@ class SerAPI(REPLDriver):
         err += "\n" + "Results past this point may be unreliable."
         self.observer.notify(chunk.s, err, SerAPI._range_of_span(span, chunk), level=3)
 
-    def _collect_messages(self, typs: Tuple[type, ...], chunk, sid) -> Iterator[Any]:
+    def _collect_messages(self, typs: Tuple[type, ...], chunk, sid, qid) -> Iterator[Any]:
         warn_on_exn = ApiExn not in typs
+        responses = self.responses[qid]
         while True:
-            for response in self._deserialize_response(self._next_sexp()):
+            while not responses:
+                self._dispatch()
+            for response in self._deserialize_response(responses.popleft()):
                 if isinstance(response, ApiAck):
                     continue
                 if isinstance(response, ApiCompleted):
+                    del self.responses[qid]
                     return
                 if warn_on_exn and isinstance(response, ApiExn):
                     if sid is None or response.sids is None or sid in response.sids:
@@ -224,9 +552,14 @@ class SerAPI(REPLDriver):
                 if (not typs) or isinstance(response, typs): # type: ignore
                     yield response
 
-    def _pprint(self, sexp, sid, kind, pp_depth, pp_margin):
+    def _pprint(self, sexp, sid, kind, pp_depth, pp_margin) -> Callable[[], PrettyPrinted]:
+        """Send a ``Print`` query for `sexp`.
+
+        Return a function that waits for the answer; this allows callers to
+        send multiple queries before collecting results.
+        """
         if sexp is None:
-            return PrettyPrinted(sid, None)
+            return lambda: PrettyPrinted(sid, None)
         if kind is not None:
             sexp = [kind, sexp]
         meta = [[b'sid', sid],
@@ -234,28 +567,46 @@ class SerAPI(REPLDriver):
                  [[b'pp_format', b'PpStr'],
                   [b'pp_depth', utf8(pp_depth)],
                   [b'pp_margin', utf8(pp_margin)]]]]
-        self._send([b'Print', meta, sexp])
-        strings: List[ApiString] = list(self._collect_messages((ApiString,), None, sid))
-        if strings:
-            assert len(strings) == 1
-            return PrettyPrinted(sid, strings[0].string)
-        raise UnexpectedError("No string found in Print answer")
-
-    def _pprint_message(self, msg: ApiMessage):
-        return self._pprint(msg.msg, msg.sid, b'CoqPp', **self.pp_args)
-
-    def _exec(self, sid, chunk):
-        self._send([b'Exec', sid])
-        messages: List[ApiMessage] = list(self._collect_messages((ApiMessage,), chunk, sid))
-        return [self._pprint_message(msg) for msg in messages]
+        qid = self._send([b'Print', meta, sexp])
+        def collect():
+            strings: List[ApiString] = \
+                list(self._collect_messages((ApiString,), None, sid, qid))
+            if strings:
+                assert len(strings) == 1
+                return PrettyPrinted(sid, strings[0].string)
+            raise UnexpectedError("No string found in Print answer")
+        return collect
+
+    def _pprint_message(self, msg: ApiMessage, batch: PrintBatch):
+        pp = batch.add(msg.msg, msg.sid, b'CoqPp', **self.pp_args)
+        return lambda: PrettyPrinted(msg.sid, pp())
+
+    def _pprint_messages(self, messages: List[ApiMessage]) -> List[PrettyPrinted]:
+        batch = PrintBatch(self)
+        printed = [self._pprint_message(msg, batch) for msg in messages]
+        batch.run()
+        return [msg() for msg in printed]
+
+    def _exec(self, sid, chunk) -> Callable[[], List[ApiMessage]]:
+        qid = self._send([b'Exec', sid])
+        return lambda: list(self._collect_messages((ApiMessage,), chunk, sid, qid))
 
     def _add(self, chunk):
-        self._send([b'Add', [], sx.escape(chunk)])
+        self.history.append(bytes(chunk))
+        qid = self._send([b'Add', [], sx.escape(chunk)])
         prev_end, spans, messages = 0, [], []
         responses: Iterator[Union[ApiAdded, ApiMessage]] = \
-            self._collect_messages((ApiAdded, ApiMessage), chunk, None)
+            self._collect_messages((ApiAdded, ApiMessage), chunk, None, qid)
+        # Sertop parses sentences one by one, so the time between two ``Added``
+        # answers is the time spent adding the second sentence.
+        last_added = time.perf_counter()
         for response in responses:
             if isinstance(response, ApiAdded):
+                if self.RECORD_TIMINGS:
+                    now = time.perf_counter()
+                    self.add_times[response.sid], last_added = now - last_added, now
+                if self.first_sid is None:
+                    self.first_sid = response.sid
                 start, end = response.loc
                 if start != prev_end:
                     spans.append((None, chunk[prev_end:start]))
@@ -265,27 +616,76 @@ class SerAPI(REPLDriver):
                 messages.append(response)
         if prev_end != len(chunk):
             spans.append((None, chunk[prev_end:]))
-        return spans, [self._pprint_message(msg) for msg in messages]
+        return spans, self._pprint_messages(messages)
 
-    def _pprint_hyp(self, hyp, sid):
+    def _pprint_hyp(self, hyp, sid, batch: PrintBatch, context):
         d = self.pp_args['pp_depth']
         name_w = max(len(n) for n in hyp.names)
         w = max(self.pp_args['pp_margin'] - name_w, SerAPI.MIN_PP_MARGIN)
-        body = self._pprint(hyp.body, sid, b'CoqExpr', d, w - 2).pp
-        htype = self._pprint(hyp.type, sid, b'CoqExpr', d, w - 3).pp
-        return Hypothesis(hyp.names, body, htype)
-
-    def _pprint_goal(self, goal, sid):
-        ccl = self._pprint(goal.conclusion, sid, b'CoqExpr', **self.pp_args).pp
-        hyps = [self._pprint_hyp(h, sid) for h in goal.hypotheses]
-        return Goal(sx.tostr(goal.name) if goal.name else None, ccl, hyps)
-
-    def _goals(self, sid, chunk):
+        body = batch.add(hyp.body, sid, b'CoqExpr', d, w - 2, context)
+        htype = batch.add(hyp.type, sid, b'CoqExpr', d, w - 3, context)
+        return lambda: Hypothesis(hyp.names, body(), htype())
+
+    def _pprint_goal(self, goal, sid, batch: PrintBatch):
+        context = tuple(n for hyp in goal.hypotheses for n in hyp.names)
+        ccl = batch.add(goal.conclusion, sid, b'CoqExpr', **self.pp_args, context=context)
+        hyps = [self._pprint_hyp(h, sid, batch, context) for h in goal.hypotheses]
+        name = sx.tostr(goal.name) if goal.name else None
+        return lambda: Goal(name, ccl(), [hyp() for hyp in hyps])
+
+    def _goals(self, sid, chunk) -> Callable[[], List[Goal]]:
         # LATER Goals instead and CoqGoal and CoqConstr?
         # LATER We'd like to retrieve the formatted version directly
-        self._send([b'Query', [[b'sid', sid]], b'EGoals'])
-        goals: List[Goal] = list(self._collect_messages((Goal,), chunk, sid))
-        yield from (self._pprint_goal(g, sid) for g in goals)
+        qid = self._send([b'Query', [[b'sid', sid]], b'EGoals'])
+        self.goal_stats.queried += 1
+        return lambda: list(self._collect_messages((Goal,), chunk, sid, qid))
+
+    @staticmethod
+    def _fingerprint(goals) -> Optional[bytes]:
+        """Compute a digest of unprinted `goals`; ``None`` if they contain evars."""
+        dumped = sx.dump([[g.name or [], g.conclusion,
+                           [[[utf8(n) for n in h.names], h.body or [], h.type]
+                            for h in g.hypotheses]]
+                          for g in goals])
+        if may_contain_evars(dumped):
+            return None
+        return hashlib.blake2b(dumped, digest_size=16).digest()
+
+    def _sentence_goals(self, sid, goals, print_neutral, batch: PrintBatch) \
+            -> Callable[[], List[Goal]]:
+        """Print `goals` in `batch`, or reuse those of the previous sentence.
+
+        `goals` is ``None`` when the query was skipped.
+        """
+        last = self.last_goals if self.REUSE_GOALS else None
+        if last is not None and goals is None:
+            self.goal_stats.skipped += 1
+            fingerprint = last[0]
+        else:
+            fingerprint = self._fingerprint(goals)
+            if (last is None or fingerprint is None or not print_neutral
+                    or last[0] != fingerprint):
+                printed = [self._pprint_goal(g, sid, batch) for g in goals]
+                def collect():
+                    pp = [goal() for goal in printed]
+                    self.last_goals = (fingerprint, pp)
+                    return pp
+                return collect
+            self.goal_stats.reused += 1
+        # Copy, since transforms can modify goals in place
+        pp = deepcopy(last[1])
+        self.last_goals = (fingerprint, pp)
+        return lambda: pp
+
+    def rewind(self):
+        """Cancel all sentences added so far, restoring Coq's initial state."""
+        if self.first_sid is not None:
+            qid = self._send([b'Cancel', [self.first_sid]])
+            exns = list(self._collect_messages((ApiExn,), None, None, qid))
+            if exns:
+                MSG = "Failed to rewind sertop: {}"
+                raise UnexpectedError(MSG.format(sx.tostr(exns[0].exn)))
+        self._reset_document_state()
 
     def _warn_orphaned(self, chunk, message):
         err = "Orphaned message for sid {}:".format(message.sid)
@@ -293,26 +693,138 @@ class SerAPI(REPLDriver):
         err_range = SerAPI._range_of_span((0, len(chunk)), chunk)
         self.observer.notify(chunk.s, err, err_range, level=2)
 
-    def run(self, chunk):
-        """Send a `chunk` to sertop.
+    def _warn_on_timeout(self, exn, span, chunk, consequence):
+        err = "{}\n{}".format(exn, SerAPI._highlight_exn(span, chunk, prefix='  > '))
+        err += "\n" + consequence
+        self.observer.notify(chunk.s, err, SerAPI._range_of_span(span, chunk), level=3)
 
-        A chunk is a string containing Coq sentences or comments.  The sentences
-        are split, sent to Coq, and returned as a list of ``Text`` instances
-        (for whitespace and comments) and ``Sentence`` instances (for code).
+    def _restart(self, prefix: bytes):
+        """Restart sertop after a timeout and restore the document's state.
+
+        All text added before the current chunk is sent again, followed by
+        `prefix` (the part of the current chunk that preceded the sentence that
+        timed out), and executed within the document's remaining budget.
+        """
+        history = self.history[:-1] + [prefix]
+        self.kill()
+        self.reset()
+        text = b"\n".join(history)
+        if not text.strip():
+            return
+        spans, _ = self._add(text)
+        with self.time_limit(self.time_left(per_sentence=False)):
+            self._replay([sid for sid, _ in spans if sid is not None])
+
+    def _replay(self, sids):
+        """Execute sentences `sids`, discarding their output.
+
+        This is used for sentences whose output was already reported.
+        """
+        if sids:
+            list(self._collect_messages((ApiExn,), None, None,
+                                        self._send([b'Exec', sids[-1]])))
+
+    def _run_prefix(self, sids, chunk):
+        """Execute sentences `sids`, which precede `chunk`, before running it.
+
+        If this exhausts the document's budget, no further sentences are run.
+        """
+        try:
+            with self.time_limit(self.time_left(per_sentence=False)):
+                self._replay(sids)
+        except ProverTimeout as e:
+            MSG = ("Time budget of the document ({}s) exhausted while running "
+                   "earlier sentences; later sentences were not run.")
+            self._warn_on_timeout(e, (0, 0), chunk, MSG.format(self.DOCUMENT_TIMEOUT))
+            self._halt()
+
+    def _halt(self):
+        """Restart sertop, without running any further sentences."""
+        self.kill()
+        self.reset()
+        self.halted = True
+
+    def _timeout(self, exn, span, chunk):
+        """Recover from a timeout in `span` of `chunk`.
+
+        The sentence that timed out is dropped; if the document's budget is
+        exhausted, no further sentences are run.
+        """
+        left = self.time_left(per_sentence=False)
+        if left is not None and left <= 0:
+            MSG = "Time budget of the document ({}s) exhausted; later sentences were not run."
+            self._warn_on_timeout(exn, span, chunk, MSG.format(self.DOCUMENT_TIMEOUT))
+            self._halt()
+            return
+        MSG = "This sentence was skipped.  Results past this point may be unreliable."
+        self._warn_on_timeout(exn, span, chunk, MSG)
+        try:
+            self._restart(bytes(chunk[:span[0]]))
+        except ProverTimeout as e:
+            MSG = "Failed to restore the state of the document; later sentences were not run."
+            self._warn_on_timeout(e, span, chunk, MSG)
+            self._halt()
+
+    @staticmethod
+    def _suffix(chunk: View, offset) -> View:
+        """Return the part of `chunk` that follows byte `offset`."""
+        if isinstance(chunk.s, PosStr):
+            nchars = len(bytes(chunk[:offset]).decode("utf-8"))
+            return PosView(chunk.s.split_at(nchars)[1])
+        return View(bytes(chunk[offset:]))
+
+    def _run_sentence(self, span_id, contents, chunk, messages):
+        t_start = time.perf_counter()
+        # Send both queries before reading answers (pipelining)
+        exec_messages = self._exec(span_id, chunk)
+        skip_goals = (self.REUSE_GOALS and self.last_goals is not None
+                      and self.GOAL_NEUTRAL_RE.match(contents))
+        goals = None if skip_goals else self._goals(span_id, chunk)
+        print_neutral = bool(self.PRINT_NEUTRAL_RE.match(contents))
+        if not print_neutral:
+            self.print_memo.clear()
+        # Print all goals and messages for this sentence in one batch
+        batch = PrintBatch(self)
+        printed_messages = [self._pprint_message(m, batch) for m in exec_messages()]
+        t_exec = time.perf_counter()
+        raw_goals = goals() if goals else None
+        t_goals = time.perf_counter()
+        printed_goals = self._sentence_goals(span_id, raw_goals, print_neutral, batch)
+        batch.run()
+        messages.extend(msg() for msg in printed_messages)
+        timing = None
+        if self.RECORD_TIMINGS:
+            timing = Timing(*(round(t, 6) for t in (
+                self.add_times.pop(span_id, 0.0), t_exec - t_start,
+                t_goals - t_exec, time.perf_counter() - t_goals)))
+        return Sentence(contents, messages=[], goals=printed_goals(), timing=timing)
+
+    def _run_part(self, chunk: View, fragments) -> Optional[View]:
+        """Add `chunk` and run its sentences, appending them to `fragments`.
+
+        If a sentence times out, stop and return the rest of `chunk`, which
+        must be added again once sertop has been restarted.
         """
-        chunk = PosView(chunk)
         spans, messages = self._add(chunk)
-        fragments, fragments_by_id = [], {}
+        fragments_by_id, offset, rest = {}, 0, None
         for span_id, contents in spans:
+            span, offset = (offset, offset + len(contents)), offset + len(contents)
             contents = str(contents, encoding='utf-8')
             if span_id is None:
                 fragments.append(Text(contents))
-            else:
-                messages.extend(self._exec(span_id, chunk))
-                goals = list(self._goals(span_id, chunk))
-                fragment = Sentence(contents, messages=[], goals=goals)
-                fragments.append(fragment)
-                fragments_by_id[span_id] = fragment
+                continue
+            fragment = Sentence(contents, messages=[], goals=[])
+            fragments.append(fragment)
+            if self.halted:
+                continue
+            try:
+                with self.time_limit(self.time_left()):
+                    fragments[-1] = self._run_sentence(span_id, contents, chunk, messages)
+            except ProverTimeout as e:
+                self._timeout(e, span, chunk)
+                rest = SerAPI._suffix(chunk, span[1])
+                break
+            fragments_by_id[span_id] = fragments[-1]
         # Messages for span n + δ can arrive during processing of span n or
         # during _add, so we delay message processing until the very end.
         for message in messages:
@@ -321,11 +833,54 @@ class SerAPI(REPLDriver):
                 self._warn_orphaned(chunk, message)
             else:
                 fragment.messages.append(Message(message.pp))
+        return rest
+
+    def run(self, chunk):
+        """Send a `chunk` to sertop.
+
+        A chunk is a string containing Coq sentences or comments.  The sentences
+        are split, sent to Coq, and returned as a list of ``Text`` instances
+        (for whitespace and comments) and ``Sentence`` instances (for code).
+
+        Sentences that exceed their time budget (``SENTENCE_TIMEOUT``,
+        ``DOCUMENT_TIMEOUT``) are reported to the ``observer`` and returned
+        without goals or messages; sertop is then restarted to process the
+        rest of the chunk (see ``_timeout``).
+        """
+        rest, fragments = PosView(chunk), []
+        while rest is not None:
+            rest = self._run_part(rest, fragments)
         return fragments
 
     def annotate(self, chunks):
+        return list(self.annotate_iter(chunks))
+
+    def annotate_iter(self, chunks):
+        if self.SEGMENTER is not None:
+            annotated = self.SEGMENTER.annotate(self, chunks)
+            if annotated is not None:
+                yield from annotated
+                return
+        with self as api:
+            for chunk in chunks:
+                yield api.run(chunk)
+            debug(api.print_stats, '# ')
+            debug(api.goal_stats, '# ')
+
+    def annotate_suffix(self, chunks, start):
+        # Sentences in ``chunks[:start]`` are executed all at once, without
+        # querying or printing goals, and outside of the per-sentence budget.
         with self as api:
-            return [api.run(chunk) for chunk in chunks]
+            sids = []
+            for chunk in chunks[:start]:
+                spans, _ = api._add(PosView(chunk))
+                sids.extend(sid for sid, _ in spans if sid is not None)
+            if start < len(chunks):
+                api._run_prefix(sids, PosView(chunks[start]))
+            annotated = [api.run(chunk) for chunk in chunks[start:]]
+            debug(api.print_stats, '# ')
+            debug(api.goal_stats, '# ')
+            return annotated
 
 class SerAPI_noexec(SerAPI):
     """A variant of SerAPI that segments the code without executing it.
@@ -336,9 +891,9 @@ class SerAPI_noexec(SerAPI):
     ID = "sertop_noexec"
 
     def _exec(self, sid, chunk):
-        return []
+        return lambda: []
     def _goals(self, sid, chunk):
-        return []
+        return lambda: []
 
 def annotate(chunks, sertop_args=(), fpath="-", binpath=None):
     r"""Annotate multiple `chunks` of Coq code.
@@ -75,9 +75,131 @@ def parse(tokens):
             top.append(tok)
     return top[0]
 
-def load(bs):
+# A single regular expression matching all tokens: parentheses, strings
+# (quotes included), atoms, and stray quotes (which start unterminated strings).
+TOKEN_RE = re.compile(rb'[()]|"(?:[^\\"]+|\\.)*"|[^ ()"]+|"', re.DOTALL)
+PAREN_RE = re.compile(rb'[()]|"(?:[^\\"]+|\\.)*"', re.DOTALL)
+
+class Lazy:
+    """A subtree of an s-expression, kept in serialized form.
+
+    ``dump`` copies lazy subtrees as-is; use ``force`` to parse them.
+
+    >>> t = load(b'(Answer (ty (App f x)))', lazy=TERM_RE)
+    >>> t
+    [b'Answer', [b'ty', Lazy(b'(App f x)')]]
+    >>> t[1][1].force()
+    [b'App', b'f', b'x']
+    >>> bytes(dump(t))
+    b'("Answer"("ty"(App f x)))'
+    """
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def force(self):
+        return load(self.raw)
+
+    def __eq__(self, other):
+        return isinstance(other, Lazy) and self.raw == other.raw
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __repr__(self):
+        return "Lazy({!r})".format(self.raw)
+
+# Constructors of Coq terms (``Constr.t``), which are usually sent back to
+# sertop to be printed without being inspected.
+TERM_RE = re.compile(
+    rb'[(](?:Rel|Var|Meta|Evar|Sort|Cast|Prod|Lambda|LetIn|App|Const|Ind'
+    rb'|Construct|Case|Fix|CoFix|Proj|Int|Float|Array)(?=[ ()])')
+
+def _skip(bs, pos):
+    """Find the end of the list whose opening parenthesis ends at `pos`."""
+    start, depth = pos, 1
+    while depth: # Fast path: count parentheses
+        close = bs.find(b')', pos)
+        if close < 0:
+            raise ParseError("Unbalanced input")
+        depth += bs.count(b'(', pos, close) - 1
+        pos = close + 1
+    if b'"' not in bs[start:pos]:
+        return pos
+    depth = 1 # Slow path: skip over strings, which may contain parentheses
+    for m in PAREN_RE.finditer(bs, start):
+        tok = bs[m.start()]
+        depth += 1 if tok == OPEN else -1 if tok == CLOSE else 0
+        if not depth:
+            return m.end()
+    raise ParseError("Unbalanced input")
+
+def _parse_tokens(tokens, top, stack):
+    for tok in tokens:
+        hd = tok[0]
+        if hd == OPEN:
+            new = []
+            top.append(new)
+            stack.append(top)
+            top = new
+        elif hd == CLOSE:
+            top = stack.pop()
+        elif hd == QUOTE:
+            if len(tok) == 1:
+                raise ParseError("Unterminated string: {!r}.".format(tok))
+            top.append(tok[1:-1])
+        else:
+            top.append(tok)
+    return top
+
+def _load_lazy_slow(bs, lazy, pos, top, stack):
+    while True:
+        m = TOKEN_RE.search(bs, pos)
+        if m is None:
+            return top
+        start, pos = m.span()
+        if bs[start] == OPEN and lazy.match(bs, start):
+            end = _skip(bs, pos)
+            top.append(Lazy(bs[start:end]))
+            pos = end
+        else:
+            top = _parse_tokens((bs[start:pos],), top, stack)
+
+def _load_lazy(bs, lazy):
+    top, stack, pos = [], [], 0
+    while True:
+        m = lazy.search(bs, pos)
+        segment = bs[pos:m.start() if m else len(bs)]
+        tokens = TOKEN_RE.findall(segment)
+        if b'"' in segment and b'"' in tokens:
+            # `m` may be part of a string that starts in `segment`
+            return _load_lazy_slow(bs, lazy, pos, top, stack), stack
+        top = _parse_tokens(tokens, top, stack)
+        if m is None:
+            return top, stack
+        pos = _skip(bs, m.end())
+        top.append(Lazy(bs[m.start():pos]))
+
+def load(bs, lazy=None):
+    """Parse the first s-expression in `bs`, in a single pass.
+
+    Strings are returned unquoted but still escaped (see ``tostr``).  If `lazy`
+    is a compiled regexp (such as ``TERM_RE``), lists that start with a match
+    of `lazy` are not parsed, but returned as ``Lazy`` objects.
+
+    >>> load(b'(Message (level Notice) (str "a (b)"))')
+    [b'Message', [b'level', b'Notice'], [b'str', b'a (b)']]
+    """
     try:
-        return parse(tokenize(bs))
+        if lazy is None:
+            stack = []
+            top = _parse_tokens(TOKEN_RE.findall(bs), [], stack)
+        else:
+            top, stack = _load_lazy(bs, lazy)
+        if stack:
+            raise ParseError("Unbalanced input")
+        return top[0]
     except IndexError as e:
         raise ParseError("Unbalanced input") from e
 
@@ -89,6 +211,8 @@ def unparse(sexp, buf):
             buf.append(OPEN)
             stack.append(CLOSE)
             stack.extend(reversed(top))
+        elif isinstance(top, Lazy):
+            buf.extend(top.raw)
         elif isinstance(top, bytes):
             buf.append(QUOTE)
             buf.extend(top)
@@ -24,7 +24,7 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from sphinx.application import Sphinx
 
-from . import docutils
+from . import docutils, json
 from .html import ASSETS as HTML_ASSETS
 from .latex import ASSETS as LATEX_ASSETS
 from .pygments import LatexFormatter
@@ -51,6 +51,28 @@ def add_assets(app: "Sphinx"):
         app.config.latex_additional_files.append(os.path.join(LATEX_ASSETS.PATH, sty))
         app.add_latex_package(sty.replace(".sty", ""))
 
+def reset_cache_stats(_app: "Sphinx", env, _docnames):
+    env.alectryon_cache_stats = json.CacheStats()
+
+def collect_cache_stats(app: "Sphinx", _doctree):
+    # Stats are attached to the environment so that they survive parallel reads
+    stats = getattr(app.env, "alectryon_cache_stats", None)
+    if stats is not None:
+        stats.merge(json.STATS)
+    json.STATS = json.CacheStats()
+
+def merge_cache_stats(_app: "Sphinx", env, _docnames, other):
+    stats = getattr(other, "alectryon_cache_stats", None)
+    if stats is not None and hasattr(env, "alectryon_cache_stats"):
+        env.alectryon_cache_stats.merge(stats)
+
+def log_cache_stats(app: "Sphinx", _exception):
+    from sphinx.util import logging
+    stats = getattr(app.env, "alectryon_cache_stats", None)
+    if docutils.CACHE_DIRECTORY is not None and stats is not None:
+        for line in stats.format_summary().splitlines():
+            logging.getLogger(__name__).info("[alectryon] " + line)
+
 def setup(app: "Sphinx"):
     """Register Alectryon's directives, transforms, etc."""
     register_coq_parser(app)
@@ -89,4 +111,9 @@ def setup(app: "Sphinx"):
 
     app.connect('builder-inited', add_assets)
 
+    app.connect('env-before-read-docs', reset_cache_stats)
+    app.connect('doctree-read', collect_cache_stats)
+    app.connect('env-merge-info', merge_cache_stats)
+    app.connect('build-finished', log_cache_stats)
+
     return {'version': '0.1', "parallel_read_safe": True}
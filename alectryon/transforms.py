@@ -109,8 +109,11 @@ def enrich_sentences(fragments):
             # Always add goals & messages; empty lists are filtered out later
             outputs = [Messages([RichMessage(m.contents) for m in fr.messages]),
                        Goals([_enrich_goal(g) for g in fr.goals])]
-            yield RichSentence(input=RichCode(fr.contents), outputs=outputs,
-                               prefixes=[], suffixes=[], annots=IOAnnots())
+            rich = RichSentence(input=RichCode(fr.contents), outputs=outputs,
+                                prefixes=[], suffixes=[], annots=IOAnnots())
+            if fr.timing is not None:
+                rich.props["timing"] = fr.timing
+            yield rich
         else:
             yield fr
 
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+"""Benchmark Alectryon's pipeline on synthetic documents.
+
+This script generates a literate Coq or Lean 4 document of configurable size,
+along with a prover transcript for it (see ``alectryon/replay.py``), and times
+each stage of the pipeline separately: literate partitioning, annotation
+(replayed from the transcript, so no prover is needed), transforms, HTML and
+LaTeX generation, JSON serialization, and cache writes, reads, and misses (an
+edited document, whose cache is only validated).  Results are written as JSON,
+to make it easy to track them across releases::
+
+   python3 etc/benchmark.py --sentences 5000 --repeat 5 -o bench.json
+
+For Coq, it also measures parsing throughput on the generated transcript, and
+annotation with both of ``sertop``'s output formats (s-expressions and JSON).
+To measure parsing on real ``sertop`` output instead, record a transcript and
+pass it with ``--transcript``::
+
+   alectryon --record-transcripts transcripts/ file.v
+   python3 etc/benchmark.py --transcript transcripts/file.v.coq.transcript
+"""
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from alectryon import __version__, cli, sexp as sx
+from alectryon.core import CLIDriver, EncodedDocument, Goal, Hypothesis, \
+    Message, Sentence, Text
+from alectryon.json import FileCacheSet, PlainSerializer, \
+    DeduplicatingSerializer, FullyDeduplicatingSerializer
+from alectryon.lean4 import Lean4
+from alectryon.literate import Code
+from alectryon.replay import CoqReplay, Lean4Replay, Transcript, \
+    TranscriptWriter, transcript_path
+from alectryon.serapi import SerAPI, json_to_sexp, sexp_hd
+
+# Document generation
+# ===================
+
+class Spec(NamedTuple):
+    sentences: int # Total number of sentences
+    goals: int # Goals per proof step
+    hypotheses: int # Hypotheses per goal
+    comments: float # Fraction of sentences followed by a comment
+
+TACTICS_PER_PROOF = 8
+
+class Record(NamedTuple):
+    """A sentence of a synthetic document, with the prover's output for it."""
+    text: str
+    goals: List[Any] # ``Goal`` instances with sexps in place of strings
+    messages: List[str]
+
+def var(name: str):
+    return [b'Var', [b'Id', name.encode("ascii")]]
+
+def app(fn: str, *args):
+    return [b'App', var(fn), list(args)]
+
+def render(sexp) -> str:
+    """Pretty-print a term produced by ``var`` or ``app``."""
+    if sexp[0] == b'Var':
+        return sexp[1][1].decode("ascii")
+    if sexp[0] == b'Pp_string':
+        return sx.tostr(sexp[1])
+    assert sexp[0] == b'App'
+    return "({})".format(" ".join([render(sexp[1]), *map(render, sexp[2])]))
+
+def term_json(sexp):
+    """Convert a term produced by ``var`` or ``app`` to JSON."""
+    if isinstance(sexp, list):
+        return [term_json(x) for x in sexp]
+    return sexp.decode("ascii")
+
+def make_goals(spec: Spec, lemma: int, step: int) -> List[Any]:
+    # Most hypotheses are shared by consecutive steps, as in real proofs
+    xs = [var("x{}".format(i)) for i in range(spec.hypotheses)]
+    hyps = [Hypothesis(["H{}".format(i)], None,
+                       app("P{}".format(i), var("l{}".format(lemma)), x))
+            for i, x in enumerate(xs[1:])]
+    hyps.append(Hypothesis(["IH"], None, app("Q", var("s{}".format(step)))))
+    return [Goal(None, app("eq", app("f{}".format(step), *xs), var("y{}".format(g))), hyps)
+            for g in range(spec.goals)]
+
+class Builder:
+    def __init__(self, spec: Spec):
+        self.spec = spec
+        self.parts: List[str] = []
+        self.records: List[Record] = []
+
+    def sentence(self, text, goals=(), messages=(), indent=""):
+        n = len(self.records)
+        self.parts.append(indent + text + "\n")
+        self.records.append(Record(text, list(goals), list(messages)))
+        if self.spec.comments and int(n * self.spec.comments) != int((n + 1) * self.spec.comments):
+            self.comment(n, indent)
+
+    def comment(self, n, indent):
+        raise NotImplementedError()
+
+class CoqBuilder(Builder):
+    def comment(self, n, indent):
+        self.parts.append("{}(* Comment {} *)\n".format(indent, n))
+
+    def lemma(self, n):
+        self.parts.append("(*| Lemma {} is about ``f``. |*)\n\n".format(n))
+        statement = "Lemma lemma{} : forall x, P x.".format(n)
+        self.sentence(statement, make_goals(self.spec, n, 0))
+        self.sentence("Proof.", make_goals(self.spec, n, 0))
+        for step in range(1, TACTICS_PER_PROOF + 1):
+            self.sentence("tac{}.".format(step), make_goals(self.spec, n, step), indent="  ")
+        self.sentence("Qed.")
+        self.sentence("Check lemma{}.".format(n), messages=[statement])
+        self.parts.append("\n")
+
+class Lean4Builder(Builder):
+    def comment(self, n, indent):
+        self.parts.append("{}-- Comment {}\n".format(indent, n))
+
+    def lemma(self, n):
+        self.parts.append("/-! Lemma {} is about `f`. -/\n\n".format(n))
+        statement = "theorem lemma{} (x : Nat) : P x := by".format(n)
+        self.sentence(statement, make_goals(self.spec, n, 0))
+        for step in range(1, TACTICS_PER_PROOF + 1):
+            self.sentence("tac{}".format(step), make_goals(self.spec, n, step), indent="  ")
+        self.sentence("#check lemma{}".format(n), messages=[statement])
+        self.parts.append("\n")
+
+BUILDERS = {"coq": CoqBuilder, "lean4": Lean4Builder}
+EXTENSIONS = {"coq": ".v", "lean4": ".lean"}
+
+def generate(spec: Spec, language: str):
+    builder = BUILDERS[language](spec)
+    n = 0
+    while len(builder.records) < spec.sentences:
+        builder.lemma(n)
+        n += 1
+    return "".join(builder.parts), builder.records
+
+# Transcripts
+# ===========
+
+class _SimulatedProcess:
+    @staticmethod
+    def poll():
+        return None
+
+class SimulatedSerAPI(SerAPI):
+    """A SerAPI driver connected to a simulated ``sertop``.
+
+    The simulated prover answers queries using a list of ``Record`` instances;
+    this is only used to produce a transcript, which is then replayed.
+    """
+    SENTENCE_RE = rb"[(][*].*?[*][)]|[^\s.][^.]*[.]"
+
+    TRANSPORT = "sexp"
+
+    def __init__(self, records: List[Record], *args, transport="sexp", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transport = transport
+        self.records = deque(records)
+        self.answers: deque = deque()
+        self.by_sid: Dict[bytes, Record] = {}
+
+    def _start(self, *_args, **_kwargs):
+        return _SimulatedProcess()
+
+    def kill(self):
+        self.repl = None
+
+    def _read(self):
+        response = self.answers.popleft()
+        self._record("read", response)
+        return response
+
+    def _write(self, s, end):
+        self._record("write", s + end)
+        qid, query = sx.load(bytes(s))
+        qid = qid.decode("ascii")
+        self._reply(["Answer", qid, ["Ack"]])
+        getattr(self, "_answer_" + query[0].decode("ascii"))(qid, query)
+        self._reply(["Answer", qid, ["Completed"]])
+
+    # Like sertop, only quote atoms that need it
+    PLAIN_ATOM_RE = re.compile(rb'"([^ ()"\\]+)"(?![()])')
+    PLAIN_ATOM_BEFORE_PAREN_RE = re.compile(rb'"([^ ()"\\]+)"(?=[()])')
+
+    def _reply(self, reply):
+        """Print `reply`, given in the shape of sertop's JSON output."""
+        if self.transport == "json":
+            dumped = json.dumps(reply, separators=(",", ":")).encode("utf-8")
+        else:
+            dumped = bytes(sx.dump(json_to_sexp(reply)))
+            dumped = self.PLAIN_ATOM_RE.sub(rb"\1 ", dumped)
+            dumped = self.PLAIN_ATOM_BEFORE_PAREN_RE.sub(rb"\1", dumped)
+        self.answers.append(dumped + b"\n")
+
+    def _answer_Add(self, qid, query):
+        for m in re.finditer(self.SENTENCE_RE, sx.unescape(query[2]), re.DOTALL):
+            if m.group().startswith(b"(*"):
+                continue
+            record = self.records.popleft()
+            assert record.text == m.group().decode("utf-8"), (record, m.group())
+            sid = len(self.by_sid) + 2
+            self.by_sid[str(sid).encode("ascii")] = record
+            loc = {"fname": ["ToplevelInput"], "line_nb": 1, "bol_pos": 0,
+                   "line_nb_last": 1, "bol_pos_last": 0, "bp": m.start(), "ep": m.end()}
+            self._reply(["Answer", qid, ["Added", sid, loc, ["NewTip"]]])
+
+    def _answer_Exec(self, _qid, query):
+        sid = query[1]
+        for msg in self.by_sid[sid].messages:
+            contents = ["Message", {"level": ["Notice"], "loc": None,
+                                    "pp": ["Pp_string", msg], "str": msg}]
+            self._reply(["Feedback", {"doc_id": 0, "span_id": int(sid),
+                                      "route": 0, "contents": contents}])
+
+    def _answer_Query(self, qid, query):
+        goals = self.by_sid[dict(query[1])[b'sid']].goals
+        objs = []
+        if goals:
+            goals = [{"info": {"evar": ["Ser_Evar", 1], "name": None},
+                      "ty": term_json(g.conclusion),
+                      "hyp": [[[["Id", n] for n in h.names], None, term_json(h.type)]
+                              for h in reversed(g.hypotheses)]}
+                     for g in goals]
+            objs.append(["CoqExtGoal", {"goals": goals, "stack": [], "bullet": None,
+                                        "shelf": [], "given_up": []}])
+        self._reply(["Answer", qid, ["ObjList", objs]])
+
+    def _answer_Print(self, qid, query):
+        self._reply(["Answer", qid, ["ObjList", [["CoqString", render(query[2][1])]]]])
+
+def record_coq(records, chunks, fpath, transport="sexp"):
+    SimulatedSerAPI(records, fpath=fpath, transport=transport).annotate(chunks)
+
+def record_lean4(records, chunks, fpath):
+    contents = EncodedDocument(chunks, "\n").contents.decode("utf-8")
+    records, fragments = deque(records), []
+    for line in contents.splitlines(keepends=True):
+        text = line.strip()
+        if not text or text.startswith("--"):
+            fragments.append(Text(line))
+            continue
+        record = records.popleft()
+        assert record.text == text, (record, text)
+        goals = [Goal(g.name, render(g.conclusion),
+                      [Hypothesis(h.names, h.body, render(h.type)) for h in g.hypotheses])
+                 for g in record.goals]
+        indent = line[:len(line) - len(line.lstrip())]
+        if indent:
+            fragments.append(Text(indent))
+        fragments.append(Sentence(text, [Message(m) for m in record.messages], goals))
+        fragments.append(Text(line[len(indent) + len(text):]))
+    writer = TranscriptWriter(Lean4(fpath=fpath), CLIDriver.TRANSCRIPT_DIRECTORY) # type: ignore
+    writer.record("cli", None)
+    writer.record("file", json.dumps(PlainSerializer.encode(fragments)))
+
+RECORDERS = {"coq": record_coq, "lean4": record_lean4}
+REPLAYERS = {"coq": CoqReplay, "lean4": Lean4Replay}
+
+# Timing
+# ======
+
+class Stage(NamedTuple):
+    name: str
+    fn: Callable[[Any], Any]
+    setup: Optional[Callable[[], Any]] = None
+
+def time_stage(stage: Stage, repeat: int):
+    runs, result = [], None
+    for _ in range(repeat):
+        arg = stage.setup() if stage.setup else None
+        start = time.perf_counter()
+        result = stage.fn(arg)
+        runs.append(time.perf_counter() - start)
+    return result, {"min": min(runs), "median": statistics.median(runs), "runs": runs}
+
+SERIALIZERS = (PlainSerializer, DeduplicatingSerializer, FullyDeduplicatingSerializer)
+
+LOADERS = {
+    "sexp": {
+        "tokenize+parse": lambda bs: sx.parse(sx.tokenize(bs)),
+        "load": sx.load,
+        "load (lazy terms)": lambda bs: sx.load(bs, sx.TERM_RE),
+    },
+    "json": {
+        "loads+json_to_sexp": lambda bs: json_to_sexp(json.loads(bs)),
+    },
+}
+
+def time_parsing(path: Path, repeat: int) -> Dict[str, Any]:
+    """Time the parsing of the sertop responses recorded in `path`."""
+    responses = list(Transcript.load(path).events["read"])
+    transport = "json" if responses[0][:1] in (b'[', b'{') else "sexp"
+    size = sum(len(r) for r in responses)
+    stats: Dict[str, Any] = {}
+    for name, loader in LOADERS[transport].items():
+        parse_all = lambda _, load=loader: [load(r) for r in responses]
+        _, timings = time_stage(Stage(name, parse_all), repeat)
+        stats["{} {}".format(transport, name)] = \
+            {**timings, "MB/s": size / timings["min"] / 1e6}
+    if transport == "sexp":
+        eager = [sx.load(r) for r in responses]
+        lazy = [sx.load(r, sx.TERM_RE) for r in responses]
+        assert eager == [sx.parse(sx.tokenize(r)) for r in responses]
+        assert [sexp_hd(s) for s in eager] == [sexp_hd(s) for s in lazy]
+    return {"bytes": size, "responses": len(responses), "stages": stats}
+
+def run(spec: Spec, language: str, repeat: int, workdir: Path):
+    document, records = generate(spec, language)
+    fpath = workdir / ("bench" + EXTENSIONS[language])
+    fpath.write_text(document, encoding="utf-8")
+    CLIDriver.TRANSCRIPT_DIRECTORY = str(workdir / "transcripts")
+    cache_root = workdir / "cache"
+
+    results: Dict[str, Any] = {}
+    def timed(name, fn, setup=None):
+        try:
+            result, results[name] = time_stage(Stage(name, fn, setup), repeat)
+            return result
+        except Exception as e: # pylint: disable=broad-except
+            # Report broken stages instead of aborting the whole benchmark
+            results[name] = {"error": "{}: {}".format(type(e).__name__, e)}
+            return None
+
+    parts = timed("partition_literate", lambda _: cli.parse_literate(document, language))
+    chunks = [c.v for c in parts if isinstance(c, Code)]
+    RECORDERS[language](records, chunks, fpath)
+
+    if language == "coq":
+        transcript = transcript_path(CLIDriver.TRANSCRIPT_DIRECTORY, fpath, language)
+        results.update(time_parsing(transcript, repeat)["stages"])
+
+    driver = REPLAYERS[language](fpath=fpath)
+    annotated = timed("annotate (replay)", lambda _: driver.annotate(chunks))
+
+    if language == "coq": # Same, with sertop's JSON printer
+        CLIDriver.TRANSCRIPT_DIRECTORY = str(workdir / "transcripts-json")
+        record_coq(records, chunks, fpath, transport="json")
+        transcript = transcript_path(CLIDriver.TRANSCRIPT_DIRECTORY, fpath, language)
+        results.update(time_parsing(transcript, repeat)["stages"])
+        annotated_json = timed("annotate (replay, JSON transport)",
+                               lambda _: CoqReplay(fpath=fpath).annotate(chunks))
+        assert annotated_json == annotated
+    transformed = timed("transforms", lambda a: list(cli.apply_transforms(a, language)),
+                        lambda: copy.deepcopy(annotated))
+    timed("html", lambda a: cli.dump_html_snippets(
+        cli.gen_html_snippets(a, fpath.name, language, False, None)),
+          lambda: copy.deepcopy(transformed))
+    timed("latex", lambda a: cli.dump_latex_snippets(
+        cli.gen_latex_snippets(a, language, None)),
+          lambda: copy.deepcopy(transformed))
+
+    for serializer in SERIALIZERS:
+        name = serializer.__name__
+        encoded = timed("json encode ({})".format(name),
+                        lambda _, s=serializer: json.dumps(s.encode(annotated)))
+        if encoded is not None:
+            timed("json decode ({})".format(name),
+                  lambda _, s=serializer, e=encoded: s.decode(json.loads(e)))
+
+    metadata, info = driver.metadata, driver.version_info()
+    def clear_cache():
+        for f in cache_root.glob("**/*.cache*"):
+            f.unlink()
+    def write_cache(_, compression):
+        with FileCacheSet(cache_root, fpath, compression) as caches:
+            caches[language].put(chunks, metadata, annotated, info)
+    def read_cache(_, compression):
+        with FileCacheSet(cache_root, fpath, compression) as caches:
+            return caches[language].get(chunks, metadata)
+    edited = chunks[:-1] + [chunks[-1] + " "]
+    def check_cache(_, compression):
+        # A miss, as when the last chunk was edited; only validation happens
+        with FileCacheSet(cache_root, fpath, compression) as caches, \
+             contextlib.redirect_stdout(io.StringIO()):
+            return caches[language].lookup(edited, metadata)
+    for compression in (None, "binary"):
+        suffix = " ({})".format(compression) if compression else ""
+        timed("cache write" + suffix, lambda _, c=compression: write_cache(_, c), clear_cache)
+        timed("cache read" + suffix, lambda _, c=compression: read_cache(_, c))
+        timed("cache miss" + suffix, lambda _, c=compression: check_cache(_, c))
+
+    return {"document": {"bytes": len(document.encode("utf-8")),
+                         "chunks": len(chunks), "sentences": len(records)},
+            "stages": results}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--language", choices=sorted(BUILDERS), default="coq")
+    parser.add_argument("--sentences", type=int, default=2000)
+    parser.add_argument("--goals", type=int, default=2,
+                        help="Number of goals at each proof step.")
+    parser.add_argument("--hypotheses", type=int, default=8,
+                        help="Number of hypotheses in each goal.")
+    parser.add_argument("--comment-density", type=float, default=0.25,
+                        help="Fraction of sentences followed by a comment.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each stage.")
+    parser.add_argument("--transcript", type=Path, default=None,
+                        help="Only time the parsing of the sertop "
+                        "responses of a transcript recorded with "
+                        "``alectryon --record-transcripts``.")
+    parser.add_argument("-o", "--output", default="-",
+                        help="Where to write results (default: stdout).")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    spec = Spec(args.sentences, args.goals, args.hypotheses, args.comment_density)
+    if args.transcript:
+        results = {"transcript": str(args.transcript),
+                   **time_parsing(args.transcript, args.repeat)}
+        header = {}
+    else:
+        with tempfile.TemporaryDirectory(prefix="alectryon_bench") as workdir:
+            results = run(spec, args.language, args.repeat, Path(workdir))
+        header = {"language": args.language, "spec": spec._asdict()}
+    report = {"alectryon": __version__, "python": platform.python_version(),
+              **header, "repeat": args.repeat, **results}
+
+    for name, timings in results["stages"].items():
+        summary = ("{:9.4f}s".format(timings["min"]) if "min" in timings
+                   else timings["error"].splitlines()[0][:60])
+        if "MB/s" in timings:
+            summary += " ({:.1f} MB/s)".format(timings["MB/s"])
+        print("{:<45} {}".format(name, summary), file=sys.stderr)
+    js = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(js)
+    else:
+        Path(args.output).write_text(js + "\n", encoding="utf-8")
+
+if __name__ == '__main__':
+    main()
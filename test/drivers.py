@@ -0,0 +1,37 @@
+"""Drivers shared by tests that do not need a real prover."""
+
+import re
+
+from alectryon.core import Driver, Sentence, Text
+
+class SplittingDriver(Driver):
+    """Annotate each chunk as a list of sentences, segmented at ``Reset.``.
+
+    Sentences starting with ``Fail`` produce a warning, and requests to
+    annotate suffixes of documents are recorded.
+    """
+    SEGMENT_RE = re.compile(r"^Reset[.]", re.MULTILINE)
+    metadata = {"args": ()}
+
+    def __init__(self):
+        super().__init__()
+        self.suffixes = []
+
+    @classmethod
+    def version_info(cls, binpath=None):
+        return ("test", "0")
+
+    def _annotate_one(self, chunk):
+        sentences = re.findall(r"\s+|[^.\s][^.]*[.]", chunk)
+        for s in sentences:
+            if s.startswith("Fail"):
+                self.observer.notify(s, "failure", None, 2)
+        return [Text(s) if s.isspace() else Sentence(s, [], [])
+                for s in sentences]
+
+    def annotate(self, chunks):
+        return [self._annotate_one(c) for c in chunks]
+
+    def annotate_suffix(self, chunks, start):
+        self.suffixes.append(chunks[start:])
+        return self.annotate(chunks[start:])
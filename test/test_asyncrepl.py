@@ -0,0 +1,70 @@
+import asyncio
+import sys
+import unittest
+
+from alectryon.asyncrepl import AsyncREPL, ProverTimeout
+from alectryon.core import REPLDriver, DriverPool
+
+ECHO = """
+import sys, time
+for line in sys.stdin:
+    if line.startswith("sleep"):
+        time.sleep(5)
+    sys.stdout.write(line.upper())
+    sys.stdout.flush()
+"""
+
+class AsyncEcho(AsyncREPL, REPLDriver):
+    BIN = sys.executable
+    REPL_ARGS = ("-u", "-c", ECHO)
+    READ_TIMEOUT = 2
+
+    def rewind(self):
+        pass
+
+    def annotate(self, chunks):
+        with self:
+            out = []
+            for chunk in chunks:
+                self._write(chunk.encode(), b"\n")
+                out.append(self._read().decode().strip())
+            return out
+
+class TestAsyncREPL(unittest.TestCase):
+    def test_roundtrip(self):
+        self.assertEqual(AsyncEcho().annotate(["a", "b"]), ["A", "B"])
+
+    def test_timeout(self):
+        with self.assertRaises(ProverTimeout):
+            AsyncEcho().annotate(["sleep"])
+
+    def test_multiplexing(self):
+        async def run_all():
+            drivers = [AsyncEcho() for _ in range(4)]
+            return await asyncio.gather(*(d.annotate_async(["x{}".format(i)])
+                                          for i, d in enumerate(drivers)))
+        self.assertEqual(asyncio.run(run_all()), [["X0"], ["X1"], ["X2"], ["X3"]])
+
+    def test_read(self):
+        driver = AsyncEcho()
+        with driver:
+            driver._write(b"a", b"\n")
+            # The prover is still running: return what it printed so far
+            self.assertEqual(driver.repl.stdout.read(timeout=0.5), b"A\n")
+
+    def test_pool(self):
+        with DriverPool() as pool:
+            AsyncEcho.POOL = pool
+            try:
+                first, second = AsyncEcho(), AsyncEcho()
+                self.assertEqual(first.annotate(["a"]), ["A"])
+                [[repl]] = pool.idle.values()
+                self.assertIsNone(repl.poll())
+                self.assertEqual(second.annotate(["b"]), ["B"])
+                self.assertEqual(pool.idle[pool._key(second)], [repl]) # Reused
+            finally:
+                AsyncEcho.POOL = None
+        self.assertIsNotNone(repl.poll())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from os import path, makedirs
+
+from alectryon.cli import PIPELINES, annotate_chunks, find_prewarm_inputs, \
+    resolve_prewarm_pipeline
+
+from test_serapi import FAKE_SERTOP
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+class TestPrewarm(unittest.TestCase):
+    def test_find_inputs(self):
+        with tempfile.TemporaryDirectory() as root:
+            for fname in ("a.v", "b/c.rst", "b/d.lean", "b/e.html", "b/f.v.json", ".git/g.v"):
+                fpath = path.join(root, fname)
+                makedirs(path.dirname(fpath), exist_ok=True)
+                open(fpath, mode="w", encoding="utf-8").close()
+            found = [path.relpath(f, root) for f in find_prewarm_inputs([root])]
+            self.assertEqual(found, ["a.v", path.join("b", "c.rst"), path.join("b", "d.lean")])
+
+    def test_pipelines(self):
+        class Args:
+            frontend = None
+        self.assertEqual(resolve_prewarm_pipeline("a.v", Args)[:2], ("coq+rst", "null"))
+        Args.frontend = "coq"
+        _, _, steps = resolve_prewarm_pipeline("a.v", Args)
+        self.assertEqual(steps[-1], annotate_chunks)
+        for frontend in ("rst", "md", "coq+markup", "coqdoc", "lean4+rst"):
+            self.assertIn("null", PIPELINES[frontend])
+
+    def test_prewarm(self):
+        with tempfile.TemporaryDirectory() as root:
+            makedirs(path.join(root, "bin"))
+            makedirs(path.join(root, "src", "sub"))
+            sertop = path.join(root, "bin", "sertop")
+            with open(sertop, mode="w", encoding="utf-8") as f:
+                f.write("#!{} -u\n{}".format(sys.executable, FAKE_SERTOP))
+            os.chmod(sertop, 0o755)
+            for fname, contents in (("a.v", "Check 1. Check 2."), ("sub/b.v", "Check 3.")):
+                with open(path.join(root, "src", fname), mode="w", encoding="utf-8") as f:
+                    f.write(contents)
+
+            env = {**os.environ, "PYTHONPATH": ROOT,
+                   "PATH": os.pathsep.join((path.join(root, "bin"), os.environ["PATH"]))}
+            subprocess.run(
+                [sys.executable, "-m", "alectryon", "--prewarm=1", "--reuse-provers",
+                 "--cache-directory", "cache", "src"],
+                cwd=root, env=env, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                check=True, timeout=60)
+
+            caches = {}
+            for fname in ("a.v", "sub/b.v"):
+                with open(path.join(root, "cache", "src", fname + ".cache"), encoding="utf-8") as f:
+                    caches[fname] = json.load(f)["&coq"]
+        self.assertEqual(caches["a.v"]["chunks"], ["Check 1. Check 2."])
+        self.assertEqual(caches["sub/b.v"]["chunks"], ["Check 3."])
+        for cache in caches.values(): # Provers come from the workers' pools
+            self.assertEqual(cache["metadata"]["topfile"], "Top.v")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 
+from alectryon import core
 from alectryon.core import *
 
 class TestFragmentContent(unittest.TestCase):
@@ -172,5 +173,25 @@ class TestFragmentContent(unittest.TestCase):
         self.assertEqual(second, FragmentContent([FragmentToken("<"), FragmentToken(">")]))
         self.assertEqual(third, FragmentContent([FragmentToken("d"), FragmentToken("s")]))
 
+class TestProfiler(unittest.TestCase):
+    def test_nested_sections(self):
+        profiler = Profiler()
+        with profiler.section("step", "outer", fpath="a.v"):
+            for _ in range(2):
+                with profiler.section("driver", "inner"):
+                    pass
+        self.assertEqual([r["name"] for r in profiler.records],
+                         ["inner", "inner", "outer"])
+        self.assertEqual(profiler.records[-1]["fpath"], "a.v")
+        self.assertIsNone(profiler.records[-1]["peak_memory"])
+        summary = {t["name"]: t for t in profiler.summary()}
+        self.assertEqual(summary["inner"]["calls"], 2)
+        self.assertGreaterEqual(summary["outer"]["wall"], summary["inner"]["wall"])
+
+    def test_profiled_disabled(self):
+        self.assertIsNone(core.PROFILER)
+        with profiled("step", "noop"):
+            pass
+
 if __name__ == '__main__':
     unittest.main()
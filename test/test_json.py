@@ -0,0 +1,287 @@
+import io
+import json
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from os import listdir, path, unlink
+
+import alectryon.json
+from alectryon.core import Sentence, Text, Timing
+from alectryon.json import Cache, CacheStats, FileCacheSet, SQLiteCacheSet, SharedStore, Sections, \
+    PlainSerializer, DeduplicatingSerializer, FullyDeduplicatingSerializer, \
+    _JSONStreamReader, load_stream, dump_stream, file_lock
+from drivers import SplittingDriver
+
+class TestCache(unittest.TestCase):
+    def test_incremental_update(self):
+        cache, driver = Cache(None, None), SplittingDriver()
+        chunks = ["A. B.", "C. D."]
+        cache.update(chunks, driver)
+        self.assertEqual(driver.suffixes, [])
+
+        annotated = cache.update(["A. B.", "C. E."], driver)
+        self.assertEqual(driver.suffixes, [["E."]])
+        self.assertEqual(annotated, driver.annotate(["A. B.", "C. E."]))
+
+        annotated = cache.update(["A. B."], driver)
+        self.assertEqual(len(driver.suffixes), 1)
+        self.assertEqual(annotated, driver.annotate(["A. B."]))
+
+    def test_update_iter(self):
+        cache, driver = Cache(None, None), SplittingDriver()
+        stream = cache.update_iter(["A.", "B."], driver)
+        first = next(stream)
+        self.assertIsNone(cache.data) # Written after the last chunk
+        first.append(Text("modified"))
+        self.assertEqual(list(stream), driver.annotate(["B."]))
+        self.assertEqual(cache.get(["A.", "B."], driver.metadata),
+                         driver.annotate(["A.", "B."]))
+
+class TestCacheStats(unittest.TestCase):
+    def setUp(self):
+        alectryon.json.STATS = CacheStats()
+
+    def test_reasons(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver, doc = SplittingDriver(), path.join(root, "a.v")
+            with redirect_stdout(io.StringIO()) as out:
+                for chunks in (["A. B."], ["A. B."], ["A. C."], ["D."]):
+                    with FileCacheSet(root, doc, None) as caches:
+                        caches["coq"].update(chunks, driver)
+                driver.metadata = {"args": ["-v"]}
+                with FileCacheSet(root, doc, None) as caches:
+                    caches["coq"].update(["D."], driver)
+        self.assertEqual(out.getvalue().count("Outdated"), 3) # Reported once per miss
+        stats = alectryon.json.STATS
+        self.assertEqual(stats.hits, 1)
+        self.assertEqual(stats.misses, {"missing": 1, "chunks": 2, "metadata": 1})
+        self.assertEqual(stats.reuses, {"incremental": 1})
+        self.assertGreater(stats.bytes_read, 0)
+        self.assertGreater(stats.bytes_written, 0)
+
+    def test_version(self):
+        with tempfile.TemporaryDirectory() as root:
+            doc = path.join(root, "a.v")
+            with open(doc + ".cache", mode="w", encoding="utf-8") as f:
+                json.dump({"metadata": {"cache_version": "0"}}, f)
+            caches = FileCacheSet(root, doc, None)
+            self.assertEqual(caches["coq"]._staleness(["A."], {}), "version")
+
+class CountingCacheSet(FileCacheSet):
+    writes = 0
+
+    def _force_write(self, js):
+        CountingCacheSet.writes += 1
+        super()._force_write(js)
+
+class TestFileCacheSet(unittest.TestCase):
+    def test_dirty_tracking(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver, doc = SplittingDriver(), path.join(root, "a.v")
+            for chunks, writes in ((["A."], 1), (["A."], 1), (["B."], 2)):
+                with CountingCacheSet(root, doc, None) as caches:
+                    caches["coq"].update(chunks, driver)
+                self.assertEqual(CountingCacheSet.writes, writes)
+
+    def test_digests(self):
+        data = {"driver": ["test", "0"], "metadata": {"args": []},
+                "chunks": ["A."], "annotated": [[]]}
+        cache = Cache(dict(data), None) # No digests: computed on load
+        self.assertFalse(cache.dirty)
+        self.assertEqual(cache.get(["A."], {"args": ()}), [[]])
+        self.assertIsNone(cache.get(["B."], {"args": ()}))
+
+    def test_digests_on_disk(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver, doc = SplittingDriver(), path.join(root, "a.v")
+            with FileCacheSet(root, doc, None) as caches:
+                caches["coq"].update(["A."], driver)
+            with open(doc + ".cache", encoding="utf-8") as f:
+                js = json.load(f)
+            del js["&coq"]["digests"]
+            with open(doc + ".cache", mode="w", encoding="utf-8") as f:
+                json.dump(js, f)
+            with open(doc + ".cache", encoding="utf-8") as f:
+                before = f.read()
+            with FileCacheSet(root, doc, None) as caches: # Hit: not rewritten
+                caches["coq"].update(["A."], driver)
+            with open(doc + ".cache", encoding="utf-8") as f:
+                self.assertEqual(f.read(), before)
+            with FileCacheSet(root, doc, None) as caches:
+                caches["coq"].update(["B."], driver)
+            with open(doc + ".cache", encoding="utf-8") as f:
+                self.assertIn("digests", json.load(f)["&coq"])
+
+    def test_binary_format(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver, doc = SplittingDriver(), path.join(root, "a.v")
+            expected = driver.annotate(["A. B.", "C. E."])
+            for chunks, compression in ((["A. B.", "C. D."], "binary"),
+                                        (["A. B.", "C. E."], "binary"), # Incremental
+                                        (["A. B.", "C. E."], "none"),
+                                        (["A. B.", "C. E."], "binary")):
+                with FileCacheSet(root, doc, compression) as caches:
+                    annotated = caches["coq"].update(chunks, driver)
+            self.assertEqual(annotated, expected)
+            self.assertEqual(driver.suffixes, [["E."]])
+            self.assertFalse(path.exists(doc + ".cache"))
+            caches = FileCacheSet(root, doc, "binary")
+            self.assertIsInstance(caches.js["&coq"]["annotated"], Sections)
+            self.assertEqual(caches["coq"].get(["A. B.", "C. E."], driver.metadata), expected)
+            caches._close()
+
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver, doc = SplittingDriver(), path.join(root, "a.v")
+            for compression in ("none", "binary"):
+                first = FileCacheSet(root, doc, compression)
+                with FileCacheSet(root, doc, compression) as second:
+                    second["lean3"].update(["B."], driver)
+                first["coq"].update(["A."], driver)
+                first.__exit__(None, None, None)
+                caches = FileCacheSet(root, doc, compression)
+                self.assertEqual(sorted(caches.caches), ["coq", "lean3"])
+                caches._close()
+            self.assertEqual([f for f in listdir(root) if f.endswith(".lock")], [])
+
+    def test_lock(self):
+        with tempfile.TemporaryDirectory() as root:
+            lock, holders, overlaps = path.join(root, "a.lock"), [], []
+            def work():
+                for _ in range(20):
+                    with file_lock(lock):
+                        overlaps.append(len(holders))
+                        holders.append(None)
+                        time.sleep(0.001)
+                        holders.pop()
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(overlaps, [0] * 80)
+            self.assertFalse(path.exists(lock))
+
+    def test_upgrade(self):
+        v2 = {"metadata": {"cache_version": "2"}, "&coq": {}}
+        self.assertEqual(FileCacheSet._upgrade(dict(v2)), v2)
+        v1 = {"metadata": {"cache_version": "1", "args": []}, "generator": ["coq", "0"],
+              "chunks": [], "annotated": []}
+        self.assertEqual(FileCacheSet._upgrade(v1),
+                         {"metadata": FileCacheSet.METADATA,
+                          "&coq": {"driver": ["coq", "0"], "metadata": {"args": []},
+                                   "chunks": [], "annotated": []}})
+
+class TestSQLiteCacheSet(unittest.TestCase):
+    def tearDown(self):
+        SQLiteCacheSet.MAX_SIZE = None
+
+    @staticmethod
+    def _update(root, doc, chunks, driver, compression=None):
+        with SQLiteCacheSet(root, path.join(root, doc), compression) as caches:
+            return caches["coq"].update(chunks, driver)
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver = SplittingDriver()
+            for compression in (None, "gzip", "xz"):
+                self._update(root, "a.v", ["A. B.", "C."], driver, compression)
+                annotated = self._update(root, "a.v", ["A. B.", "D."], driver, compression)
+                self.assertEqual(annotated, driver.annotate(["A. B.", "D."]))
+            self.assertEqual(driver.suffixes, [["D."], ["C."], ["D."], ["C."], ["D."]])
+            self._update(root, "b.v", ["A. B.", "D."], driver) # Same contents as a.v
+            self.assertEqual(len(driver.suffixes), 5)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver = SplittingDriver()
+            self._update(root, "a.v", ["A."], driver)
+            self._update(root, "b.v", ["B."], driver)
+            SQLiteCacheSet.MAX_SIZE = 1
+            self._update(root, "c.v", ["C."], driver)
+            caches = SQLiteCacheSet(root, path.join(root, "a.v"), None)
+            documents = caches.db.execute("SELECT document FROM caches").fetchall()
+            self.assertEqual(documents, [("c.v",)])
+            caches.db.close()
+
+class TestSharedStore(unittest.TestCase):
+    def setUp(self):
+        FileCacheSet.SHARED_STORE = True
+
+    def tearDown(self):
+        FileCacheSet.SHARED_STORE = False
+
+    @staticmethod
+    def _update(root, doc, chunks, driver):
+        with FileCacheSet(root, path.join(root, doc), None) as caches:
+            return caches["coq"].update(chunks, driver)
+
+    def test_sharing(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver = SplittingDriver()
+            self._update(root, "a.v", ["A.", "B.", "C."], driver)
+            annotated = self._update(root, "b.v", ["A.", "B.", "D."], driver)
+            self.assertEqual(driver.suffixes, [["D."]])
+            self.assertEqual(annotated, driver.annotate(["A.", "B.", "D."]))
+            self._update(root, "c.v", ["A.", "B.", "C."], driver)
+            self.assertEqual(len(driver.suffixes), 1)
+
+            store = SharedStore(root)
+            self.assertEqual(store.collect_garbage(), 0)
+            unlink(path.join(root, "b.v.cache"))
+            self.assertEqual(store.collect_garbage(), 1) # "D."
+            keys = store.keys("coq", driver.metadata, ["A.", "B.", "C."])
+            self.assertTrue(all(store.get(k) for k in keys))
+
+    def test_empty_document(self):
+        with tempfile.TemporaryDirectory() as root:
+            driver = SplittingDriver()
+            self.assertEqual(self._update(root, "a.v", [], driver), [])
+            self.assertEqual(self._update(root, "a.v", [], driver), [])
+
+    def test_keys(self):
+        k1 = SharedStore.keys("coq", {}, ["A", "B"])
+        self.assertEqual(k1[0], SharedStore.keys("coq", {}, ["A"])[0])
+        self.assertNotEqual(k1[1], SharedStore.keys("coq", {}, ["AB"])[0])
+        self.assertNotEqual(k1, SharedStore.keys("lean3", {}, ["A", "B"]))
+
+class TestStreaming(unittest.TestCase):
+    DOCUMENTS = ({"metadata": {"v": 1.5e-7}, "&coq": {"chunks": ["A.", ""], "annotated": [[{"a": [1]}], []]}},
+                 [[], {}, [[1, 2], [-3.25e+10]]], 12345, "str\n\"ing")
+
+    def setUp(self):
+        _JSONStreamReader.BLOCK_SIZE = 3 # Split values across blocks
+
+    def tearDown(self):
+        _JSONStreamReader.BLOCK_SIZE = 1 << 16
+
+    def test_roundtrip(self):
+        for js in self.DOCUMENTS:
+            for depth in (0, 1, 3):
+                out = io.StringIO()
+                dump_stream(js, out, depth)
+                self.assertEqual(json.loads(out.getvalue()), js)
+                self.assertEqual(load_stream(io.StringIO(out.getvalue()), depth), js)
+                indented = io.StringIO(json.dumps(js, indent=2))
+                self.assertEqual(load_stream(indented, depth), js)
+
+    def test_errors(self):
+        for doc in ("", "[1,", "[1 2]", '{"a" 1}', "{1: 2}", "[1] 2", "// Comment\n1"):
+            with self.assertRaises(json.JSONDecodeError):
+                load_stream(io.StringIO(doc))
+
+class TestSerializers(unittest.TestCase):
+    SERIALIZERS = (PlainSerializer, DeduplicatingSerializer, FullyDeduplicatingSerializer)
+
+    def test_optional_timings(self):
+        untimed = [Sentence("A.", [], [])]
+        timed = [Sentence("A.", [], [], Timing(0.5, 1.25, 0.0, None))]
+        for serializer in self.SERIALIZERS:
+            self.assertNotIn("timing", str(serializer.encode(untimed)))
+            self.assertEqual(serializer.decode(serializer.encode(untimed)), untimed)
+            self.assertEqual(serializer.decode(serializer.encode(timed)), timed)
+
+if __name__ == '__main__':
+    unittest.main()
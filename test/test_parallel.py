@@ -0,0 +1,60 @@
+import unittest
+from typing import List
+
+from alectryon.core import Message, Observer, Sentence, Text
+from alectryon.literate import CoqParser
+from alectryon.parallel import SegmentedAnnotator
+from alectryon.serapi import SerAPI
+from drivers import SplittingDriver
+
+class RecordingObserver(Observer):
+    def __init__(self):
+        self.messages = []
+
+    def _notify(self, n):
+        self.messages.append(n.message)
+
+class ConfiguredDriver(SplittingDriver):
+    MESSAGES: List[Message] = []
+
+    def _annotate_one(self, chunk):
+        return [Sentence(fr.contents, self.MESSAGES, []) if isinstance(fr, Sentence) else fr
+                for fr in super()._annotate_one(chunk)]
+
+def configure(messages):
+    ConfiguredDriver.MESSAGES = messages
+
+class TestSegmentedAnnotator(unittest.TestCase):
+    def test_annotate(self):
+        driver = SplittingDriver()
+        driver.observer = RecordingObserver()
+        chunks = ["A. B.\nReset. C.", "D. Fail E.", "Reset. F."]
+        expected = SplittingDriver().annotate(chunks)
+        annotated = SegmentedAnnotator(jobs=2).annotate(driver, chunks)
+        self.assertEqual(annotated, expected)
+        self.assertEqual(driver.observer.messages, ["failure"])
+
+    def test_initializer(self):
+        msgs = [Message("configured")]
+        annotator = SegmentedAnnotator(jobs=2, initializer=configure, initargs=(msgs,))
+        annotated = annotator.annotate(ConfiguredDriver(), ["A.\nReset.", "B."])
+        self.assertEqual(annotated, [
+            [Sentence("A.", msgs, []), Text("\n"), Sentence("Reset.", msgs, [])],
+            [Sentence("B.", msgs, [])]])
+        self.assertEqual(ConfiguredDriver.MESSAGES, [])
+
+    def test_comments(self):
+        chunks = ["A.\n(* Old code:\nReset Initial.\n*)\nB.\n(* alectryon-segment *)\nC."]
+        segments = SegmentedAnnotator.split(chunks, SerAPI.SEGMENT_RE, CoqParser)
+        self.assertEqual(segments, [["A.\n(* Old code:\nReset Initial.\n*)\nB.\n"],
+                                    ["(* alectryon-segment *)\nC."]])
+        unterminated = ["A.\n(* B.\nReset Initial."]
+        self.assertEqual(SegmentedAnnotator.split(unterminated, SerAPI.SEGMENT_RE, CoqParser),
+                         [unterminated])
+
+    def test_single_segment(self):
+        driver = SplittingDriver()
+        self.assertIsNone(SegmentedAnnotator().annotate(driver, ["A.", "B."]))
+
+if __name__ == '__main__':
+    unittest.main()
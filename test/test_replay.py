@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from alectryon.core import CLIDriver
+from alectryon.replay import Replaying, Transcript, TranscriptMismatch, \
+    TranscriptWriter, transcript_path
+
+class EchoDriver(CLIDriver):
+    ID = "echo"
+    LANGUAGE = "coq"
+
+class ReplayingEchoDriver(Replaying, EchoDriver):
+    pass
+
+class TestTranscripts(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            driver = EchoDriver(("-q",), fpath="dir/doc.v")
+            writer = TranscriptWriter(driver, directory)
+            writer.record("write", bytearray(b"(Add \xce\xbb)\n"))
+            writer.record("read", b"(Answer \xff)\n")
+            writer.record("cli", "out")
+            writer.close()
+            transcript = Transcript.load(writer.path)
+
+        self.assertEqual((transcript.driver, transcript.args), ("echo", ["-q"]))
+        replayed = ReplayingEchoDriver()
+        replayed.replayed = transcript
+        replayed._write(b"(Add \xce\xbb)", b"\n")
+        self.assertEqual(replayed._read(), b"(Answer \xff)\n")
+        self.assertEqual(replayed.run_cli(), "out")
+        with self.assertRaises(TranscriptMismatch):
+            replayed._read()
+
+    def test_paths(self):
+        with tempfile.TemporaryDirectory() as root:
+            directory = Path(root) / "transcripts"
+            paths = [transcript_path(str(directory), Path(root) / d / "doc.v", "coq")
+                     for d in ("a", "b")]
+        self.assertEqual(paths, [directory / "a" / "doc.v.coq.transcript",
+                                 directory / "b" / "doc.v.coq.transcript"])
+        self.assertEqual(transcript_path("tr", Path("-"), "coq"),
+                         Path("tr") / "-.coq.transcript")
+
+    def test_reopen(self):
+        with tempfile.TemporaryDirectory() as directory:
+            driver = EchoDriver(fpath=Path(directory) / "doc.v")
+            driver.TRANSCRIPT_DIRECTORY = directory
+            driver._record("write", "a")
+            driver.close_transcript()
+            driver._record("read", "b")
+            driver.close_transcript()
+            transcript = Transcript.load(driver.transcript.path)
+        self.assertEqual([list(transcript.events[k]) for k in ("write", "read")],
+                         [["a"], ["b"]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,389 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from collections import deque
+from pathlib import Path
+
+from alectryon import sexp as sx
+from alectryon.core import DriverPool, Goal, Hypothesis, Message, Observer, PrettyPrinted, Sentence, Text, \
+    Timing
+from alectryon.serapi import ApiAdded, ApiExn, ApiMessage, PrintBatch, PrintMemo, PrintStats, SerAPI
+
+class RecordingAPI:
+    def __init__(self):
+        self.print_stats = PrintStats()
+        self.print_memo = PrintMemo(2)
+        self.sent = []
+
+    def _pprint(self, sexp, sid, kind, pp_depth, pp_margin):
+        self.sent.append(sexp)
+        pp = "pp{}".format(len(self.sent))
+        return lambda: PrettyPrinted(sid, pp)
+
+class TestPrintBatch(unittest.TestCase):
+    def test_deduplication(self):
+        api = RecordingAPI()
+        batch = PrintBatch(api)
+        a1 = batch.add(b"A", b"1", b"CoqExpr", 30, 55)
+        b = batch.add(b"B", b"1", b"CoqExpr", 30, 55)
+        a2 = batch.add(b"A", b"1", b"CoqExpr", 30, 55)
+        a3 = batch.add(b"A", b"1", b"CoqExpr", 30, 20)
+        none = batch.add(None, b"1", b"CoqExpr", 30, 55)
+        batch.run()
+        self.assertEqual([a1(), b(), a2(), a3(), none()],
+                         ["pp1", "pp2", "pp1", "pp3", None])
+        self.assertEqual(api.sent, [b"A", b"B", b"A"])
+        self.assertEqual((api.print_stats.requested, api.print_stats.printed,
+                          api.print_stats.batches), (4, 3, 1))
+
+    def test_memoization(self):
+        api = RecordingAPI()
+        for sid in (b"1", b"2"):
+            batch = PrintBatch(api)
+            a = batch.add(b"A", sid, b"CoqExpr", 30, 55, ("x",))
+            evar = batch.add([b"Evar", b"1"], sid, b"CoqExpr", 30, 55)
+            batch.run()
+            self.assertEqual(a(), "pp1")
+        self.assertEqual(api.sent, [b"A", [b"Evar", b"1"], [b"Evar", b"1"]])
+        self.assertEqual(api.print_stats.memoized, 1)
+
+    def test_memoization_lazy(self):
+        api = RecordingAPI()
+        goal = sx.load(b'(CoqGoal (ty (App (Evar (1 ())) (Var (Id x)))))', sx.TERM_RE)
+        term = goal[1][1]
+        self.assertIsInstance(term, sx.Lazy)
+        for sid in (b"1", b"2"):
+            batch = PrintBatch(api)
+            batch.add(term, sid, b"CoqConstr", 30, 55)
+            batch.run()
+        self.assertEqual(api.sent, [term, term])
+        self.assertEqual(api.print_stats.memoized, 0)
+
+class TestPrintMemo(unittest.TestCase):
+    def test_eviction(self):
+        memo = PrintMemo(2)
+        memo.put("a", "A")
+        memo.put("b", "B")
+        self.assertEqual(memo.get("a"), "A")
+        memo.put("c", "C")
+        self.assertEqual((memo.get("a"), memo.get("b"), memo.get("c")), ("A", None, "C"))
+
+class RecordingSerAPI(SerAPI):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def _pprint(self, sexp, sid, kind, pp_depth, pp_margin):
+        self.sent.append(sexp)
+        pp = "pp{}".format(len(self.sent))
+        return lambda: PrettyPrinted(sid, pp)
+
+class TestGoalReuse(unittest.TestCase):
+    @staticmethod
+    def _goals(api, goals, print_neutral=True):
+        batch = PrintBatch(api)
+        printed = api._sentence_goals(b"1", goals, print_neutral, batch)
+        batch.run()
+        return printed()
+
+    def test_reuse(self):
+        api = RecordingSerAPI()
+        goals = [Goal(None, b"A", [Hypothesis(["x"], None, b"B")])]
+        printed = self._goals(api, goals)
+        self.assertEqual(printed, [Goal(None, "pp1", [Hypothesis(["x"], None, "pp2")])])
+        self.assertEqual(self._goals(api, None), printed) # Skipped query
+        self.assertEqual(self._goals(api, list(goals)), printed) # Same goals
+        self.assertEqual(api.sent, [b"A", b"B"])
+        self.assertEqual((api.goal_stats.skipped, api.goal_stats.reused), (1, 1))
+
+        self._goals(api, goals, print_neutral=False)
+        self._goals(api, [Goal(None, [b"Evar", b"1"], [])])
+        self._goals(api, [Goal(None, [b"Evar", b"1"], [])])
+        self.assertEqual(api.goal_stats.reused, 1)
+
+    def test_lazy_evars(self):
+        api = RecordingSerAPI()
+        evar, x = sx.load(b'(CoqGoal ((App (Evar (1 ())) (Var (Id x))) (Var (Id x))))',
+                          sx.TERM_RE)[1]
+        self.assertIsInstance(evar, sx.Lazy)
+        goals = [Goal(None, evar, [Hypothesis(["x"], None, x)])]
+        self._goals(api, goals)
+        self._goals(api, goals) # Not reused: the evar may have been instantiated
+        self.assertEqual(api.sent, [evar, x, evar])
+        self.assertEqual((api.goal_stats.reused, api.print_stats.memoized), (0, 1))
+
+class ScriptedSerAPI(SerAPI):
+    def __init__(self, responses):
+        super().__init__()
+        self.script = list(responses)
+
+    def _read(self):
+        return self.script.pop(0)
+
+class TestResponses(unittest.TestCase):
+    def test_ignored_responses(self):
+        api = ScriptedSerAPI([
+            b'(Answer query0 Ack)',
+            b'(Feedback((doc_id 0)(span_id 2)(route 0)(contents(ProcessingIn master))))',
+            b'(Feedback((doc_id 0)(span_id 2)(route 0)(contents(Message(level Notice)'
+            b'(loc())(pp(Pp_string hi))(str hi)))))',
+            b'(Feedback((doc_id 0)(span_id 2)(route 0)(contents Processed)))',
+            b'(Answer query0 Completed)'])
+        api.pending.append((b'query0', 0))
+        api.responses[b'query0'] = deque()
+        messages = list(api._collect_messages((ApiMessage,), None, None, b'query0'))
+        self.assertEqual(messages, [ApiMessage(b'2', b'Notice', [b'Pp_string', b'hi'])])
+        self.assertEqual(api.script, [])
+
+    def test_json_responses(self):
+        api = ScriptedSerAPI([
+            b'["Answer","query0",["Ack"]]',
+            b'["Answer","query0",["Added",2,{"bp":0,"ep":8},["NewTip"]]]',
+            b'["Feedback",{"doc_id":0,"span_id":2,"route":0,"contents":'
+            b'["Message",{"level":["Notice"],"loc":null,"pp":["Pp_string","hi"],"str":"hi"}]}]',
+            b'["Answer","query0",["CoqExn",{"loc":null,"stm_ids":[2,2],"str":"Oops"}]]',
+            b'["Answer","query0",["Completed"]]'])
+        api.pending.append((b'query0', 0))
+        api.responses[b'query0'] = deque()
+        responses = list(api._collect_messages(
+            (ApiAdded, ApiMessage, ApiExn), None, None, b'query0'))
+        self.assertEqual(responses, [
+            ApiAdded(b'2', (0, 8)),
+            ApiMessage(b'2', b'Notice', [b'Pp_string', b'hi']),
+            ApiExn([b'2', b'2'], b'Oops', None)])
+
+class TestJSONTerms(unittest.TestCase):
+    HYP = b'(Ind (((MutInd (MPfile (DirPath ((Id Datatypes) (Id Init) (Id Coq)))) (Id nat)) 0)' \
+          b' (Instance ())))'
+    TY = (b'(Prod ((binder_name (Name (Id y))) (binder_relevance Relevant)) ' + HYP +
+          b' (App (Evar (1 ())) ((Rel 1) (Var (Id x)))))')
+    SEXP = (b'(Answer query0 (ObjList ((CoqExtGoal ((goals (((info ((evar (Ser_Evar 4))'
+            b' (name ()))) (ty ' + TY + b') (hyp ((((Id x)) () ' + HYP + b')))))) (stack ())'
+            b' (bullet ()) (shelf ()) (given_up ()))))))')
+
+    JSON_HYP = ('["Ind",[[["MutInd",["MPfile",["DirPath",[["Id","Datatypes"],["Id","Init"],'
+                '["Id","Coq"]]]],["Id","nat"]],0],["Instance",[]]]]')
+    JSON_TY = ('["Prod",{"binder_name":["Name",["Id","y"]],"binder_relevance":["Relevant"]},'
+               + JSON_HYP + ',["App",["Evar",[1,[]]],[["Rel",1],["Var",["Id","x"]]]]]')
+    JSON = ('["Answer","query0",["ObjList",[["CoqExtGoal",{"goals":[{"info":{"evar":'
+            '["Ser_Evar",4],"name":null},"ty":' + JSON_TY + ',"hyp":[[[["Id","x"]],null,'
+            + JSON_HYP + ']]}],"stack":[],"bullet":null,"shelf":[],"given_up":[]}]]]]').encode()
+
+    @staticmethod
+    def _print_goal(response, answers):
+        api = ScriptedSerAPI([response, *answers])
+        api.written = []
+        api._write = lambda s, end: api.written.append(sx.load(bytes(s)))
+        api.next_qid = 1
+        api.pending.append((b'query0', 0))
+        api.responses[b'query0'] = deque()
+        [goal] = api._collect_messages((Goal,), None, None, b'query0')
+        ty = api._pprint(goal.conclusion, b'2', b'CoqConstr', 30, 55)
+        hyp = api._pprint(goal.hypotheses[0].type, b'2', b'CoqConstr', 30, 55)
+        return [ty().pp, hyp().pp], api.written
+
+    def test_print_round_trip(self):
+        completed = b'(Answer query0 Completed)'
+        sexp = self._print_goal(self.SEXP, [
+            completed, b'(Answer query1 (ObjList ((CoqString "forall y : nat, ?e"))))',
+            b'(Answer query1 Completed)', b'(Answer query2 (ObjList ((CoqString nat))))',
+            b'(Answer query2 Completed)'])
+        json = self._print_goal(self.JSON, [
+            b'["Answer","query0",["Completed"]]',
+            b'["Answer","query1",["ObjList",[["CoqString","forall y : nat, ?e"]]]]',
+            b'["Answer","query1",["Completed"]]',
+            b'["Answer","query2",["ObjList",[["CoqString","nat"]]]]',
+            b'["Answer","query2",["Completed"]]'])
+        self.assertEqual(sexp, json)
+        self.assertEqual(json[0], ["forall y : nat, ?e", "nat"])
+        self.assertEqual(json[1][0][1][2], [b'CoqConstr', sx.load(self.TY)])
+
+    def test_auto_transport(self):
+        class Api(SerAPI):
+            TRANSPORT = "auto"
+        HELP = "       --printer=VAL (absent=sertop)\n           Select printer: {}\n\n"
+        with tempfile.TemporaryDirectory() as root:
+            transports = []
+            for name, printers in (("old", "sertop or human"),
+                                   ("new", "sertop, human or json")):
+                binpath = os.path.join(root, name)
+                with open(binpath, mode="w", encoding="utf-8") as f:
+                    f.write("#!/bin/sh\necho '{}'\n".format(HELP.format(printers)))
+                os.chmod(binpath, 0o755)
+                api = Api(binpath=binpath)
+                transports.append((api.transport, api.instance_args[0]))
+        self.assertEqual(transports, [("sexp", "--printer=sertop"), ("json", "--printer=json")])
+
+FAKE_SERTOP = "import sys; sys.path.insert(0, %r)" % os.path.dirname(os.path.dirname(__file__)) + r"""
+import re, time
+from alectryon import sexp as sx
+sid, sentences, executed = 1, {}, set()
+def out(s):
+    print(s, flush=True)
+def execute(sid, sentence):
+    if sentence.startswith(b'loop'):
+        time.sleep(60)
+    if sentence.startswith(b'slow'):
+        time.sleep(0.4)
+    if sentence.startswith(b'Check'):
+        out("(Feedback((doc_id 0)(span_id %d)(route 0)(contents(Message(level Notice)"
+            "(loc())(pp(Pp_string ok))(str ok)))))" % sid)
+    if sentence.startswith(b'Count'):
+        n = "s%d" % len(sentences)
+        out("(Feedback((doc_id 0)(span_id %d)(route 0)(contents(Message(level Notice)"
+            "(loc())(pp(Pp_string %s))(str %s)))))" % (sid, n, n))
+for line in sys.stdin.buffer:
+    qid, cmd = sx.load(line.strip())
+    qid = qid.decode()
+    if cmd[0] == b'Add':
+        for m in re.finditer(rb'[^\s.][^.]*[.]', sx.unescape(cmd[2])):
+            sid += 1
+            sentences[sid] = m.group()
+            out("(Answer %s(Added %d((bp %d)(ep %d))NewTip))" % (qid, sid, m.start(), m.end()))
+    elif cmd[0] == b'Exec': # Like Coq, run all pending sentences up to this one
+        for s in sorted(sentences):
+            if s <= int(cmd[1]) and s not in executed:
+                executed.add(s)
+                execute(s, sentences[s])
+    elif cmd[0] == b'Cancel':
+        canceled = [s for s in sentences if s >= int(cmd[1][0])]
+        for s in canceled:
+            del sentences[s]
+            executed.discard(s)
+        out("(Answer %s(Canceled(%s)))" % (qid, " ".join(map(str, canceled))))
+    elif cmd[0] == b'Query':
+        out("(Answer %s(ObjList()))" % qid)
+    elif cmd[0] == b'Print':
+        obj = cmd[2]
+        pp = obj[1][1].decode() if obj[0] == b'CoqPp' and obj[1][0] == b'Pp_string' else "ok"
+        out("(Answer %s(ObjList((CoqString %s))))" % (qid, pp))
+    out("(Answer %s Completed)" % qid)
+"""
+
+class FakeSerAPI(SerAPI):
+    BIN = sys.executable
+    REPL_ARGS = ("-u", "-c", FAKE_SERTOP)
+    SENTENCE_TIMEOUT = 1
+
+class RecordingObserver(Observer):
+    def __init__(self):
+        self.notifications = []
+
+    def _notify(self, n):
+        self.notifications.append(n)
+
+class TestTimeouts(unittest.TestCase):
+    @staticmethod
+    def _annotate(api, chunks):
+        api.observer = RecordingObserver()
+        start = time.monotonic()
+        annotated = api.annotate(chunks)
+        return annotated, api.observer.notifications, time.monotonic() - start
+
+    def test_sentence_timeout(self):
+        ok = [Message("ok")]
+        annotated, notifications, elapsed = self._annotate(
+            FakeSerAPI(), ["Check 1. loop. Check 2.", "Check 3."])
+        self.assertEqual(annotated, [
+            [Sentence("Check 1.", ok, []), Text(" "), Sentence("loop.", [], []),
+             Text(" "), Sentence("Check 2.", ok, [])],
+            [Sentence("Check 3.", ok, [])]])
+        self.assertEqual([n.level for n in notifications], [3])
+        self.assertIn("This sentence was skipped", notifications[0].message)
+        self.assertLess(elapsed, 30)
+
+    def test_document_timeout(self):
+        class Api(FakeSerAPI):
+            SENTENCE_TIMEOUT = None
+            DOCUMENT_TIMEOUT = 1
+        annotated, notifications, _ = self._annotate(Api(), ["Check 1. loop.", "Check 2."])
+        self.assertEqual(annotated, [
+            [Sentence("Check 1.", [Message("ok")], []), Text(" "), Sentence("loop.", [], [])],
+            [Sentence("Check 2.", [], [])]])
+        self.assertEqual([n.level for n in notifications], [3])
+        self.assertIn("Time budget of the document", notifications[0].message)
+
+class TestSuffix(unittest.TestCase):
+    def test_prefix_messages(self):
+        api = FakeSerAPI()
+        api.observer = RecordingObserver()
+        self.assertEqual(api.annotate_suffix(["Check 1.", "Check 3."], 1),
+                         [[Sentence("Check 3.", [Message("ok")], [])]])
+        self.assertEqual(api.observer.notifications, [])
+
+    def test_prefix_budget(self):
+        chunks = ["slow. slow. slow.", "Check 1."]
+        api = FakeSerAPI() # The prefix takes longer than SENTENCE_TIMEOUT
+        api.observer = RecordingObserver()
+        self.assertEqual(api.annotate_suffix(chunks, 1),
+                         [[Sentence("Check 1.", [Message("ok")], [])]])
+        self.assertEqual(api.observer.notifications, [])
+
+        class Api(FakeSerAPI):
+            SENTENCE_TIMEOUT = None
+            DOCUMENT_TIMEOUT = 1
+        api, start = Api(), time.monotonic()
+        api.observer = RecordingObserver()
+        self.assertEqual(api.annotate_suffix(["loop.", "Check 1."], 1),
+                         [[Sentence("Check 1.", [], [])]])
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertEqual([n.level for n in api.observer.notifications], [3])
+        self.assertIn("Time budget of the document", api.observer.notifications[0].message)
+
+class TestTimings(unittest.TestCase):
+    def test_record_timings(self):
+        class Api(FakeSerAPI):
+            RECORD_TIMINGS = True
+        [[check, _, loop]] = Api().annotate(["Check 1. loop."])
+        self.assertIsInstance(check.timing, Timing)
+        self.assertTrue(all(t >= 0 for t in check.timing))
+        self.assertIsNone(loop.timing) # Timed out
+        self.assertEqual(Api().metadata, {"sertop_args": (), "timings": True})
+        [[check]] = FakeSerAPI().annotate(["Check 1."])
+        self.assertIsNone(check.timing)
+
+class TestPool(unittest.TestCase):
+    def test_rewind(self):
+        with DriverPool() as pool:
+            FakeSerAPI.POOL = pool
+            try:
+                a, b = FakeSerAPI(fpath=Path("a.v")), FakeSerAPI(fpath=Path("b.v"))
+                self.assertEqual(pool._key(a), pool._key(b))
+                self.assertEqual(a.annotate(["Check 1.", "Count."]),
+                                 [[Sentence("Check 1.", [Message("ok")], [])],
+                                  [Sentence("Count.", [Message("s2")], [])]])
+                [[repl]] = pool.idle.values()
+                self.assertEqual(b.annotate(["Count."]),
+                                 [[Sentence("Count.", [Message("s1")], [])]])
+                self.assertEqual(pool.idle[pool._key(b)], [repl])
+            finally:
+                FakeSerAPI.POOL = None
+        self.assertIsNotNone(repl.poll())
+
+    def test_document_state(self):
+        with DriverPool() as pool:
+            FakeSerAPI.POOL = pool
+            try:
+                api = FakeSerAPI()
+                for chunks in (["Goal True."], ["Check 1."]):
+                    api.annotate(chunks)
+                    self.assertEqual(len(pool.idle[pool._key(api)]), 1)
+            finally:
+                FakeSerAPI.POOL = None
+        # The leading Check of the second document is not known to be neutral
+        self.assertEqual((api.goal_stats.queried, api.goal_stats.skipped), (2, 0))
+
+    def test_metadata(self):
+        self.assertEqual(FakeSerAPI(fpath=Path("a.v")).topfile, "a.v")
+        FakeSerAPI.POOL = DriverPool()
+        try:
+            api = FakeSerAPI(fpath=Path("a.v"))
+            self.assertEqual(api.topfile, "Top.v")
+            self.assertEqual(api.metadata, {"sertop_args": (), "topfile": "Top.v"})
+        finally:
+            FakeSerAPI.POOL = None
+
+if __name__ == '__main__':
+    unittest.main()
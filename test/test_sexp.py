@@ -0,0 +1,43 @@
+import unittest
+
+from alectryon import sexp as sx
+
+class TestLoad(unittest.TestCase):
+    SAMPLES = [
+        b'(Answer query3 Ack)',
+        b'(Feedback((doc_id 0)(span_id 4)(route 0)(contents(Message(level Notice)'
+        b'(loc())(pp(Pp_string "a \\"(quoted)\\" string"))(str "x\\\\")))))',
+        b'(Answer query4(ObjList((CoqExtGoal((goals(((info((evar(Ser_Evar 1))'
+        b'(name((Id g)))))(ty(App(Var(Id f))((Var(Id x)))))(hyp((((Id H))()'
+        b'(Prod(Name(Id y))(Sort Set)(Rel 1))))))))(stack())(bullet())(shelf())'
+        b'(given_up()))))))',
+    ]
+
+    def test_same_as_tokenize_parse(self):
+        for bs in self.SAMPLES:
+            self.assertEqual(sx.load(bs), sx.parse(sx.tokenize(bs)))
+
+    def test_lazy(self):
+        for bs in self.SAMPLES:
+            lazy = sx.load(bs, sx.TERM_RE)
+            self.assertEqual(sx.load(bytes(sx.dump(lazy))), sx.load(bs))
+        goal = sx.load(self.SAMPLES[2], sx.TERM_RE)[2][1][0][1][0][1][0]
+        ty = dict(goal)[b'ty']
+        self.assertIsInstance(ty, sx.Lazy)
+        self.assertEqual(ty.force(), [b'App', [b'Var', [b'Id', b'f']],
+                                      [[b'Var', [b'Id', b'x']]]])
+
+    def test_string_hides_term(self):
+        bs = b'(Answer q (CoqString "(App f)") (App g))'
+        self.assertEqual(sx.load(bs, sx.TERM_RE),
+                         [b'Answer', b'q', [b'CoqString', b'(App f)'],
+                          sx.Lazy(b'(App g)')])
+
+    def test_errors(self):
+        for bs in (b'', b'(a (b)', b'(a))', b'(a "b)'):
+            for lazy in (None, sx.TERM_RE):
+                with self.assertRaises(sx.ParseError):
+                    sx.load(bs, lazy)
+
+if __name__ == '__main__':
+    unittest.main()